@@ -0,0 +1,226 @@
+"""Cliente de Anthropic compartido, con límite de ritmo y reintentos.
+
+Todas las llamadas a Claude del proceso (todas las sesiones de la aplicación
+y los trabajos en segundo plano) pasan por un único limitador con tres cubos
+de tokens: peticiones por minuto (ANTHROPIC_RPM), tokens de entrada por
+minuto (ANTHROPIC_INPUT_TPM) y tokens de salida por minuto
+(ANTHROPIC_OUTPUT_TPM). Antes de cada petición se reserva una estimación de
+sus tokens de entrada, que se corrige con el uso real de la respuesta; los
+de salida se cobran al terminar, y mientras el cubo esté en negativo las
+peticiones nuevas esperan. Las respuestas en streaming se corrigen igual al
+cerrar el stream.
+
+Los errores transitorios (429, 5xx, 529 sobrecarga, errores de conexión) se
+reintentan con espera exponencial con jitter, respetando la cabecera
+retry-after si viene. Como cada página de un convenio es una petición, un
+fallo solo repite esa página.
+"""
+import os
+import random
+import threading
+import time
+
+import anthropic
+
+import metrics
+from convenio_context import CHARS_PER_TOKEN
+
+API_RPM = float(os.getenv("ANTHROPIC_RPM", "50"))
+API_INPUT_TPM = float(os.getenv("ANTHROPIC_INPUT_TPM", "40000"))
+API_OUTPUT_TPM = float(os.getenv("ANTHROPIC_OUTPUT_TPM", "8000"))
+API_MAX_RETRIES = int(os.getenv("ANTHROPIC_MAX_RETRIES", "6"))
+# Espera base y máxima (segundos) del backoff exponencial
+API_BACKOFF_BASE = float(os.getenv("ANTHROPIC_BACKOFF_BASE", "1"))
+API_BACKOFF_MAX = float(os.getenv("ANTHROPIC_BACKOFF_MAX", "60"))
+# Tokens que se reservan por imagen (máximo de una imagen de 1568 px)
+IMAGE_TOKENS = 1600
+
+_RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+_RETRYABLE_ERROR_TYPES = {"overloaded_error", "rate_limit_error", "api_error"}
+
+class TokenBucket:
+    """Cubo de tokens que se rellena a rate_per_minute, con capacidad de un minuto"""
+
+    def __init__(self, rate_per_minute, sleep=time.sleep, clock=time.monotonic):
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self._sleep = sleep
+        self._clock = clock
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount=1):
+        """Espera hasta poder consumir amount (una petición mayor que el cubo espera a tenerlo lleno)"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            self._sleep(wait)
+
+    def adjust(self, amount):
+        """Devuelve (amount > 0) o cobra (amount < 0) la diferencia con lo reservado"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+class RateLimiter:
+    def __init__(self, rpm=API_RPM, input_tpm=API_INPUT_TPM, output_tpm=API_OUTPUT_TPM):
+        self.requests = TokenBucket(rpm)
+        self.input_tokens = TokenBucket(input_tpm)
+        self.output_tokens = TokenBucket(output_tpm)
+
+    def acquire(self, estimated_tokens):
+        with metrics.span("espera_limite_api"):
+            self.requests.acquire(1)
+            self.input_tokens.acquire(estimated_tokens)
+            self.output_tokens.acquire(0)  # solo espera si el cubo de salida está en negativo
+
+    def settle(self, estimated_tokens, response):
+        """Corrige la reserva con los tokens de entrada reales de la respuesta y cobra los de salida"""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        actual = (getattr(usage, "input_tokens", None) or 0) + (getattr(usage, "cache_creation_input_tokens", None) or 0)
+        self.input_tokens.adjust(estimated_tokens - actual)
+        self.output_tokens.adjust(-(getattr(usage, "output_tokens", None) or 0))
+
+def estimate_request_tokens(request):
+    """Tokens de entrada aproximados de una petición (texto + imágenes)"""
+    text_chars = 0
+    images = 0
+
+    def visit(content):
+        nonlocal text_chars, images
+        if isinstance(content, str):
+            text_chars += len(content)
+        elif isinstance(content, list):
+            for block in content:
+                visit(block)
+        elif isinstance(content, dict):
+            if content.get("type") == "image":
+                images += 1
+            elif "text" in content:
+                text_chars += len(content["text"])
+            elif "content" in content:
+                visit(content["content"])
+
+    visit(request.get("system") or "")
+    for message in request.get("messages") or []:
+        visit(message.get("content"))
+    return int(text_chars / CHARS_PER_TOKEN) + images * IMAGE_TOKENS
+
+def is_retryable(error):
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    if not isinstance(error, anthropic.APIStatusError):
+        return False
+    if error.status_code in _RETRYABLE_STATUS:
+        return True
+    # Errores recibidos a mitad de un streaming (la respuesta HTTP era 200)
+    body = error.body if isinstance(error.body, dict) else {}
+    return (body.get("error") or {}).get("type") in _RETRYABLE_ERROR_TYPES
+
+def retry_delay(error, attempt):
+    """Segundos de espera antes del reintento attempt (0, 1, ...)"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after) + random.uniform(0, 1)
+        except ValueError:
+            pass
+    delay = min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def with_retries(func, max_retries=None, sleep=time.sleep):
+    """Llama a func() y la repite ante errores transitorios de la API"""
+    max_retries = API_MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            metrics.count("api_reintentos")
+            sleep(retry_delay(e, attempt))
+            attempt += 1
+
+class SharedMessages:
+    """messages de Anthropic con límite de ritmo y reintentos"""
+
+    def __init__(self, messages, limiter):
+        self._messages = messages
+        self._limiter = limiter
+
+    def create(self, **request):
+        def call():
+            estimated = estimate_request_tokens(request)
+            self._limiter.acquire(estimated)
+            start = time.perf_counter()
+            with metrics.span("api"):
+                response = self._messages.create(**request)
+            metrics.record_response(response, time.perf_counter() - start, request.get("model"))
+            self._limiter.settle(estimated, response)
+            return response
+        return with_retries(call)
+
+    def stream(self, **request):
+        """Aplica el límite de ritmo; quien consume el stream lo repite entero si falla (ver with_retries)"""
+        estimated = estimate_request_tokens(request)
+        self._limiter.acquire(estimated)
+        return _SettledStream(self._messages.stream(**request), self._limiter, estimated)
+
+class _SettledStream:
+    """Gestor de contexto del stream que corrige el limitador con el uso real al cerrarse"""
+
+    def __init__(self, manager, limiter, estimated):
+        self._manager = manager
+        self._limiter = limiter
+        self._estimated = estimated
+        self._stream = None
+
+    def __enter__(self):
+        self._stream = self._manager.__enter__()
+        return self._stream
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._limiter.settle(self._estimated, self._stream.get_final_message())
+        return self._manager.__exit__(exc_type, exc, tb)
+
+class SharedClient:
+    def __init__(self, client, limiter):
+        self.messages = SharedMessages(client.messages, limiter)
+
+_limiter = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+def set_limits(rpm, input_tpm, output_tpm=API_OUTPUT_TPM):
+    """Sustituye los límites del proceso (por ejemplo, para repartirlos entre procesos)"""
+    global _limiter
+    with _clients_lock:
+        _limiter = RateLimiter(rpm, input_tpm, output_tpm)
+        _clients.clear()
+
+def get_client(api_key):
+    """Cliente compartido por todo el proceso para esa API key"""
+    global _limiter
+    with _clients_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        if api_key not in _clients:
+            # Los reintentos los gestiona with_retries, no el SDK
+            _clients[api_key] = SharedClient(anthropic.Anthropic(api_key=api_key, max_retries=0), _limiter)
+        return _clients[api_key]
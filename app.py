@@ -1,19 +1,39 @@
 import streamlit as st
-import anthropic
-import base64
 import os
-import io
 import re
-from pathlib import Path
+import time
 from dotenv import load_dotenv
-import fitz  # PyMuPDF para leer PDFs
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-from openpyxl.utils import get_column_letter
+import api_client
+import convenio_library
+from cost_engine import (
+    SCENARIO_COLUMNS,
+    SCENARIO_GRID,
+    compute_costs,
+    render_cost_report,
+    scenario_grid,
+    scenario_table,
+)
+import jobs
+import metrics
+import planner
+from pipeline import (
+    CONVENIO_MAX_WORKERS,
+    CONVENIO_SEARCH_TTL_DAYS,
+    cached_relevant_pages,
+    excel_export_bytes,
+    extract_convenio_from_file,
+    run_analysis,
+)
 
 # Cargar variables de entorno (local) o secrets (Streamlit Cloud)
 load_dotenv()
 
+# Segundos entre consultas del estado de un análisis en segundo plano
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+
+# Mantener precompilada en segundo plano la biblioteca de convenios de la carpeta
+CONVENIO_LIBRARY_BACKGROUND = os.getenv("CONVENIO_LIBRARY_BACKGROUND", "1") == "1"
+
 def get_secret(key):
     """Obtiene un secret desde Streamlit Cloud o .env local"""
     try:
@@ -49,555 +69,97 @@ def check_login():
 
     return False
 
+@st.cache_data(ttl=60, show_spinner=False)
 def get_convenios_disponibles():
     """Lista los convenios PDF disponibles en la carpeta"""
-    carpeta = Path(__file__).parent
-    convenios = list(carpeta.glob("*.pdf"))
-    return [c for c in convenios if "uploaded_" not in c.name]
-
-def pdf_to_images(pdf_bytes):
-    """Convierte un PDF a lista de imágenes en base64"""
-    images = []
-    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-
-    for page_num in range(len(pdf_document)):
-        page = pdf_document.load_page(page_num)
-        mat = fitz.Matrix(2, 2)
-        pix = page.get_pixmap(matrix=mat)
-        img_bytes = pix.tobytes("png")
-        img_base64 = base64.standard_b64encode(img_bytes).decode("utf-8")
-        images.append(img_base64)
-
-    pdf_document.close()
-    return images
-
-def extract_text_from_pdf(pdf_bytes):
-    """Extrae texto de un PDF"""
-    text = ""
-    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-
-    for page_num in range(len(pdf_document)):
-        page = pdf_document.load_page(page_num)
-        text += page.get_text() + "\n\n"
-
-    pdf_document.close()
-    return text
-
-def extract_convenio_from_image(client, image_bytes, image_type, detailed=True):
-    """Extrae información del convenio desde una imagen usando Claude"""
-    img_base64 = base64.standard_b64encode(image_bytes).decode("utf-8")
-    media_type = f"image/{image_type}" if image_type != "jpg" else "image/jpeg"
-
-    if detailed:
-        prompt_text = """Extrae TODA la información de este convenio colectivo o tabla salarial.
-
-Incluye:
-- Tablas salariales con todas las categorías y salarios
-- Complementos (transporte, nocturnidad, festividad, etc.)
-- Antigüedad (trienios, porcentajes)
-- Pagas extras
-- Jornada laboral
-- Cualquier otro dato relevante para calcular costes de personal
-
-Transcribe los datos de forma estructurada y completa."""
-    else:
-        prompt_text = """Analiza brevemente esta página. ¿Contiene alguno de estos elementos?
-- Tablas salariales o retribuciones
-- Complementos salariales (transporte, nocturnidad, etc.)
-- Información sobre antigüedad/trienios
-- Pagas extraordinarias
-- Jornada laboral
-
-Responde SOLO con: "RELEVANTE: [motivo breve]" o "NO RELEVANTE"."""
-
-    response = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=4096 if detailed else 200,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": media_type,
-                            "data": img_base64,
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": prompt_text
-                    }
-                ]
-            }
-        ]
-    )
-
-    return response.content[0].text
-
-def identify_relevant_pages(client, images, progress_callback=None):
-    """Identifica qué páginas del convenio contienen información relevante"""
-    relevant_pages = []
-    total_pages = len(images)
-
-    for i, img_base64 in enumerate(images):
-        if progress_callback:
-            progress_callback(i + 1, total_pages)
-
-        img_bytes = base64.standard_b64decode(img_base64)
-        result = extract_convenio_from_image(client, img_bytes, "png", detailed=False)
-
-        if "RELEVANTE" in result.upper():
-            relevant_pages.append(i)
-
-    return relevant_pages
-
-def extract_convenio_from_file(client, file_bytes, file_type, is_image, progress_placeholder=None):
-    """Extrae información del convenio desde PDF o imagen con extracción inteligente"""
-    if is_image:
-        return extract_convenio_from_image(client, file_bytes, file_type, detailed=True)
-
-    # Para PDFs, intentar extraer texto primero
-    text = extract_text_from_pdf(file_bytes)
-
-    # Si hay suficiente texto, usarlo directamente
-    if len(text.strip()) >= 500:
-        return text
-
-    # PDF escaneado - usar extracción inteligente
-    images = pdf_to_images(file_bytes)
-    total_pages = len(images)
-
-    if progress_placeholder:
-        progress_placeholder.info(f"📄 Convenio de {total_pages} páginas detectado. Analizando estructura...")
-
-    # Si son pocas páginas, procesar todas
-    if total_pages <= 20:
-        all_text = ""
-        for i, img_base64 in enumerate(images):
-            if progress_placeholder:
-                progress_placeholder.info(f"📄 Procesando página {i+1}/{total_pages}...")
-            img_bytes = base64.standard_b64decode(img_base64)
-            page_text = extract_convenio_from_image(client, img_bytes, "png", detailed=True)
-            all_text += f"\n--- PÁGINA {i+1} ---\n{page_text}\n"
-        return all_text
-
-    # Para convenios largos: extracción inteligente en 2 fases
-    if progress_placeholder:
-        progress_placeholder.info(f"🔍 Fase 1: Escaneando {total_pages} páginas para identificar tablas salariales...")
-
-    def update_progress(current, total):
-        if progress_placeholder:
-            progress_placeholder.info(f"🔍 Fase 1: Escaneando página {current}/{total}...")
-
-    # Fase 1: Identificar páginas relevantes
-    relevant_pages = identify_relevant_pages(client, images, update_progress)
-
-    if not relevant_pages:
-        # Si no encontró páginas relevantes, usar las primeras 30 páginas
-        if progress_placeholder:
-            progress_placeholder.warning("⚠️ No se identificaron páginas con tablas. Procesando primeras 30 páginas...")
-        relevant_pages = list(range(min(30, total_pages)))
-    else:
-        if progress_placeholder:
-            progress_placeholder.success(f"✅ Encontradas {len(relevant_pages)} páginas con información salarial")
-
-    # Fase 2: Extraer contenido detallado de páginas relevantes
-    if progress_placeholder:
-        progress_placeholder.info(f"📊 Fase 2: Extrayendo datos de {len(relevant_pages)} páginas relevantes...")
-
-    all_text = ""
-    for idx, page_num in enumerate(relevant_pages):
-        if progress_placeholder:
-            progress_placeholder.info(f"📊 Fase 2: Extrayendo página {page_num+1} ({idx+1}/{len(relevant_pages)})...")
-        img_bytes = base64.standard_b64decode(images[page_num])
-        page_text = extract_convenio_from_image(client, img_bytes, "png", detailed=True)
-        all_text += f"\n--- PÁGINA {page_num+1} ---\n{page_text}\n"
-
-    return all_text
-
-def buscar_convenio_con_ia(client, nombre_convenio):
-    """Busca información del convenio usando Claude con búsqueda web para obtener datos actualizados"""
-
-    prompt = f"""Eres un experto en convenios colectivos españoles y legislación laboral.
-
-TAREA CRÍTICA: Busca en internet el convenio colectivo MÁS RECIENTE y ACTUALIZADO:
-"{nombre_convenio}"
-
-INSTRUCCIONES DE BÚSQUEDA:
-1. Busca PRIMERO en el BOE (Boletín Oficial del Estado) o boletines autonómicos/provinciales
-2. Busca la ÚLTIMA revisión salarial o tablas salariales publicadas
-3. Asegúrate de obtener los datos del año actual o el más reciente disponible
-4. Si hay varias publicaciones, usa SIEMPRE la más reciente
-
-DEBES INCLUIR CON DATOS ACTUALIZADOS:
-
-1. **TABLAS SALARIALES VIGENTES** - Salarios base por categoría profesional (indicar año de las tablas)
-2. **COMPLEMENTOS SALARIALES**:
-   - Plus de transporte
-   - Plus de nocturnidad
-   - Plus de festividad
-   - Otros pluses específicos del sector
-
-3. **ANTIGÜEDAD**:
-   - Tipo (trienios, quinquenios, bienios)
-   - Porcentaje o cantidad por periodo
-
-4. **PAGAS EXTRAORDINARIAS**:
-   - Número de pagas extras
-   - Cuantía (salario base, base + antigüedad, etc.)
-
-5. **JORNADA LABORAL**:
-   - Horas anuales
-   - Horas semanales
-
-6. **CATEGORÍAS PROFESIONALES** del sector
-
-7. **FECHA DE PUBLICACIÓN** del convenio/tablas salariales encontradas
-
-8. **FUENTE** (enlace al BOE u otra fuente oficial)
-
-IMPORTANTE:
-- NO uses datos aproximados ni de memoria
-- BUSCA siempre en internet para obtener los datos más recientes
-- Indica claramente la fecha y fuente de los datos
-
-Responde de forma estructurada y detallada para poder calcular costes de subrogación.
-"""
-
-    response = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=8192,
-        tools=[
-            {
-                "type": "web_search_20250305"
-            }
-        ],
-        messages=[
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ]
-    )
-
-    # Extraer el texto de la respuesta (puede venir en varios bloques por la búsqueda web)
-    result_text = ""
-    for block in response.content:
-        if hasattr(block, 'text'):
-            result_text += block.text + "\n"
-
-    return result_text.strip()
-
-def analyze_with_claude(client, file_bytes, file_type, convenio_text, years, is_image=False):
-    """Analiza el documento con Claude"""
-
-    prompt = f"""Eres un experto en recursos humanos y cálculo de costes de subrogación de personal en España.
-
-TAREA: Analiza la tabla de personal del documento adjunto y calcula los costes de subrogación con PRECISIÓN.
-
-⚠️ REGLA CRÍTICA - LEE ESTO PRIMERO ⚠️
-=============================================
-DEBES usar ÚNICAMENTE los salarios y datos que aparecen en el CONVENIO DE REFERENCIA proporcionado abajo.
-NUNCA inventes salarios. NUNCA uses valores por defecto como 750€.
-Si no encuentras un dato en el convenio, indica "NO ENCONTRADO EN CONVENIO" y deja el campo vacío.
-Cita textualmente de dónde sacas cada salario del convenio.
-=============================================
-
-CONVENIO DE REFERENCIA (USA ESTOS DATOS, NO OTROS):
-================================================================================
-{convenio_text[:50000] if convenio_text else "ERROR: No se ha proporcionado convenio de referencia. NO PUEDES CALCULAR SIN CONVENIO."}
-================================================================================
-
-=== PASO 1: EXTRAE LOS DATOS DEL CONVENIO (CITA TEXTUALMENTE) ===
-
-Antes de calcular, BUSCA en el texto del convenio anterior y COPIA TEXTUALMENTE los valores que encuentres:
-
-1. **NÚMERO DE PAGAS**: ¿Cuántas pagas al año? (12, 14, 15...)
-2. **SALARIO BASE** por categoría profesional (mensual y anual)
-3. **PLUSES Y COMPLEMENTOS** (indicar importe mensual de cada uno):
-   - Plus Transporte / Locomoción
-   - Plus Convenio / Plus Empresa
-   - Plus Nocturnidad (% sobre salario base)
-   - Plus Festivos / Domingos
-   - Plus Toxicidad / Penosidad / Peligrosidad
-   - Plus Disponibilidad
-   - Plus Asistencia
-   - Otros pluses específicos del sector
-4. **ANTIGÜEDAD**:
-   - Tipo: Trienios / Bienios / Quinquenios
-   - Importe o % por cada periodo
-   - ¿Se aplica sobre salario base o sobre total?
-5. **PAGAS EXTRAORDINARIAS**:
-   - Cuántas pagas extras
-   - Base de cálculo (solo salario base, base+antigüedad, salario total...)
-
-=== DATOS A EXTRAER DE LA TABLA DE PERSONAL ===
-
-- Trabajador (nombre o iniciales)
-- Antigüedad (fecha de alta)
-- Tipo contrato (código o descripción)
-- Categoría profesional
-- **JORNADA MENSUAL** (en horas) - MUY IMPORTANTE
-- Salario bruto anual (IGNORAR - recalcular desde convenio)
-
-=== CÁLCULO DE JORNADA ===
-
-**JORNADA COMPLETA DE REFERENCIA:**
-- Jornada completa mensual = 152 horas/mes (aprox. 1.824 horas/año)
-- Si un trabajador tiene 80 horas/mes = 52,6% de jornada
-- Si un trabajador tiene 148 horas/mes = 97,4% de jornada
-
-**PORCENTAJE DE JORNADA:**
-% Jornada = (Horas mensuales del trabajador / 152) × 100
-
-=== FÓRMULAS DE CÁLCULO ===
-
-**IMPORTANTE: IGNORAR los salarios que aparezcan en la tabla (pueden estar desactualizados)**
-**SIEMPRE calcular los salarios desde el CONVENIO proporcionalmente a la jornada**
-
-**CÁLCULO DETALLADO DEL SALARIO MENSUAL:**
-1. Salario Base (según categoría y convenio) × % Jornada
-2. Plus Antigüedad = (Importe trienio × Nº Trienios) × % Jornada
-3. Plus Transporte × % Jornada (si aplica)
-4. Plus Convenio × % Jornada (si aplica)
-5. Otros Pluses × % Jornada (si aplican)
-
-**Salario Bruto Mensual** = Suma de todos los conceptos anteriores
-
-**CÁLCULO ANUAL:**
-- Si el convenio indica X pagas → Salario Bruto Anual = Salario Bruto Mensual × X pagas
-- Las pagas extras pueden tener base de cálculo diferente (verificar en convenio)
-
-**COSTE EMPRESA:**
-- SS Empresa Anual = Salario Bruto Anual × 0.32
-- COSTE EMPRESA ANUAL = Salario Bruto Anual + SS Empresa Anual
-
-=== INSTRUCCIONES ===
-
-1. **PRIMERO - OBLIGATORIO**: Muestra EXACTAMENTE qué datos has encontrado en el convenio:
-
-📋 **DATOS EXTRAÍDOS DEL CONVENIO** (cita textual):
-| Concepto | Valor encontrado | Cita textual del convenio |
-|----------|------------------|---------------------------|
-| Número de pagas | X | "..." (copia la frase del convenio) |
-| Salario base [Categoría] | X €/mes | "..." (copia la frase del convenio) |
-| Plus Transporte | X €/mes | "..." (copia la frase del convenio) |
-| Plus Convenio | X €/mes | "..." (copia la frase del convenio) |
-| Antigüedad (trienio) | X €/mes | "..." (copia la frase del convenio) |
-| Otros pluses | X €/mes | "..." (copia la frase del convenio) |
-
-⚠️ Si algún valor NO aparece en el convenio, escribe "NO ENCONTRADO" y NO inventes un valor.
-
-2. Extrae TODOS los trabajadores con sus datos
-
-3. Para CADA trabajador calcula DESGLOSANDO todos los conceptos:
-   - Años de antigüedad = Fecha actual - Fecha alta
-   - Nº Trienios = Años antigüedad / 3 (parte entera)
-   - % Jornada = Horas mensuales / 152 × 100
-   - Salario Base × % Jornada = X €
-   - Plus Antigüedad (X trienios × importe) × % Jornada = X €
-   - Plus Transporte × % Jornada = X €
-   - Plus Convenio × % Jornada = X €
-   - Otros pluses × % Jornada = X €
-   - **Total Mensual** = Suma
-   - **Bruto Anual** = Total Mensual × Nº Pagas
-   - SS Empresa = Bruto Anual × 0.32
-   - **COSTE EMPRESA ANUAL** = Bruto Anual + SS Empresa
-
-4. FACTORES ADICIONALES:
-   - **Suplencia vacaciones**: 1 mes de suplencia = Coste mensual empresa
-   - **Absentismo 2%**: (Coste personal + Suplencias) × 0.02
-
-5. Período de cálculo: {years} año(s)
-
-6. **TABLA DE PERSONAL DETALLADA:**
-| Trabajador | Categoría | Trienios | % Jornada | Base | Antigüedad | Transporte | Otros Pluses | Total Mes | Bruto Anual | SS Empresa | Coste Empresa |
-
-7. **TABLA RESUMEN DE COSTES:**
-
-| Concepto | Año 1 | Total {years} Año(s) |
-|----------|-------|----------------------|
-| Coste Personal (suma todos) | € | € |
-| Suplencia Vacaciones (1 mes) | € | € |
-| Absentismo (2%) | € | € |
-| **SUBTOTAL PERSONAL** | € | € |
-| Gastos Generales (8%) | € | € |
-| Materiales Estimados | € | € |
-| **TOTAL GENERAL** | € | € |
-
-8. **RESUMEN DE HORAS:**
-| Concepto | Valor |
-|----------|-------|
-| Total trabajadores | X |
-| Horas mensuales totales | X horas |
-| Horas anuales totales | X horas |
-| Equivalente jornadas completas | X |
-
-9. **OBSERVACIONES**:
-   - Indica qué pluses se han aplicado y cuáles no
-   - Si algún dato no estaba en el convenio, indícalo
-   - Cualquier observación relevante sobre el cálculo
-
-⚠️ REGLAS OBLIGATORIAS - VIOLACIÓN = ERROR GRAVE:
-1. NUNCA inventes un salario. Si no lo encuentras en el convenio, pon "NO ENCONTRADO"
-2. NUNCA uses 750€ ni ningún valor por defecto
-3. CITA TEXTUALMENTE de dónde sacas cada salario del convenio proporcionado
-4. Si el convenio dice "Auxiliar de ayuda a domicilio: 1.200€/mes", usa 1.200€, NO 750€
-5. RESPETAR las horas de jornada de cada trabajador
-6. IGNORAR salarios de la tabla de personal - usar SOLO los del CONVENIO
-7. Aplicar proporción de jornada a todos los conceptos salariales
-8. Calcular SS Empresa como ~32% del bruto
-9. Formato español: punto miles, coma decimales (18.456,78 €)
-
-Si no puedes calcular porque falta información del convenio, INDICA CLARAMENTE qué falta.
-"""
-
-    messages_content = []
-
-    if is_image:
-        img_base64 = base64.standard_b64encode(file_bytes).decode("utf-8")
-        media_type = "image/png" if file_type == "png" else f"image/{file_type}"
-        messages_content.append({
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": media_type,
-                "data": img_base64,
-            }
-        })
-    else:
-        images = pdf_to_images(file_bytes)
-        for img_base64 in images[:10]:
-            messages_content.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": "image/png",
-                    "data": img_base64,
-                }
-            })
-
-    messages_content.append({
-        "type": "text",
-        "text": prompt
-    })
-
-    response = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=4096,
-        messages=[
-            {
-                "role": "user",
-                "content": messages_content
-            }
-        ]
-    )
+    return convenio_library.list_library_pdfs()
+
+@st.cache_data(ttl=300, max_entries=16, show_spinner="Estimando el análisis...")
+def plan_analysis(plan_request, max_usd, max_minutes, max_workers):
+    """Plan del análisis, en caché por el contenido de los documentos y las opciones"""
+    return planner.plan_analysis(plan_request, max_usd, max_minutes, max_workers)
+
+def attach_job(job_id):
+    """Asocia la sesión a un trabajo; el id va en la URL para recuperarlo al recargar"""
+    st.session_state.job_id = job_id
+    st.query_params["job"] = job_id
+
+def show_job_notes(notes):
+    for level, text in notes:
+        if level == "caption":
+            st.caption(text)
+        else:
+            getattr(st, level)(text)
+
+def parse_grid_values(text, percent=False):
+    """Valores de un parámetro de la rejilla escritos como "30 32 34" o "2,5; 3" (porcentajes en %)"""
+    values = []
+    for part in re.split(r"[;\s]+", text.strip()):
+        if part:
+            value = float(part.replace("%", "").replace(",", "."))
+            values.append(value / 100 if percent else value)
+    return tuple(sorted(set(values)))
+
+def format_grid_values(values, percent=False):
+    return " ".join(f"{v * 100 if percent else v:g}".replace(".", ",") for v in values)
+
+def show_scenarios(staff_data, years):
+    """Rejilla de escenarios (qué pasaría si...) sobre los datos ya extraídos, sin llamar a la IA"""
+    kinds = {key: kind for key, _, kind in SCENARIO_COLUMNS}
+    defaults = {**SCENARIO_GRID, "years": tuple(sorted(set(SCENARIO_GRID["years"]) | {years}))}
+    grid = {}
+    input_columns = st.columns(len(defaults))
+    for column, (key, label, kind) in zip(input_columns, SCENARIO_COLUMNS):
+        percent = kind == "porcentaje"
+        text = column.text_input(
+            label + (" (%)" if percent else ""),
+            value=format_grid_values(defaults[key], percent),
+            key=f"escenario_{key}",
+            help="Uno o varios valores separados por espacios o ;"
+        )
+        try:
+            grid[key] = parse_grid_values(text, percent)
+        except ValueError:
+            st.error(f"❌ Valores no válidos en {label}: {text}")
+            return None
 
-    return response.content[0].text
-
-def parse_markdown_tables(text):
-    """Extrae tablas markdown del texto"""
-    tables = []
-    lines = text.split('\n')
-    current_table = []
-    in_table = False
-
-    for line in lines:
-        if '|' in line and line.strip().startswith('|'):
-            in_table = True
-            current_table.append(line)
-        elif in_table and line.strip() == '':
-            if current_table:
-                tables.append(current_table)
-                current_table = []
-            in_table = False
-        elif in_table and '|' not in line:
-            if current_table:
-                tables.append(current_table)
-                current_table = []
-            in_table = False
-
-    if current_table:
-        tables.append(current_table)
-
-    return tables
-
-def create_excel_from_result(resultado, years):
-    """Crea un archivo Excel con los resultados del análisis"""
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Costes Subrogación"
-
-    # Estilos
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
+    try:
+        scenarios = scenario_grid(staff_data, grid)
+    except ValueError as e:
+        st.error(f"❌ {e}")
+        return None
+
+    formats = {"porcentaje": "percent", "importe": "euro", "numero": "%g"}
+    st.dataframe(
+        {label: scenarios[key] for key, label, _ in SCENARIO_COLUMNS},
+        column_config={
+            label: st.column_config.NumberColumn(label, format=formats[kinds[key]])
+            for key, label, _ in SCENARIO_COLUMNS
+        },
+        hide_index=True,
+        use_container_width=True
     )
-    money_alignment = Alignment(horizontal='right')
-    center_alignment = Alignment(horizontal='center')
-
-    # Título
-    ws['A1'] = f"CÁLCULO DE COSTES DE SUBROGACIÓN - {years} AÑO(S)"
-    ws['A1'].font = Font(bold=True, size=14)
-    ws.merge_cells('A1:I1')
-
-    # Intentar extraer tablas del resultado
-    tables = parse_markdown_tables(resultado)
-
-    current_row = 3
-
-    if tables:
-        for table in tables:
-            for line in table:
-                # Limpiar la línea
-                if '---' in line:
-                    continue
-                cells = [cell.strip() for cell in line.split('|') if cell.strip()]
-                if cells:
-                    for col, cell in enumerate(cells, 1):
-                        ws.cell(row=current_row, column=col, value=cell)
-                        ws.cell(row=current_row, column=col).border = border
-                        if current_row == 3 or (table == tables[0] and line == table[0]):
-                            ws.cell(row=current_row, column=col).font = header_font
-                            ws.cell(row=current_row, column=col).fill = header_fill
-                    current_row += 1
-            current_row += 2
-    else:
-        # Si no hay tablas, poner el texto completo
-        ws['A3'] = "Resultado del Análisis:"
-        ws['A3'].font = Font(bold=True)
-        current_row = 5
-        for line in resultado.split('\n'):
-            if line.strip():
-                ws.cell(row=current_row, column=1, value=line)
-                current_row += 1
-
-    # Ajustar anchos de columna
-    for col_num in range(1, ws.max_column + 1):
-        max_length = 0
-        column_letter = get_column_letter(col_num)
-        for row_num in range(1, ws.max_row + 1):
-            cell = ws.cell(row=row_num, column=col_num)
-            try:
-                if cell.value and len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50) if max_length > 0 else 10
-        ws.column_dimensions[column_letter].width = adjusted_width
-
-    # Guardar en buffer
-    excel_buffer = io.BytesIO()
-    wb.save(excel_buffer)
-    excel_buffer.seek(0)
-
-    return excel_buffer
+    st.caption(f"{len(scenarios['total_periodo']):,} escenarios. Se incluyen en el XLSX como hoja \"Escenarios\".")
+    return scenario_table(scenarios)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id):
+    """Estado de un trabajo en curso; se refresca solo, sin volver a ejecutar la página"""
+    job = jobs.get(job_id)
+    if job is None or job.finished:
+        st.rerun()
+    snapshot = job.snapshot()
+    st.subheader(f"⏳ Análisis {snapshot['status']}: {snapshot['description']}")
+    if snapshot["stage"]:
+        st.caption(f"Etapa: {snapshot['stage']} · {time.time() - snapshot['created_at']:.0f} s")
+    show_job_notes(snapshot["notes"])
+    level, text = snapshot["message"]
+    getattr(st, level)(text)
+    if snapshot["progress"] is not None:
+        st.progress(min(max(snapshot["progress"], 0.0), 1.0))
+    if snapshot["partial"]:
+        st.markdown(snapshot["partial"])
+    st.caption("Puedes seguir usando la aplicación o recargar la página: el análisis continúa en el servidor.")
 
 def main():
     st.set_page_config(
@@ -616,8 +178,19 @@ def main():
         if st.button("🚪 Cerrar Sesión"):
             st.session_state.authenticated = False
             st.rerun()
+        recent_jobs = jobs.jobs_for(get_secret("LOGIN_USER"), limit=5)
+        if recent_jobs:
+            st.markdown("**🕘 Análisis recientes**")
+            for job in recent_jobs:
+                if st.button(f"{job.description} · {job.status}", key=f"job_{job.id}", use_container_width=True):
+                    attach_job(job.id)
+                    st.rerun()
         st.markdown("---")
 
+    # Volver a engancharse al análisis indicado en la URL (tras recargar o reconectar)
+    if "job_id" not in st.session_state and st.query_params.get("job"):
+        st.session_state.job_id = st.query_params["job"]
+
     st.title("📊 Calculadora de Costes de Subrogación")
     st.markdown("---")
 
@@ -627,8 +200,14 @@ def main():
         st.error("❌ No se encontró la API key de Anthropic.")
         st.stop()
 
-    # Inicializar cliente de Anthropic
-    client = anthropic.Anthropic(api_key=api_key)
+    # Cliente de Anthropic compartido por todas las sesiones (límite de ritmo y reintentos)
+    client = api_client.get_client(api_key)
+
+    if CONVENIO_LIBRARY_BACKGROUND:
+        convenio_library.start_background_indexer(
+            lambda pdf_bytes: extract_convenio_from_file(client, pdf_bytes, "pdf", False),
+            cached_relevant_pages
+        )
 
     # Sidebar con configuración
     with st.sidebar:
@@ -642,6 +221,36 @@ def main():
             help="Número de años para calcular el coste total de subrogación"
         )
 
+        max_workers = st.number_input(
+            "Páginas en paralelo",
+            min_value=1,
+            max_value=32,
+            value=CONVENIO_MAX_WORKERS,
+            help="Número de páginas del convenio que se envían a la IA simultáneamente"
+        )
+
+        streaming = st.checkbox(
+            "Mostrar respuesta en tiempo real",
+            value=True,
+            help="Muestra el resultado de la IA a medida que se genera"
+        )
+
+        max_usd = st.number_input(
+            "Presupuesto máximo por análisis ($)",
+            min_value=0.0,
+            value=0.0,
+            step=0.1,
+            help="0 = sin límite. Si el plan lo supera, se reduce la resolución, se agrupan más páginas en la fase 1 o se recorta el convenio"
+        )
+
+        max_minutes = st.number_input(
+            "Tiempo máximo por análisis (min)",
+            min_value=0.0,
+            value=0.0,
+            step=1.0,
+            help="0 = sin límite"
+        )
+
         st.markdown("---")
 
         st.header("📁 Convenio de Referencia")
@@ -656,6 +265,7 @@ def main():
         convenio_seleccionado = "Ninguno"
         convenio_subido = None
         convenio_busqueda = ""
+        forzar_busqueda = False
 
         if metodo_convenio == "Buscar con IA":
             convenio_busqueda = st.text_input(
@@ -665,6 +275,11 @@ def main():
             )
             if convenio_busqueda:
                 st.success(f"✅ Se buscará en internet la versión más reciente: {convenio_busqueda}")
+            forzar_busqueda = st.checkbox(
+                "🔄 Forzar nueva búsqueda",
+                value=False,
+                help=f"Ignora el resultado guardado (se reutiliza durante {CONVENIO_SEARCH_TTL_DAYS:g} días)"
+            )
 
         elif metodo_convenio == "Seleccionar archivo":
             convenios = get_convenios_disponibles()
@@ -732,74 +347,120 @@ def main():
 
     st.markdown("---")
 
-    # Botón de análisis
+    # Botón de análisis: el trabajo se ejecuta en segundo plano (ver jobs)
     if uploaded_file:
-        if st.button("🔍 Analizar y Calcular Costes", type="primary", use_container_width=True):
-
-            convenio_text = ""
-
-            # Obtener información del convenio según el método seleccionado
-            if metodo_convenio == "Buscar con IA" and convenio_busqueda:
-                with st.spinner(f"🌐 Buscando en internet el convenio más reciente: {convenio_busqueda}..."):
-                    convenio_text = buscar_convenio_con_ia(client, convenio_busqueda)
-                    st.success("✅ Convenio actualizado obtenido de internet")
-            elif convenio_subido:
-                progress_placeholder = st.empty()
-                progress_placeholder.info("📄 Procesando archivo del convenio...")
-                convenio_bytes = convenio_subido.read()
-                is_convenio_image = convenio_subido.type.startswith("image")
-                convenio_file_type = convenio_subido.type.split("/")[-1]
-                convenio_text = extract_convenio_from_file(client, convenio_bytes, convenio_file_type, is_convenio_image, progress_placeholder)
-                convenio_subido.seek(0)
-                progress_placeholder.success("✅ Convenio procesado correctamente")
-            elif convenio_seleccionado != "Ninguno":
-                carpeta = Path(__file__).parent
-                convenio_path = carpeta / convenio_seleccionado
-                with open(convenio_path, "rb") as f:
-                    pdf_bytes = f.read()
-                    progress_placeholder = st.empty()
-                    progress_placeholder.info("📄 Procesando convenio seleccionado...")
-                    convenio_text = extract_convenio_from_file(client, pdf_bytes, "pdf", False, progress_placeholder)
-                    progress_placeholder.success("✅ Convenio procesado correctamente")
-
-            # Mostrar preview del convenio extraído para verificación
-            if convenio_text:
-                with st.expander("👁️ Ver texto extraído del convenio (para verificar)"):
-                    st.text_area("Contenido del convenio:", convenio_text[:10000], height=200, disabled=True)
-                    st.caption(f"Total caracteres extraídos: {len(convenio_text)}")
+        request = {
+            "metodo": None,
+            "file_bytes": uploaded_file.getvalue(),
+            "file_type": uploaded_file.type.split("/")[-1],
+            "is_image": uploaded_file.type.startswith("image"),
+            "years": years,
+            "max_workers": max_workers,
+            "streaming": streaming,
+        }
+        if metodo_convenio == "Buscar con IA" and convenio_busqueda:
+            request.update(metodo="buscar", convenio_busqueda=convenio_busqueda, forzar_busqueda=forzar_busqueda)
+        elif convenio_subido:
+            request.update(
+                metodo="subir",
+                convenio_bytes=convenio_subido.getvalue(),
+                convenio_file_type=convenio_subido.type.split("/")[-1],
+                convenio_is_image=convenio_subido.type.startswith("image"),
+            )
+        elif convenio_seleccionado != "Ninguno":
+            request.update(metodo="biblioteca", convenio_nombre=convenio_seleccionado)
+
+        # Plan previo: llamadas, tokens, tiempo y coste estimados con la estrategia elegida
+        # El último análisis de la sesión puede haber llenado la caché de disco: cambia la clave del plan
+        plan_request = dict(request, estado_cache=st.session_state.get("applied_job"))
+        if request["metodo"] == "biblioteca":
+            convenio_path = convenio_library.LIBRARY_DIR / convenio_seleccionado
+            entry = convenio_library.get_entry(convenio_path)
+            if entry:
+                plan_request["convenio_text"] = entry["text"]
             else:
-                st.warning("⚠️ No se ha cargado ningún convenio. Los cálculos pueden no ser precisos.")
-
-            with st.spinner("🔄 Analizando documento con IA... Esto puede tardar unos segundos."):
-                try:
-                    file_bytes = uploaded_file.read()
-                    is_image = uploaded_file.type.startswith("image")
-                    file_type = uploaded_file.type.split("/")[-1]
-
-                    resultado = analyze_with_claude(
-                        client,
-                        file_bytes,
-                        file_type,
-                        convenio_text,
-                        years,
-                        is_image
-                    )
-
-                    # Guardar resultado en session_state
-                    st.session_state.resultado = resultado
-                    st.session_state.years = years
+                plan_request["convenio_bytes"] = convenio_path.read_bytes()
+        try:
+            plan = plan_analysis(plan_request, max_usd, max_minutes, max_workers)
+        except Exception as e:
+            plan = None
+            st.caption(f"No se ha podido estimar el análisis: {e}")
+        if plan:
+            with st.expander("🧮 Plan del análisis", expanded=True):
+                if not plan["dentro_presupuesto"]:
+                    st.warning("⚠️ Ninguna estrategia cabe en el presupuesto: se usará la más barata")
+                st.markdown(planner.format_plan(plan))
+            request["estrategia"] = plan["estrategia"]
 
-                    st.success("✅ Análisis completado")
-
-                except Exception as e:
-                    st.error(f"❌ Error al analizar: {str(e)}")
-                    st.exception(e)
+        if st.button("🔍 Analizar y Calcular Costes", type="primary", use_container_width=True):
+            job_id = jobs.submit(
+                run_analysis, client, request, owner=get_secret("LOGIN_USER"), description=uploaded_file.name
+            )
+            attach_job(job_id)
+
+    job_id = st.session_state.get("job_id")
+    if job_id:
+        job = jobs.get(job_id)
+        if job is None:
+            st.warning("⚠️ El análisis ya no está disponible en el servidor")
+            del st.session_state.job_id
+            st.query_params.pop("job", None)
+        elif not job.finished:
+            show_job_progress(job_id)
+        elif st.session_state.get("applied_job") != job_id:
+            st.session_state.applied_job = job_id
+            snapshot = job.snapshot()
+            st.session_state.job_notes = snapshot["notes"]
+            st.session_state.run_metrics = snapshot["metrics"]
+            st.session_state.job_error = None
+            st.session_state.staff_diff = None
+            if job.status == jobs.DONE:
+                # Versión corregida de un documento ya analizado: mostrar qué ha cambiado
+                st.session_state.staff_diff = job.result.get("staff_diff")
+                st.session_state.staff_data = job.result["staff_data"]
+                st.session_state.resultado = job.result["resultado"]
+                st.session_state.years = job.result["years"]
+                st.session_state.convenio_text = job.result["convenio_text"]
+            else:
+                st.session_state.job_error = (job.error, job.traceback)
+
+    if job_id and st.session_state.get("applied_job") == job_id:
+        if st.session_state.get("convenio_text"):
+            with st.expander("👁️ Ver texto extraído del convenio (para verificar)"):
+                st.text_area("Contenido del convenio:", st.session_state.convenio_text[:10000], height=200, disabled=True)
+                st.caption(f"Total caracteres extraídos: {len(st.session_state.convenio_text)}")
+        show_job_notes(st.session_state.get("job_notes", []))
+        if st.session_state.get("staff_diff"):
+            with st.expander("🔀 Cambios respecto a la versión anterior", expanded=True):
+                st.markdown(st.session_state.staff_diff)
+        if st.session_state.get("job_error"):
+            error, trace = st.session_state.job_error
+            st.error(f"❌ Error al analizar: {error}")
+            st.code(trace)
+
+    if st.session_state.get("run_metrics"):
+        with st.sidebar:
+            with st.expander("📈 Desglose de la última ejecución"):
+                st.markdown(metrics.format_breakdown(st.session_state.run_metrics))
+
+    # Si solo han cambiado los años, recalcular localmente sin llamar a la IA
+    if "staff_data" in st.session_state and st.session_state.years != years:
+        st.session_state.resultado = render_cost_report(
+            st.session_state.staff_data, compute_costs(st.session_state.staff_data, years)
+        )
+        st.session_state.years = years
 
     # Mostrar resultados si existen
     if "resultado" in st.session_state:
         st.header("📊 Resultados del Análisis")
         st.markdown(st.session_state.resultado)
 
+        scenarios = None
+        if "staff_data" in st.session_state:
+            st.markdown("---")
+            st.subheader("🎯 Escenarios")
+            scenarios = show_scenarios(st.session_state.staff_data, st.session_state.years)
+
         st.markdown("---")
         st.subheader("📥 Descargar Resultados")
 
@@ -816,14 +477,11 @@ def main():
             )
 
         with col_download2:
-            # Descargar como Excel
-            excel_buffer = create_excel_from_result(
-                st.session_state.resultado,
-                st.session_state.years
-            )
+            # Descargar como Excel: el libro se genera (y se memoriza) solo al pulsar el botón
+            resultado, result_years = st.session_state.resultado, st.session_state.years
             st.download_button(
                 label="📊 Descargar como XLSX",
-                data=excel_buffer,
+                data=lambda: excel_export_bytes(resultado, result_years, scenarios),
                 file_name=f"subrogacion_{st.session_state.years}_anios.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                 use_container_width=True
@@ -0,0 +1,176 @@
+"""Procesamiento por lotes de tablas de personal, sin interfaz.
+
+Extrae el convenio una sola vez y analiza en paralelo todas las tablas de
+personal (PDF o imagen) de una carpeta, con un número limitado de llamadas
+simultáneas a la API compartido entre todos los procesos. Genera un XLSX por
+archivo y un libro resumen con todos los resultados:
+
+    python batch.py tablas/ --convenio convenio.pdf --years 2 --out resultados/
+    python batch.py tablas/ --buscar "Convenio de limpieza de Madrid"
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from openpyxl import Workbook
+from openpyxl.styles import Font, PatternFill
+
+import api_client
+import metrics
+from cost_engine import compute_costs, render_cost_report
+from pipeline import buscar_convenio_con_ia, create_excel_from_result, extract_convenio_from_file, extract_staff_data
+
+STAFF_EXTENSIONS = {".pdf": "pdf", ".png": "png", ".jpg": "jpeg", ".jpeg": "jpeg"}
+
+# Estado de cada proceso del pool (se inicializa en _init_worker)
+_client = None
+
+class _BoundedMessages:
+    """messages de Anthropic con un semáforo compartido entre procesos"""
+
+    def __init__(self, messages, semaphore):
+        self._messages = messages
+        self._semaphore = semaphore
+
+    def create(self, **request):
+        with self._semaphore:
+            return self._messages.create(**request)
+
+class _BoundedClient:
+    def __init__(self, client, semaphore):
+        self.messages = _BoundedMessages(client.messages, semaphore)
+
+def _make_client(semaphore):
+    return _BoundedClient(api_client.get_client(os.getenv("ANTHROPIC_API_KEY")), semaphore)
+
+def _init_worker(semaphore, processes):
+    global _client
+    # Cada proceso tiene su propio limitador: se reparten los límites de la API entre ellos
+    api_client.set_limits(
+        api_client.API_RPM / processes, api_client.API_INPUT_TPM / processes, api_client.API_OUTPUT_TPM / processes
+    )
+    _client = _make_client(semaphore)
+
+def process_staff_file(path, convenio_text, years, out_dir):
+    """Analiza una tabla de personal y escribe su XLSX. Devuelve una fila de resumen."""
+    path = Path(path)
+    row = {"archivo": path.name, "trabajadores": 0, "coste_personal": None, "total": None, "error": ""}
+    try:
+        file_type = STAFF_EXTENSIONS[path.suffix.lower()]
+        with metrics.run("batch", archivo=path.name):
+            data = extract_staff_data(_client, path.read_bytes(), file_type, convenio_text, is_image=file_type != "pdf")
+            with metrics.span("calculo_costes"):
+                costs = compute_costs(data, years)
+                resultado = render_cost_report(data, costs)
+
+        out_path = Path(out_dir) / f"{path.stem}_subrogacion_{years}_anios.xlsx"
+        out_path.write_bytes(create_excel_from_result(resultado, years).getvalue())
+
+        row.update(
+            trabajadores=costs["hours"]["trabajadores"],
+            coste_personal=costs["summary"]["coste_personal"] * years,
+            total=costs["summary"]["total"] * years,
+            xlsx=out_path.name,
+        )
+    except Exception as e:
+        row["error"] = str(e)
+    return row
+
+def write_summary(rows, years, out_path):
+    """Libro resumen con una fila por tabla de personal y el total"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Resumen"
+    headers = ["Archivo", "Trabajadores", f"Coste Personal ({years} año/s)", f"Total General ({years} año/s)", "XLSX", "Error"]
+    ws.append(headers)
+    for cell in ws[1]:
+        cell.font = Font(bold=True, color="FFFFFF")
+        cell.fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+
+    for row in rows:
+        ws.append([row["archivo"], row["trabajadores"], row["coste_personal"], row["total"], row.get("xlsx", ""), row["error"]])
+    ok = [row for row in rows if not row["error"]]
+    ws.append([
+        "TOTAL",
+        sum(row["trabajadores"] for row in ok),
+        sum(row["coste_personal"] for row in ok),
+        sum(row["total"] for row in ok),
+    ])
+    ws.cell(row=ws.max_row, column=1).font = Font(bold=True)
+
+    for row_cells in ws.iter_rows(min_row=2, min_col=3, max_col=4):
+        for cell in row_cells:
+            cell.number_format = '#,##0.00 "€"'
+    for col, width in zip("ABCDEF", (40, 14, 24, 24, 40, 50)):
+        ws.column_dimensions[col].width = width
+    wb.save(out_path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calcula costes de subrogación para todas las tablas de personal de una carpeta")
+    parser.add_argument("staff_dir", help="Carpeta con las tablas de personal (PDF, PNG o JPG)")
+    convenio = parser.add_mutually_exclusive_group()
+    convenio.add_argument("--convenio", help="Archivo del convenio (PDF o imagen)")
+    convenio.add_argument("--buscar", help="Nombre del convenio para buscarlo con IA")
+    parser.add_argument("--years", type=int, default=1, help="Años para el cálculo")
+    parser.add_argument("--out", default="resultados", help="Carpeta de salida")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Procesos en paralelo")
+    parser.add_argument("--api-concurrency", type=int, default=4, help="Llamadas simultáneas máximas a la API")
+    args = parser.parse_args(argv)
+
+    if not os.getenv("ANTHROPIC_API_KEY"):
+        parser.error("Falta ANTHROPIC_API_KEY en el entorno o en .env")
+
+    staff_files = sorted(p for p in Path(args.staff_dir).iterdir() if p.suffix.lower() in STAFF_EXTENSIONS)
+    if not staff_files:
+        parser.error(f"No hay tablas de personal en {args.staff_dir}")
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    ctx = multiprocessing.get_context("spawn")
+    semaphore = ctx.BoundedSemaphore(args.api_concurrency)
+
+    # El convenio se extrae una sola vez, en el proceso principal
+    convenio_text = ""
+    client = _make_client(semaphore)
+    if args.convenio:
+        convenio_path = Path(args.convenio)
+        file_type = STAFF_EXTENSIONS.get(convenio_path.suffix.lower(), "pdf")
+        print(f"Extrayendo convenio {convenio_path.name}...")
+        convenio_text = extract_convenio_from_file(
+            client, convenio_path.read_bytes(), file_type, file_type != "pdf", max_workers=args.api_concurrency
+        )
+    elif args.buscar:
+        print(f"Buscando convenio: {args.buscar}...")
+        convenio_text = buscar_convenio_con_ia(client, args.buscar)
+    else:
+        print("⚠️ Sin convenio de referencia: los cálculos pueden no ser precisos", file=sys.stderr)
+
+    rows = []
+    processes = min(args.workers, len(staff_files))
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(semaphore, processes),
+    ) as executor:
+        futures = [
+            executor.submit(process_staff_file, path, convenio_text, args.years, out_dir)
+            for path in staff_files
+        ]
+        for done, future in enumerate(as_completed(futures), start=1):
+            row = future.result()
+            rows.append(row)
+            status = f"ERROR: {row['error']}" if row["error"] else f"{row['trabajadores']} trabajadores"
+            print(f"[{done}/{len(staff_files)}] {row['archivo']}: {status}")
+
+    rows.sort(key=lambda row: row["archivo"])
+    summary_path = out_dir / f"resumen_subrogacion_{args.years}_anios.xlsx"
+    write_summary(rows, args.years, summary_path)
+    print(f"Resumen: {summary_path}")
+    return 0 if all(not row["error"] for row in rows) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,361 @@
+"""Banco de pruebas de rendimiento sin conexión (sin llamadas reales a la API).
+
+Genera con PyMuPDF convenios y tablas de personal sintéticos (solo texto,
+escaneados o mixtos) y los pasa por las etapas del pipeline contra un
+cliente falso con latencia configurable y respuestas predefinidas:
+
+    convenio  extract_convenio_from_file
+    triaje    identify_relevant_pages
+    analisis  analyze_with_claude
+    excel     create_excel_from_result
+
+Para cada escenario y etapa se mide el tiempo real, cuánto sube la etapa el
+pico de memoria (RSS) del proceso, los bytes enviados, las llamadas por tipo
+y los tokens. Cada escenario se ejecuta en su propio proceso y con una caché
+de disco vacía, así que los resultados son en frío y el pico de RSS que se
+indica por escenario es el suyo.
+
+    python benchmark.py --pages 60 --staff-pages 4 --latency 0.3
+    python benchmark.py --save-baseline bench.json
+    python benchmark.py --compare bench.json --tolerance 0.2
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import types
+from pathlib import Path
+
+import fitz
+
+import api_client
+import convenio_cache
+import metrics
+import pipeline
+
+MODES = ("texto", "escaneado", "mixto")
+# Métricas que se comparan con la línea base (más es peor)
+COMPARED = ("wall_s", "bytes_sent", "api_calls")
+
+_CATEGORIAS = ["Limpiador/a", "Especialista", "Peón", "Encargado/a", "Conductor/a", "Oficial 1ª"]
+
+# --- Documentos sintéticos ---
+
+def _draw_table(page, rows, x0=50, y0=120, widths=None, row_height=18, fontsize=8):
+    widths = widths or [(page.rect.width - 2 * x0) / len(rows[0])] * len(rows[0])
+    xs = [x0]
+    for w in widths:
+        xs.append(xs[-1] + w)
+    for r, row in enumerate(rows):
+        y = y0 + r * row_height
+        for c, value in enumerate(row):
+            page.insert_text((xs[c] + 3, y + row_height - 5), str(value), fontsize=fontsize)
+    for r in range(len(rows) + 1):
+        page.draw_line((xs[0], y0 + r * row_height), (xs[-1], y0 + r * row_height))
+    for x in xs:
+        page.draw_line((x, y0), (x, y0 + len(rows) * row_height))
+
+def _convenio_page(doc, page_num, salary):
+    page = doc.new_page()
+    if salary:
+        page.insert_text((50, 80), f"ANEXO {page_num + 1}. TABLA SALARIAL", fontsize=12)
+        rows = [["Categoría", "Salario base mensual", "Plus transporte", "Plus convenio"]]
+        rows += [[c, f"{1100 + 37 * i:,.2f} €", "98,45 €", "55,10 €"] for i, c in enumerate(_CATEGORIAS)]
+        _draw_table(page, rows)
+    else:
+        page.insert_text((50, 80), f"ARTÍCULO {page_num + 1}. Disposiciones generales", fontsize=12)
+        paragraph = (
+            "Las partes firmantes acuerdan que el presente convenio será de aplicación a todas las "
+            "empresas y personas trabajadoras del sector, sin perjuicio de lo dispuesto en la normativa vigente."
+        )
+        page.insert_textbox(fitz.Rect(50, 100, page.rect.width - 50, page.rect.height - 50), (paragraph + " ") * 12, fontsize=10)
+
+def _staff_page(doc, page_num, rows_per_page):
+    page = doc.new_page()
+    rows = [["Nombre", "Antigüedad", "Contrato", "Categoría", "Jornada"]] if page_num == 0 else []
+    for i in range(rows_per_page):
+        n = page_num * rows_per_page + i
+        rows.append([f"Trabajador {n}", f"01/0{1 + n % 9}/20{10 + n % 14}", "100" if n % 3 else "200",
+                     _CATEGORIAS[n % len(_CATEGORIAS)], f"{20 + n % 20} h/sem"])
+    if page_num == 0:
+        page.insert_text((50, 80), "RELACIÓN DE PERSONAL A SUBROGAR", fontsize=12)
+    _draw_table(page, rows, widths=[120, 80, 60, 120, 80])
+
+def _rasterize(doc, scanned, dpi=110):
+    """PDF en el que las páginas de scanned son solo una imagen (sin capa de texto)"""
+    out = fitz.open()
+    for page_num, page in enumerate(doc):
+        if page_num in scanned:
+            pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+            new_page = out.new_page(width=page.rect.width, height=page.rect.height)
+            new_page.insert_image(new_page.rect, stream=pix.tobytes("jpeg", jpg_quality=75))
+        else:
+            out.insert_pdf(doc, from_page=page_num, to_page=page_num)
+    return out.tobytes()
+
+def _apply_mode(doc, mode):
+    if mode == "texto":
+        scanned = set()
+    elif mode == "escaneado":
+        scanned = set(range(len(doc)))
+    else:
+        scanned = set(range(1, len(doc), 2))
+    return _rasterize(doc, scanned)
+
+def make_convenio_pdf(pages, mode="texto", salary_every=5):
+    """Convenio sintético: artículos de texto y una tabla salarial cada salary_every páginas"""
+    doc = fitz.open()
+    for page_num in range(pages):
+        _convenio_page(doc, page_num, salary=page_num % salary_every == salary_every - 1)
+    return _apply_mode(doc, mode)
+
+def make_staff_pdf(pages, mode="texto", rows_per_page=30):
+    """Tabla de personal sintética con cabecera en la primera página"""
+    doc = fitz.open()
+    for page_num in range(pages):
+        _staff_page(doc, page_num, rows_per_page)
+    return _apply_mode(doc, mode)
+
+# --- Cliente falso ---
+
+class FakeMessages:
+    """Imita messages.create con latencia y respuestas predefinidas según el tipo de petición"""
+
+    def __init__(self, latency=0.2, image_latency=0.05, relevant_ratio=0.25, rows_per_page=30):
+        self.latency = latency
+        self.image_latency = image_latency
+        self.relevant_ratio = relevant_ratio
+        self.rows_per_page = rows_per_page
+        self.calls = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.bytes_sent = 0
+
+    def _relevant(self, image_block):
+        # Veredicto determinista a partir del contenido de la imagen
+        digest = hashlib.sha256(image_block["source"]["data"].encode("ascii")).digest()
+        return digest[0] / 256 < self.relevant_ratio
+
+    def create(self, **request):
+        content = request["messages"][0]["content"]
+        images = [block for block in content if block.get("type") == "image"]
+        prompt = content[-1].get("text", "") if content else ""
+        text = None
+        tool_input = None
+
+        if request.get("tools"):
+            kind = "analisis"
+            pages = [
+                int(match.group(1)) for block in content
+                if (match := re.match(r"--- PÁGINA (\d+)", block.get("text", "")))
+            ] or [1]
+            tool_input = {
+                "convenio": {
+                    "numero_pagas": 14,
+                    "categorias": [{"categoria": c, "salario_base_mensual": 1100 + 37 * i, "cita": "Anexo"} for i, c in enumerate(_CATEGORIAS)],
+                    "pluses": [{"concepto": "Plus transporte", "importe_mensual": 98.45, "cita": "Anexo"}],
+                    "antiguedad": {"tipo": "trienio", "porcentaje": 5, "cita": "Art. 20"},
+                },
+                "trabajadores": [
+                    {"trabajador": f"T{id(request)}-{i}", "fecha_antiguedad": "2015-03-01", "tipo_contrato": "100",
+                     "categoria": _CATEGORIAS[i % len(_CATEGORIAS)], "categoria_convenio": _CATEGORIAS[i % len(_CATEGORIAS)],
+                     "horas_mensuales": 80 + i % 80, "pagina": pages[i // self.rows_per_page]}
+                    for i in range(len(pages) * self.rows_per_page)
+                ],
+                "observaciones": [],
+            }
+        elif "Para cada página indica" in prompt:
+            kind = "triaje_lote"
+            labels = [block["text"] for block in content if block.get("type") == "text" and block["text"].startswith("PÁGINA")]
+            text = "\n".join(
+                f"{label} {'RELEVANTE - tabla salarial' if self._relevant(image) else 'NO RELEVANTE'}"
+                for label, image in zip(labels, images)
+            )
+        elif "Analiza brevemente" in prompt:
+            kind = "triaje"
+            text = "RELEVANTE: tabla salarial" if self._relevant(images[0]) else "NO RELEVANTE"
+        else:
+            kind = "extraccion"
+            text = "| Categoría | Salario base |\n|---|---|\n" + "\n".join(
+                f"| {c} | {1100 + 37 * i:,.2f} € |" for i, c in enumerate(_CATEGORIAS)
+            )
+
+        time.sleep(self.latency + self.image_latency * len(images))
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.bytes_sent += len(json.dumps(request, ensure_ascii=False).encode("utf-8"))
+
+        reply = json.dumps(tool_input) if tool_input is not None else text
+        usage = types.SimpleNamespace(
+            input_tokens=api_client.estimate_request_tokens(request),
+            output_tokens=int(len(reply) / 3.5),
+            cache_read_input_tokens=0,
+            cache_creation_input_tokens=0,
+        )
+        if tool_input is not None:
+            block = types.SimpleNamespace(type="tool_use", input=tool_input)
+        else:
+            block = types.SimpleNamespace(type="text", text=text)
+        return types.SimpleNamespace(content=[block], usage=usage)
+
+def make_fake_client(**options):
+    """Cliente falso envuelto como el cliente compartido (mismas métricas), sin límite de ritmo"""
+    fake = FakeMessages(**options)
+    client = api_client.SharedClient(types.SimpleNamespace(messages=fake), api_client.RateLimiter(1e9, 1e12, 1e12))
+    return client, fake
+
+# --- Ejecución ---
+
+def _peak_rss_mb():
+    """Pico de RSS del proceso hasta ahora (ru_maxrss es acumulado, no el de una etapa)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _run_stage(name, fake, func):
+    fake.reset()
+    peak_before = _peak_rss_mb()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        convenio_cache.CACHE_DIR = Path(cache_dir)
+        start = time.perf_counter()
+        with metrics.run(f"benchmark_{name}") as run:
+            result = func()
+        wall = time.perf_counter() - start
+    summary = run.summary()
+    return result, {
+        "wall_s": round(wall, 3),
+        "rss_growth_mb": round(_peak_rss_mb() - peak_before, 1),
+        "bytes_sent": fake.bytes_sent,
+        "api_calls": sum(fake.calls.values()),
+        "calls": dict(fake.calls),
+        "input_tokens": summary["tokens"]["input_tokens"],
+        "output_tokens": summary["tokens"]["output_tokens"],
+        "image_bytes": summary["counters"].get("bytes_imagen", 0),
+    }
+
+def run_scenario(mode, config):
+    """Ejecuta las cuatro etapas para un modo de documento; devuelve ({etapa: mediciones}, pico de RSS en MB)"""
+    metrics.METRICS_LOG = ""
+    metrics.PROMETHEUS_FILE = ""
+    client, fake = make_fake_client(
+        latency=config["latency"], image_latency=config["image_latency"],
+        relevant_ratio=config["relevant_ratio"], rows_per_page=config["rows_per_page"],
+    )
+    convenio_pdf = make_convenio_pdf(config["pages"], mode)
+    staff_pdf = make_staff_pdf(config["staff_pages"], mode, config["rows_per_page"])
+    workers = config["workers"]
+    results = {}
+
+    convenio_text, results["convenio"] = _run_stage(
+        "convenio", fake, lambda: pipeline.extract_convenio_from_file(client, convenio_pdf, "pdf", False, max_workers=workers)
+    )
+
+    def triage():
+        with pipeline.PdfPages(convenio_pdf) as pages:
+            return pipeline.identify_relevant_pages(client, pages, max_workers=workers, batch_size=pipeline.TRIAGE_BATCH_SIZE)
+    _, results["triaje"] = _run_stage("triaje", fake, triage)
+
+    resultado, results["analisis"] = _run_stage(
+        "analisis", fake, lambda: pipeline.analyze_with_claude(client, staff_pdf, "pdf", convenio_text, config["years"])
+    )
+    _, results["excel"] = _run_stage(
+        "excel", fake, lambda: pipeline.create_excel_from_result(resultado, config["years"])
+    )
+    return results, round(_peak_rss_mb(), 1)
+
+def run_all(config, modes=MODES):
+    """Cada escenario en un proceso nuevo para medir su pico de memoria por separado
+
+    Devuelve ({escenario: {etapa: mediciones}}, {escenario: pico de RSS en MB}).
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    peaks = {}
+    for mode in modes:
+        with ctx.Pool(1) as pool:
+            results[mode], peaks[mode] = pool.apply(run_scenario, (mode, config))
+    return results, peaks
+
+def format_results(results, peaks=None):
+    lines = [f"{'escenario':<10} {'etapa':<9} {'tiempo s':>9} {'+RSS MB':>8} {'KB enviados':>12} {'llamadas':>9} {'tokens ent.':>12} {'tokens sal.':>12}  tipos"]
+    for mode, stages in results.items():
+        for stage, r in stages.items():
+            calls = ", ".join(f"{k}={v}" for k, v in sorted(r["calls"].items()))
+            lines.append(
+                f"{mode:<10} {stage:<9} {r['wall_s']:>9.2f} {r['rss_growth_mb']:>8.1f} {r['bytes_sent'] / 1024:>12,.0f} "
+                f"{r['api_calls']:>9} {r['input_tokens']:>12,} {r['output_tokens']:>12,}  {calls}"
+            )
+    if peaks:
+        lines.append("")
+        lines.append("Pico de RSS por escenario: " + ", ".join(f"{mode} {peak:.1f} MB" for mode, peak in peaks.items()))
+    return "\n".join(lines)
+
+def compare(results, baseline, tolerance):
+    """Diferencias frente a la línea base; devuelve (líneas, hay_regresiones)"""
+    lines = []
+    regression = False
+    for mode, stages in results.items():
+        for stage, r in stages.items():
+            old = baseline.get(mode, {}).get(stage)
+            if not old:
+                continue
+            for metric in COMPARED:
+                before, after = old[metric], r[metric]
+                if not before:
+                    continue
+                change = (after - before) / before
+                worse = change > tolerance
+                regression = regression or worse
+                mark = "  ⚠️ REGRESIÓN" if worse else ""
+                lines.append(f"{mode:<10} {stage:<9} {metric:<11} {before:>12,} → {after:>12,} ({change:+.0%}){mark}")
+    return lines, regression
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline con documentos sintéticos y un cliente falso")
+    parser.add_argument("--pages", type=int, default=40, help="Páginas del convenio")
+    parser.add_argument("--staff-pages", type=int, default=3, help="Páginas de la tabla de personal")
+    parser.add_argument("--rows-per-page", type=int, default=30, help="Trabajadores por página de la tabla")
+    parser.add_argument("--mode", choices=MODES, action="append", help="Escenarios (por defecto, todos)")
+    parser.add_argument("--latency", type=float, default=0.2, help="Latencia base del cliente falso (s)")
+    parser.add_argument("--image-latency", type=float, default=0.05, help="Latencia adicional por imagen (s)")
+    parser.add_argument("--relevant-ratio", type=float, default=0.25, help="Proporción de páginas que el triaje marca como relevantes")
+    parser.add_argument("--workers", type=int, default=pipeline.CONVENIO_MAX_WORKERS, help="Páginas en paralelo")
+    parser.add_argument("--years", type=int, default=1)
+    parser.add_argument("--save-baseline", help="Guardar los resultados como línea base en este JSON")
+    parser.add_argument("--compare", help="Comparar con la línea base guardada en este JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Empeoramiento relativo admitido al comparar")
+    args = parser.parse_args(argv)
+
+    config = {
+        "pages": args.pages, "staff_pages": args.staff_pages, "rows_per_page": args.rows_per_page,
+        "latency": args.latency, "image_latency": args.image_latency, "relevant_ratio": args.relevant_ratio,
+        "workers": args.workers, "years": args.years,
+    }
+    results, peaks = run_all(config, args.mode or MODES)
+    print(format_results(results, peaks))
+
+    status = 0
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        if baseline.get("config") != config:
+            print("⚠️ La configuración de la línea base es distinta; la comparación puede no ser válida", file=sys.stderr)
+        lines, regression = compare(results, baseline["results"], args.tolerance)
+        print()
+        print("\n".join(lines))
+        status = 1 if regression else 0
+
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps({"config": config, "results": results, "peak_rss_mb": peaks}, indent=2), encoding="utf-8")
+        print(f"Línea base guardada en {args.save_baseline}")
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
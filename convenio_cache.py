@@ -0,0 +1,147 @@
+"""Caché en disco de los resultados de extracción de convenios.
+
+Cada convenio se identifica por el SHA-256 de sus bytes más una etiqueta de
+versión (prompt + modelo), de modo que el mismo archivo subido por cualquier
+usuario reutiliza el trabajo ya hecho. Dentro de cada entrada se guardan por
+separado la lista de páginas relevantes de la fase 1 y el texto extraído de
+cada página, para poder reaprovechar resultados parciales.
+
+También se guardan aquí los datos estructurados de cada análisis de tabla de
+personal (ver analysis_key), para no repetir la llamada a la IA cuando solo
+cambian parámetros de cálculo como los años.
+
+El tamaño total está limitado; al superarlo se eliminan los archivos usados
+hace más tiempo (LRU según la fecha de modificación, que se actualiza en cada
+lectura). El tamaño se lleva como un total acumulado que solo se recalcula
+recorriendo la carpeta al arrancar y al eliminar, no en cada escritura.
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import metrics
+
+CACHE_DIR = Path(os.getenv("CONVENIO_CACHE_DIR", Path(__file__).parent / ".cache" / "convenios"))
+CACHE_MAX_BYTES = int(float(os.getenv("CONVENIO_CACHE_MAX_MB", "200")) * 1024 * 1024)
+# Al superar el límite se elimina hasta esta fracción, para no recorrer la carpeta en cada escritura
+CACHE_EVICT_TARGET = 0.9
+
+_evict_lock = threading.Lock()
+# Bytes totales de la caché según las escrituras de este proceso (None: sin calcular)
+_total_bytes = None
+
+def cache_key(file_bytes, version):
+    """Clave de caché: SHA-256 del archivo más la etiqueta de versión"""
+    digest = hashlib.sha256(file_bytes).hexdigest()
+    safe_version = "".join(c if c.isalnum() or c in "-._" else "_" for c in version)
+    return f"{digest}_{safe_version}"
+
+def analysis_key(staff_bytes, convenio_text, version):
+    """Clave de un análisis: hash de la tabla de personal, hash del texto del convenio y versión"""
+    staff_digest = hashlib.sha256(staff_bytes).hexdigest()
+    convenio_digest = hashlib.sha256((convenio_text or "").encode("utf-8")).hexdigest()
+    return cache_key(f"{staff_digest}:{convenio_digest}".encode("utf-8"), f"analysis_{version}")
+
+def _entry_path(key, name):
+    return CACHE_DIR / key / name
+
+def get_text(key, name):
+    """Devuelve el texto guardado o None si no está en caché"""
+    path = _entry_path(key, name)
+    try:
+        text = path.read_text(encoding="utf-8")
+    except (FileNotFoundError, OSError):
+        metrics.count("cache_disco_fallos")
+        return None
+    metrics.count("cache_disco_aciertos")
+    try:
+        os.utime(path)  # marcar como usado recientemente
+    except OSError:
+        pass
+    return text
+
+def has(key, name):
+    """True si la entrada está en caché, sin leerla ni marcarla como usada"""
+    return _entry_path(key, name).is_file()
+
+def put_text(key, name, text):
+    """Guarda texto en la caché de forma atómica y aplica el límite de tamaño"""
+    path = _entry_path(key, name)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            old_size = path.stat().st_size
+        except OSError:
+            old_size = 0
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(text, encoding="utf-8")
+        size = tmp_path.stat().st_size
+        os.replace(tmp_path, path)
+    except OSError:
+        # La caché es una optimización: si el disco falla, se sigue sin ella
+        return
+    _add_bytes(size - old_size)
+
+def _scan():
+    """(fecha de modificación, tamaño, ruta) de cada archivo de la caché y su tamaño total"""
+    files = []
+    total = 0
+    for path in CACHE_DIR.glob("*/*"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    return files, total
+
+def _add_bytes(delta):
+    """Suma una escritura al total acumulado y elimina archivos si se supera el límite"""
+    global _total_bytes
+    with _evict_lock:
+        if _total_bytes is None:
+            _total_bytes = _scan()[1]
+        else:
+            _total_bytes += delta
+        over = _total_bytes > CACHE_MAX_BYTES
+    if over:
+        evict(int(CACHE_MAX_BYTES * CACHE_EVICT_TARGET))
+
+def get_json(key, name):
+    text = get_text(key, name)
+    if text is None:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+def put_json(key, name, value):
+    put_text(key, name, json.dumps(value, ensure_ascii=False))
+
+def evict(max_bytes=None):
+    """Elimina los archivos menos usados hasta quedar por debajo del límite"""
+    global _total_bytes
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with _evict_lock:
+        # Recorrido completo: corrige también lo que otros procesos hayan escrito o borrado
+        files, total = _scan()
+        _total_bytes = total
+        if total <= max_bytes:
+            return
+
+        for _, size, path in sorted(files):
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            _total_bytes = total
+            try:
+                path.parent.rmdir()  # solo se borra si la entrada quedó vacía
+            except OSError:
+                pass
+            if total <= max_bytes:
+                break
@@ -0,0 +1,124 @@
+"""Selección local del contexto del convenio que se envía a la IA.
+
+En lugar de cortar el texto a ciegas, se divide en fragmentos (páginas y
+artículos), se puntúa cada uno con BM25 frente a términos salariales más una
+señal de densidad de tablas/cifras, y se eligen los mejores fragmentos hasta
+llenar un presupuesto de tokens. Los fragmentos elegidos se devuelven en su
+orden original para que el texto siga siendo legible.
+"""
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+
+# Presupuesto de tokens para el texto del convenio dentro del prompt
+CONVENIO_CONTEXT_TOKENS = int(os.getenv("CONVENIO_CONTEXT_TOKENS", "10000"))
+# Caracteres por token aproximados para texto en español
+CHARS_PER_TOKEN = 3.5
+# Tamaño máximo de cada fragmento en caracteres
+MAX_CHUNK_CHARS = 3000
+
+QUERY_TERMS = [
+    "salario", "salarial", "salariales", "tabla", "tablas", "retribucion", "retribuciones",
+    "sueldo", "base", "plus", "pluses", "complemento", "complementos", "transporte",
+    "locomocion", "nocturnidad", "festivo", "festividad", "toxicidad", "penosidad",
+    "peligrosidad", "disponibilidad", "asistencia", "antiguedad", "trienio", "trienios",
+    "bienio", "quinquenio", "paga", "pagas", "extraordinaria", "extraordinarias",
+    "jornada", "horas", "anual", "mensual", "categoria", "categorias", "anexo", "euros",
+]
+
+# Peso de la señal de tablas/cifras frente a la puntuación BM25
+TABLE_WEIGHT = 4.0
+
+_SPLIT_RE = re.compile(r"(?=\n--- PÁGINA \d+ ---\n)|(?=\n\s*(?:ART[IÍ]CULO|Art[ií]culo)\s+\d+)|(?=\n\s*ANEXO\b)")
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_NUMBER_RE = re.compile(r"\d{1,3}(?:\.\d{3})*(?:,\d+)?|\d+(?:[.,]\d+)?")
+
+def estimate_tokens(text):
+    return int(len(text) / CHARS_PER_TOKEN)
+
+def _normalize(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+def split_chunks(text):
+    """Divide el convenio en fragmentos por página, artículo y anexo"""
+    chunks = []
+    for part in _SPLIT_RE.split(text):
+        if not part.strip():
+            continue
+        # Partir fragmentos demasiado largos por párrafos
+        while len(part) > MAX_CHUNK_CHARS:
+            cut = part.rfind("\n", 0, MAX_CHUNK_CHARS)
+            cut = cut if cut > MAX_CHUNK_CHARS // 2 else MAX_CHUNK_CHARS
+            chunks.append(part[:cut])
+            part = part[cut:]
+        chunks.append(part)
+    return chunks
+
+def table_density(chunk):
+    """Proporción de líneas que parecen filas de tabla (celdas markdown, cifras o importes)"""
+    lines = [line for line in chunk.splitlines() if line.strip()]
+    if not lines:
+        return 0.0
+    tabular = 0
+    for line in lines:
+        numbers = len(_NUMBER_RE.findall(line))
+        if line.count("|") >= 2 or "€" in line or numbers >= 2:
+            tabular += 1
+    return tabular / len(lines)
+
+def score_chunks(chunks, query_terms=QUERY_TERMS, k1=1.5, b=0.75):
+    """Puntuación BM25 de cada fragmento más la señal de densidad de tablas"""
+    docs = [Counter(_TOKEN_RE.findall(_normalize(chunk))) for chunk in chunks]
+    n = len(docs)
+    if not n:
+        return []
+    avg_len = sum(sum(d.values()) for d in docs) / n or 1
+    query = {_normalize(term) for term in query_terms}
+    doc_freq = {term: sum(1 for d in docs if term in d) for term in query}
+
+    scores = []
+    for chunk, doc in zip(chunks, docs):
+        length = sum(doc.values())
+        score = 0.0
+        for term in query:
+            tf = doc.get(term, 0)
+            if not tf:
+                continue
+            idf = math.log(1 + (n - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_len))
+        scores.append(score + TABLE_WEIGHT * table_density(chunk))
+    return scores
+
+def select_convenio_context(text, max_tokens=None):
+    """Devuelve el texto del convenio reducido a los fragmentos más relevantes
+
+    Si el texto completo cabe en el presupuesto, se devuelve sin cambios.
+    """
+    max_tokens = max_tokens or CONVENIO_CONTEXT_TOKENS
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text
+
+    chunks = split_chunks(text)
+    scores = score_chunks(chunks)
+    ranked = sorted(range(len(chunks)), key=lambda i: scores[i], reverse=True)
+
+    selected = set()
+    used = 0
+    for i in ranked:
+        cost = estimate_tokens(chunks[i])
+        if used + cost > max_tokens:
+            continue
+        selected.add(i)
+        used += cost
+
+    parts = []
+    previous = -1
+    for i in sorted(selected):
+        if i != previous + 1:
+            parts.append("\n[...]\n")
+        parts.append(chunks[i])
+        previous = i
+    return "".join(parts)
@@ -0,0 +1,211 @@
+"""Biblioteca precompilada de los convenios PDF de la carpeta de la aplicación.
+
+Cada PDF de la carpeta se extrae una sola vez (texto, páginas relevantes y
+tablas salariales) y se guarda en una base SQLite local. El índice se
+reconstruye de forma incremental: solo se vuelven a procesar los archivos
+cuya fecha de modificación/tamaño y hash hayan cambiado. Así, elegir un
+convenio en "Seleccionar archivo" no necesita ninguna llamada a la IA.
+
+Se puede usar desde la línea de comandos:
+
+    python convenio_library.py [--force]
+
+o como hilo en segundo plano dentro de la aplicación (start_background_indexer).
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+LIBRARY_DIR = Path(os.getenv("CONVENIO_LIBRARY_DIR", Path(__file__).parent))
+INDEX_PATH = Path(os.getenv("CONVENIO_LIBRARY_INDEX", Path(__file__).parent / ".cache" / "convenio_library.sqlite"))
+# Segundos entre revisiones de la carpeta del hilo en segundo plano
+RESCAN_SECONDS = int(os.getenv("CONVENIO_LIBRARY_RESCAN_SECONDS", "600"))
+
+_SALARY_WORDS = ("salario", "salarial", "sueldo", "retribuci", "plus", "€", "euros")
+
+_index_lock = threading.Lock()
+# Un cerrojo por archivo: el hilo en segundo plano y un análisis no extraen a la vez el mismo PDF
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+_background_thread = None
+
+def list_library_pdfs(directory=None):
+    """PDFs de la biblioteca (se excluyen los subidos temporalmente)"""
+    directory = Path(directory or LIBRARY_DIR)
+    return sorted(c for c in directory.glob("*.pdf") if "uploaded_" not in c.name)
+
+@contextmanager
+def _connect():
+    """Conexión a la base del índice; confirma los cambios y la cierra al salir"""
+    INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(INDEX_PATH, timeout=30)
+    try:
+        with conn:
+            _create_schema(conn)
+            yield conn
+    finally:
+        conn.close()
+
+def _create_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS convenios (
+            name TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            text TEXT NOT NULL,
+            relevant_pages TEXT,
+            salary_tables TEXT NOT NULL,
+            indexed_at REAL NOT NULL
+        )
+    """)
+
+def salary_tables(text):
+    """Tablas markdown del texto que parecen tablas salariales (lista de filas de celdas)"""
+    tables = []
+    current = []
+    for line in text.splitlines() + [""]:
+        if line.strip().startswith("|"):
+            current.append(line)
+            continue
+        if current:
+            joined = " ".join(current).lower()
+            if any(word in joined for word in _SALARY_WORDS):
+                rows = [
+                    [cell.strip() for cell in row.strip().strip("|").split("|")]
+                    for row in current if not re.fullmatch(r"[\s|:\-]+", row)
+                ]
+                tables.append(rows)
+            current = []
+    return tables
+
+def get_entry(path):
+    """Entrada del índice para path si está al día (mismo mtime y tamaño), o None"""
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT mtime, size, sha256, text, relevant_pages, salary_tables, indexed_at FROM convenios WHERE name = ?",
+            (path.name,),
+        ).fetchone()
+    if not row or row[0] != stat.st_mtime or row[1] != stat.st_size:
+        return None
+    return {
+        "name": path.name,
+        "sha256": row[2],
+        "text": row[3],
+        "relevant_pages": json.loads(row[4]) if row[4] else None,
+        "salary_tables": json.loads(row[5]),
+        "indexed_at": row[6],
+    }
+
+def index_file(path, extract_fn, relevant_pages_fn=None, force=False):
+    """Extrae e indexa un PDF si ha cambiado. Devuelve True si se ha (re)procesado.
+
+    extract_fn(pdf_bytes) devuelve el texto del convenio y
+    relevant_pages_fn(pdf_bytes) la lista de páginas relevantes de la fase 1
+    (o None si el documento no la necesitó). Si otro hilo está indexando
+    el mismo archivo, se espera a que termine y se usa su resultado.
+    """
+    path = Path(path)
+    with _file_locks_lock:
+        lock = _file_locks.setdefault(path.name, threading.Lock())
+    with lock:
+        return _index_file(path, extract_fn, relevant_pages_fn, force)
+
+def _index_file(path, extract_fn, relevant_pages_fn, force):
+    stat = path.stat()
+    if not force and get_entry(path):
+        return False
+
+    pdf_bytes = path.read_bytes()
+    digest = hashlib.sha256(pdf_bytes).hexdigest()
+
+    with _connect() as conn:
+        row = conn.execute("SELECT sha256 FROM convenios WHERE name = ?", (path.name,)).fetchone()
+        if row and row[0] == digest and not force:
+            # Solo ha cambiado la fecha: el contenido es el mismo
+            conn.execute(
+                "UPDATE convenios SET mtime = ?, size = ? WHERE name = ?",
+                (stat.st_mtime, stat.st_size, path.name),
+            )
+            return False
+
+    text = extract_fn(pdf_bytes)
+    relevant_pages = relevant_pages_fn(pdf_bytes) if relevant_pages_fn else None
+
+    with _connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO convenios VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                path.name, stat.st_mtime, stat.st_size, digest, text,
+                json.dumps(relevant_pages) if relevant_pages is not None else None,
+                json.dumps(salary_tables(text), ensure_ascii=False), time.time(),
+            ),
+        )
+    return True
+
+def index_library(extract_fn, relevant_pages_fn=None, force=False, log=print, directory=None):
+    """Indexa todos los PDFs de la biblioteca y elimina los que ya no existen"""
+    with _index_lock:
+        pdfs = list_library_pdfs(directory)
+        processed = 0
+        for path in pdfs:
+            try:
+                if index_file(path, extract_fn, relevant_pages_fn, force):
+                    processed += 1
+                    log(f"Indexado: {path.name}")
+            except Exception as e:
+                log(f"Error al indexar {path.name}: {e}")
+
+        with _connect() as conn:
+            names = [row[0] for row in conn.execute("SELECT name FROM convenios")]
+            for name in set(names) - {p.name for p in pdfs}:
+                conn.execute("DELETE FROM convenios WHERE name = ?", (name,))
+        return processed
+
+def start_background_indexer(extract_fn, relevant_pages_fn=None, log=None):
+    """Arranca (una sola vez por proceso) un hilo que mantiene el índice al día"""
+    global _background_thread
+    if _background_thread and _background_thread.is_alive():
+        return _background_thread
+
+    def run():
+        while True:
+            index_library(extract_fn, relevant_pages_fn, log=log or (lambda message: None))
+            time.sleep(RESCAN_SECONDS)
+
+    _background_thread = threading.Thread(target=run, name="convenio-library-indexer", daemon=True)
+    _background_thread.start()
+    return _background_thread
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompila los convenios PDF de la biblioteca")
+    parser.add_argument("--force", action="store_true", help="Reprocesar todos los archivos")
+    parser.add_argument("--dir", help="Carpeta de convenios (por defecto, la de la aplicación)")
+    args = parser.parse_args()
+
+    import api_client
+    import pipeline
+
+    client = api_client.get_client(os.getenv("ANTHROPIC_API_KEY"))
+    processed = index_library(
+        lambda pdf_bytes: pipeline.extract_convenio_from_file(client, pdf_bytes, "pdf", False),
+        pipeline.cached_relevant_pages,
+        force=args.force,
+        directory=args.dir,
+    )
+    print(f"{processed} convenio(s) procesado(s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+"""Cálculo local y determinista de costes de subrogación.
+
+La IA solo extrae datos (trabajadores y parámetros del convenio); toda la
+aritmética se hace aquí con NumPy, de forma vectorizada sobre todos los
+trabajadores a la vez, para que el resultado sea reproducible y no dependa
+del número de trabajadores que quepa en una respuesta.
+"""
+import unicodedata
+from datetime import date
+
+import numpy as np
+
+# Parámetros de cálculo que antes estaban fijos en el prompt
+DEFAULT_COST_SETTINGS = {
+    "horas_jornada_completa": 152,  # horas/mes de una jornada completa
+    "ss_rate": 0.32,                # Seguridad Social a cargo de la empresa
+    "suplencia_meses": 1,           # meses de suplencia por vacaciones
+    "absentismo_rate": 0.02,
+    "gastos_generales_rate": 0.08,
+    "materiales": 0.0,              # importe anual de materiales (no se estima)
+}
+
+# Rejilla por defecto del motor de escenarios (scenario_grid): valores de cada parámetro
+SCENARIO_GRID = {
+    "horas_jornada_completa": (152,),
+    "ss_rate": (0.30, 0.32, 0.34),
+    "absentismo_rate": (0.02, 0.04),
+    "gastos_generales_rate": (0.06, 0.08, 0.10),
+    "suplencia_meses": (1,),
+    "revision_salarial": (0.0, 0.02, 0.03),  # revisión anual de salarios a partir del año 2
+    "years": (1, 2, 3),
+}
+# Columnas de la tabla de escenarios: (clave, título, tipo de valor)
+SCENARIO_COLUMNS = [
+    ("horas_jornada_completa", "Horas/mes jornada completa", "numero"),
+    ("ss_rate", "SS empresa", "porcentaje"),
+    ("absentismo_rate", "Absentismo", "porcentaje"),
+    ("gastos_generales_rate", "Gastos generales", "porcentaje"),
+    ("suplencia_meses", "Suplencia (meses)", "numero"),
+    ("revision_salarial", "Revisión salarial anual", "porcentaje"),
+    ("years", "Años", "numero"),
+    ("coste_personal", "Coste personal año 1", "importe"),
+    ("total_anual", "Total año 1", "importe"),
+    ("total_periodo", "Total periodo", "importe"),
+]
+SCENARIO_MAX_ROWS = 20000
+
+# Fechas de antigüedad anteriores a este año se consideran erróneas
+MIN_SENIORITY_YEAR = 1940
+
+# Datos de un trabajador que se comparan entre dos versiones de la tabla de personal
+WORKER_DIFF_FIELDS = ("fecha_antiguedad", "tipo_contrato", "categoria", "categoria_convenio", "horas_mensuales", "pluses")
+
+def normalize_name(text):
+    """Normaliza un nombre (mayúsculas/minúsculas, acentos y espacios) para compararlo"""
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.lower().split())
+
+def parse_date(value, today=None):
+    """Convierte 'AAAA-MM-DD', 'DD/MM/AAAA' o 'DD/MM/AA' en date; None si no se puede.
+
+    Los años de dos cifras son del siglo actual salvo que queden en el
+    futuro (15/01/20 → 2020, 15/01/85 → 1985). Las fechas futuras o
+    anteriores a MIN_SENIORITY_YEAR se rechazan.
+    """
+    if not value:
+        return None
+    today = today or date.today()
+    value = str(value).strip()
+    for sep in ("-", "/", "."):
+        parts = [p.strip() for p in value.split(sep)]
+        if len(parts) != 3 or not all(p.isdigit() for p in parts):
+            continue
+        a, b, c = (int(p) for p in parts)
+        if a > 31:
+            year, month, day = a, b, c
+        else:
+            year, month, day = c, b, a
+            if len(parts[2]) <= 2:
+                year += 2000 if 2000 + year <= today.year else 1900
+        try:
+            parsed = date(year, month, day)
+        except ValueError:
+            return None
+        if parsed.year < MIN_SENIORITY_YEAR or parsed > today:
+            return None
+        return parsed
+    return None
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _is_transport(concepto):
+    name = normalize_name(concepto)
+    return "transporte" in name or "locomocion" in name
+
+def compute_costs(data, years, settings=None, fecha_referencia=None):
+    """Calcula los costes por trabajador y el resumen a partir de los datos extraídos.
+
+    data es el dict devuelto por la extracción estructurada (claves
+    "convenio" y "trabajadores"). Devuelve un dict con arrays por trabajador
+    y los totales del resumen.
+    """
+    settings = {**DEFAULT_COST_SETTINGS, **(settings or {})}
+    fecha_referencia = fecha_referencia or date.today()
+    convenio = data.get("convenio") or {}
+    workers = data.get("trabajadores") or []
+
+    salarios = {
+        normalize_name(c.get("categoria")): _number(c.get("salario_base_mensual"))
+        for c in convenio.get("categorias") or []
+    }
+    pluses = convenio.get("pluses") or []
+    plus_names = [normalize_name(p.get("concepto")) for p in pluses]
+    plus_amounts = np.array([_number(p.get("importe_mensual")) for p in pluses], dtype=float).reshape(-1)
+    plus_amounts = np.nan_to_num(plus_amounts)
+    plus_transport = np.array([_is_transport(p.get("concepto")) for p in pluses], dtype=bool).reshape(-1)
+
+    n = len(workers)
+    horas = np.array([_number(w.get("horas_mensuales")) for w in workers], dtype=float).reshape(n)
+    base_full = np.array(
+        [salarios.get(normalize_name(w.get("categoria_convenio") or w.get("categoria")), np.nan) for w in workers],
+        dtype=float,
+    ).reshape(n)
+
+    # Años completos de antigüedad a la fecha de referencia
+    seniority_years = np.zeros(n)
+    invalid_date = np.zeros(n, dtype=bool)
+    for i, w in enumerate(workers):
+        alta = parse_date(w.get("fecha_antiguedad"))
+        if alta:
+            seniority_years[i] = (fecha_referencia - alta).days / 365.25
+        elif w.get("fecha_antiguedad"):
+            invalid_date[i] = True
+
+    antig = convenio.get("antiguedad") or {}
+    periodo = _number(antig.get("periodo_anios"))
+    periodo = 3 if np.isnan(periodo) or periodo <= 0 else periodo
+    periods = np.floor(np.maximum(seniority_years, 0) / periodo)
+    max_periods = _number(antig.get("maximo_periodos"))
+    if not np.isnan(max_periods):
+        periods = np.minimum(periods, max_periods)
+
+    jornada = np.nan_to_num(horas) / settings["horas_jornada_completa"]
+
+    base = np.nan_to_num(base_full) * jornada
+    importe_periodo = _number(antig.get("importe_mensual"))
+    porcentaje_periodo = _number(antig.get("porcentaje"))
+    if not np.isnan(importe_periodo):
+        antiguedad = importe_periodo * periods * jornada
+    elif not np.isnan(porcentaje_periodo):
+        antiguedad = np.nan_to_num(base_full) * porcentaje_periodo / 100 * periods * jornada
+    else:
+        antiguedad = np.zeros(n)
+
+    # Matriz trabajadores × pluses con 1 donde el plus aplica al trabajador
+    applies = np.zeros((n, len(pluses)))
+    for i, w in enumerate(workers):
+        names = {normalize_name(p) for p in w.get("pluses") or []}
+        for j, plus_name in enumerate(plus_names):
+            if plus_name in names:
+                applies[i, j] = 1
+    transporte = applies[:, plus_transport] @ plus_amounts[plus_transport] * jornada
+    otros = applies[:, ~plus_transport] @ plus_amounts[~plus_transport] * jornada
+
+    total_mes = base + antiguedad + transporte + otros
+
+    numero_pagas = _number(convenio.get("numero_pagas"))
+    numero_pagas = 14 if np.isnan(numero_pagas) else numero_pagas
+    extras = max(numero_pagas - 12, 0)
+    extra_base = convenio.get("base_pagas_extra") or "total"
+    if extra_base == "salario_base":
+        importe_extra = base
+    elif extra_base == "salario_base_antiguedad":
+        importe_extra = base + antiguedad
+    else:
+        importe_extra = total_mes
+    bruto_anual = total_mes * min(numero_pagas, 12) + importe_extra * extras
+
+    ss_empresa = bruto_anual * settings["ss_rate"]
+    coste_empresa = bruto_anual + ss_empresa
+
+    coste_personal = float(coste_empresa.sum())
+    suplencia = coste_personal / 12 * settings["suplencia_meses"]
+    absentismo = (coste_personal + suplencia) * settings["absentismo_rate"]
+    subtotal = coste_personal + suplencia + absentismo
+    gastos_generales = subtotal * settings["gastos_generales_rate"]
+    materiales = float(settings["materiales"])
+    total = subtotal + gastos_generales + materiales
+
+    horas_mes_total = float(np.nansum(horas))
+
+    return {
+        "settings": settings,
+        "numero_pagas": numero_pagas,
+        "periods": periods,
+        "jornada": jornada,
+        "base": base,
+        "antiguedad": antiguedad,
+        "transporte": transporte,
+        "otros": otros,
+        "total_mes": total_mes,
+        "bruto_anual": bruto_anual,
+        "ss_empresa": ss_empresa,
+        "coste_empresa": coste_empresa,
+        "missing_salary": np.isnan(base_full),
+        "missing_hours": np.isnan(horas),
+        "invalid_date": invalid_date,
+        "summary": {
+            "coste_personal": coste_personal,
+            "suplencia": suplencia,
+            "absentismo": absentismo,
+            "subtotal": subtotal,
+            "gastos_generales": gastos_generales,
+            "materiales": materiales,
+            "total": total,
+        },
+        "hours": {
+            "trabajadores": n,
+            "horas_mes": horas_mes_total,
+            "horas_anio": horas_mes_total * 12,
+            "jornadas_completas": horas_mes_total / settings["horas_jornada_completa"],
+        },
+        "years": years,
+    }
+
+def scenario_grid(data, grid=None, fecha_referencia=None, materiales=0.0):
+    """Evalúa el coste de todas las combinaciones de parámetros de grid.
+
+    grid sustituye valores de SCENARIO_GRID ({parámetro: valores}). Los
+    datos por trabajador se calculan una sola vez con compute_costs: todos
+    los importes son proporcionales a horas / horas_jornada_completa, así
+    que basta el bruto anual por hora de jornada de referencia, y cada
+    escenario es una operación vectorizada sobre la rejilla completa.
+
+    Devuelve {clave de SCENARIO_COLUMNS: array}, una posición por escenario.
+    Con revision_salarial r, el año k cuesta (1 + r)^(k-1) veces el año 1.
+    """
+    grid = {**SCENARIO_GRID, **(grid or {})}
+    keys = list(SCENARIO_GRID)
+    sizes = [len(grid[key]) for key in keys]
+    if not all(sizes):
+        raise ValueError("Cada parámetro de la rejilla necesita al menos un valor")
+    if np.prod(sizes) > SCENARIO_MAX_ROWS:
+        raise ValueError(f"La rejilla tiene {int(np.prod(sizes)):,} escenarios (máximo {SCENARIO_MAX_ROWS:,})")
+
+    # Con jornada completa de 1 h, el bruto de cada trabajador es el bruto por hora de referencia
+    unit = compute_costs(data, 1, {"horas_jornada_completa": 1}, fecha_referencia)
+    bruto_por_hora = float(unit["bruto_anual"].sum())
+
+    axes = np.meshgrid(*(np.asarray(grid[key], dtype=float) for key in keys), indexing="ij")
+    result = {key: axis.ravel() for key, axis in zip(keys, axes)}
+
+    coste_personal = bruto_por_hora / result["horas_jornada_completa"] * (1 + result["ss_rate"])
+    personal = (
+        coste_personal
+        * (1 + result["suplencia_meses"] / 12)
+        * (1 + result["absentismo_rate"])
+        * (1 + result["gastos_generales_rate"])
+    )
+    revision = result["revision_salarial"]
+    years = result["years"]
+    # Suma de la serie geométrica 1 + (1 + r) + ... + (1 + r)^(años - 1)
+    safe_revision = np.where(revision == 0, 1, revision)
+    factor = np.where(revision == 0, years, np.expm1(years * np.log1p(revision)) / safe_revision)
+
+    result["coste_personal"] = coste_personal
+    result["total_anual"] = personal + materiales
+    result["total_periodo"] = personal * factor + materiales * years
+    return result
+
+def scenario_table(scenarios):
+    """Escenarios como (cabeceras, filas) de tuplas, para la hoja de Excel"""
+    headers = tuple(label for _, label, _ in SCENARIO_COLUMNS)
+    columns = [scenarios[key].tolist() for key, _, _ in SCENARIO_COLUMNS]
+    return headers, tuple(zip(*columns))
+
+def format_eur(value):
+    """Formato español: punto de miles y coma decimal (18.456,78 €)"""
+    return format_number(value) + " €"
+
+def format_number(value, decimals=2):
+    text = f"{value:,.{decimals}f}"
+    return text.replace(",", "_").replace(".", ",").replace("_", ".")
+
+def _cell(text):
+    return " ".join(str(text if text is not None else "").replace("|", "/").split())
+
+def render_cost_report(data, costs):
+    """Genera el informe en markdown con las mismas tablas que producía antes la IA"""
+    convenio = data.get("convenio") or {}
+    workers = data.get("trabajadores") or []
+    years = costs["years"]
+    settings = costs["settings"]
+    lines = []
+
+    lines.append("📋 **DATOS EXTRAÍDOS DEL CONVENIO** (cita textual):")
+    lines.append("")
+    lines.append("| Concepto | Valor encontrado | Cita textual del convenio |")
+    lines.append("|----------|------------------|---------------------------|")
+    lines.append(f"| Número de pagas | {format_number(costs['numero_pagas'], 0)} | \"{_cell(convenio.get('cita_pagas'))}\" |")
+    for categoria in convenio.get("categorias") or []:
+        salario = _number(categoria.get("salario_base_mensual"))
+        valor = "NO ENCONTRADO" if np.isnan(salario) else f"{format_eur(salario)}/mes"
+        lines.append(f"| Salario base {_cell(categoria.get('categoria'))} | {valor} | \"{_cell(categoria.get('cita'))}\" |")
+    for plus in convenio.get("pluses") or []:
+        importe = _number(plus.get("importe_mensual"))
+        valor = "NO ENCONTRADO" if np.isnan(importe) else f"{format_eur(importe)}/mes"
+        lines.append(f"| {_cell(plus.get('concepto'))} | {valor} | \"{_cell(plus.get('cita'))}\" |")
+    antig = convenio.get("antiguedad") or {}
+    if not np.isnan(_number(antig.get("importe_mensual"))):
+        valor = f"{format_eur(_number(antig.get('importe_mensual')))}/mes"
+    elif not np.isnan(_number(antig.get("porcentaje"))):
+        valor = f"{format_number(_number(antig.get('porcentaje')))} % del salario base"
+    else:
+        valor = "NO ENCONTRADO"
+    tipo = _cell(antig.get("tipo") or "trienio")
+    lines.append(f"| Antigüedad ({tipo}) | {valor} | \"{_cell(antig.get('cita'))}\" |")
+    lines.append("")
+
+    lines.append("**TABLA DE PERSONAL DETALLADA:**")
+    lines.append("")
+    lines.append("| Trabajador | Categoría | Trienios | % Jornada | Base | Antigüedad | Transporte | Otros Pluses | Total Mes | Bruto Anual | SS Empresa | Coste Empresa |")
+    lines.append("|---|---|---|---|---|---|---|---|---|---|---|---|")
+    for i, w in enumerate(workers):
+        base = "NO ENCONTRADO" if costs["missing_salary"][i] else format_eur(costs["base"][i])
+        lines.append(
+            f"| {_cell(w.get('trabajador'))} | {_cell(w.get('categoria'))} | {int(costs['periods'][i])} "
+            f"| {format_number(costs['jornada'][i] * 100)} % | {base} | {format_eur(costs['antiguedad'][i])} "
+            f"| {format_eur(costs['transporte'][i])} | {format_eur(costs['otros'][i])} "
+            f"| {format_eur(costs['total_mes'][i])} | {format_eur(costs['bruto_anual'][i])} "
+            f"| {format_eur(costs['ss_empresa'][i])} | {format_eur(costs['coste_empresa'][i])} |"
+        )
+    lines.append("")
+
+    summary = costs["summary"]
+    rows = [
+        ("Coste Personal (suma todos)", summary["coste_personal"]),
+        (f"Suplencia Vacaciones ({format_number(settings['suplencia_meses'], 0)} mes)", summary["suplencia"]),
+        (f"Absentismo ({format_number(settings['absentismo_rate'] * 100, 0)}%)", summary["absentismo"]),
+        ("**SUBTOTAL PERSONAL**", summary["subtotal"]),
+        (f"Gastos Generales ({format_number(settings['gastos_generales_rate'] * 100, 0)}%)", summary["gastos_generales"]),
+        ("Materiales Estimados", summary["materiales"]),
+        ("**TOTAL GENERAL**", summary["total"]),
+    ]
+    lines.append("**TABLA RESUMEN DE COSTES:**")
+    lines.append("")
+    lines.append(f"| Concepto | Año 1 | Total {years} Año(s) |")
+    lines.append("|----------|-------|----------------------|")
+    for concepto, value in rows:
+        lines.append(f"| {concepto} | {format_eur(value)} | {format_eur(value * years)} |")
+    lines.append("")
+
+    hours = costs["hours"]
+    lines.append("**RESUMEN DE HORAS:**")
+    lines.append("")
+    lines.append("| Concepto | Valor |")
+    lines.append("|----------|-------|")
+    lines.append(f"| Total trabajadores | {hours['trabajadores']} |")
+    lines.append(f"| Horas mensuales totales | {format_number(hours['horas_mes'])} horas |")
+    lines.append(f"| Horas anuales totales | {format_number(hours['horas_anio'])} horas |")
+    lines.append(f"| Equivalente jornadas completas | {format_number(hours['jornadas_completas'])} |")
+    lines.append("")
+
+    lines.append("**OBSERVACIONES**:")
+    missing_salary = [_cell(w.get("trabajador")) for i, w in enumerate(workers) if costs["missing_salary"][i]]
+    if missing_salary:
+        lines.append(f"- Salario base NO ENCONTRADO EN CONVENIO para: {', '.join(missing_salary)} (base calculada como 0 €)")
+    missing_hours = [_cell(w.get("trabajador")) for i, w in enumerate(workers) if costs["missing_hours"][i]]
+    if missing_hours:
+        lines.append(f"- Jornada no indicada para: {', '.join(missing_hours)} (calculado con 0 horas)")
+    invalid_date = [
+        f"{_cell(w.get('trabajador'))} ({_cell(w.get('fecha_antiguedad'))})"
+        for i, w in enumerate(workers) if costs["invalid_date"][i]
+    ]
+    if invalid_date:
+        lines.append(f"- Fecha de antigüedad no válida para: {', '.join(invalid_date)} (calculado sin antigüedad)")
+    if not summary["materiales"]:
+        lines.append("- Materiales no estimados (0 €)")
+    lines.append(
+        f"- Cálculo local: % jornada sobre {format_number(settings['horas_jornada_completa'], 0)} h/mes, "
+        f"SS empresa {format_number(settings['ss_rate'] * 100, 0)}%, periodo {years} año(s)"
+    )
+    if data.get("paginas"):
+        lines.append(f"- Páginas de la tabla de personal analizadas: {data['paginas']}")
+    observaciones = data.get("observaciones") or []
+    if isinstance(observaciones, str):
+        observaciones = [observaciones]
+    for obs in observaciones:
+        lines.append(f"- {_cell(obs)}")
+
+    return "\n".join(lines)
+
+def _diff_value(row, field):
+    value = row.get(field)
+    if field == "pluses":
+        return sorted(normalize_name(p) for p in value or [])
+    return normalize_name(value) if isinstance(value, str) else value
+
+def staff_diff(old_data, new_data):
+    """Trabajadores añadidos, eliminados y modificados entre dos análisis.
+
+    Los trabajadores se emparejan por nombre normalizado (y por orden si el
+    nombre se repite). Devuelve {"added": [...], "removed": [...],
+    "changed": [(fila_anterior, fila_nueva, [campos]), ...]}.
+    """
+    def by_name(data):
+        rows = {}
+        for row in data.get("trabajadores") or []:
+            name = normalize_name(row.get("trabajador"))
+            rows.setdefault(name, []).append(row)
+        return {(name, i): row for name, group in rows.items() for i, row in enumerate(group)}
+
+    old_rows, new_rows = by_name(old_data), by_name(new_data)
+    changed = []
+    for key in old_rows.keys() & new_rows.keys():
+        fields = [f for f in WORKER_DIFF_FIELDS if _diff_value(old_rows[key], f) != _diff_value(new_rows[key], f)]
+        if fields:
+            changed.append((old_rows[key], new_rows[key], fields))
+    return {
+        "added": [row for key, row in new_rows.items() if key not in old_rows],
+        "removed": [row for key, row in old_rows.items() if key not in new_rows],
+        "changed": changed,
+    }
+
+def format_staff_diff(diff, old_total=None, new_total=None):
+    """Resumen markdown de staff_diff, con la variación del total si se indica"""
+    def show(row, field):
+        value = row.get(field)
+        if field == "pluses":
+            return ", ".join(value or []) or "—"
+        return "—" if value is None else str(value)
+
+    lines = [
+        f"**{len(diff['added'])}** añadidos · **{len(diff['removed'])}** eliminados · "
+        f"**{len(diff['changed'])}** modificados"
+    ]
+    if old_total is not None and new_total is not None:
+        lines.append(
+            f"Total general: {format_eur(old_total)} → {format_eur(new_total)} ({format_eur(new_total - old_total)})"
+        )
+    rows = [("➕ Añadido", row.get("trabajador"), "") for row in diff["added"]]
+    rows += [("➖ Eliminado", row.get("trabajador"), "") for row in diff["removed"]]
+    rows += [
+        ("✏️ Modificado", new.get("trabajador"), "; ".join(f"{f}: {show(old, f)} → {show(new, f)}" for f in fields))
+        for old, new, fields in diff["changed"]
+    ]
+    if rows:
+        lines += ["", "| Cambio | Trabajador | Detalle |", "|---|---|---|"]
+        lines += [f"| {change} | {_cell(name)} | {_cell(detail)} |" for change, name, detail in rows]
+    return "\n".join(lines)
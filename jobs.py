@@ -0,0 +1,168 @@
+"""Ejecución de análisis en segundo plano, fuera del hilo de la sesión de Streamlit.
+
+Cada análisis se envía como un trabajo con un identificador a un pool de
+hilos compartido por todo el proceso, con un límite global de trabajos
+simultáneos (JOB_MAX_CONCURRENT); el resto espera en cola. El trabajo
+informa de su etapa y progreso en un almacén compartido, así que la interfaz
+puede consultarlo periódicamente y volver a engancharse a él por su
+identificador aunque se recargue la página o se corte la conexión. Los
+resultados se conservan JOB_RETENTION_HOURS horas.
+
+El objeto Job tiene los mismos métodos que los placeholders de Streamlit que
+usa el pipeline (info, success, warning, progress, markdown, empty), de modo
+que se le puede pasar directamente como progress_placeholder.
+"""
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+JOB_MAX_CONCURRENT = int(os.getenv("JOB_MAX_CONCURRENT", "4"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_HOURS", "24")) * 3600
+
+PENDING = "pendiente"
+RUNNING = "en curso"
+DONE = "completado"
+FAILED = "error"
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_executor = None
+
+class Job:
+    """Estado de un trabajo; se actualiza desde el hilo de trabajo y se lee desde la UI"""
+
+    def __init__(self, job_id, owner=None, description=""):
+        self.id = job_id
+        self.owner = owner
+        self.description = description
+        self.status = PENDING
+        self.stage = ""
+        self.message = ("info", "⏳ En cola...")
+        self.progress_value = None
+        self.partial = None
+        self.notes = []
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.metrics = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def set_stage(self, stage, progress=None):
+        with self._lock:
+            self.stage = stage
+            self.progress_value = progress
+            self.partial = None
+
+    def note(self, level, text):
+        """Mensaje que se conserva y se muestra con el resultado"""
+        with self._lock:
+            self.notes.append((level, text))
+
+    def snapshot(self):
+        """Copia coherente del estado para mostrarla en la UI"""
+        with self._lock:
+            return {
+                "id": self.id,
+                "description": self.description,
+                "status": self.status,
+                "stage": self.stage,
+                "message": self.message,
+                "progress": self.progress_value,
+                "partial": self.partial,
+                "notes": list(self.notes),
+                "error": self.error,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+                "metrics": self.metrics.summary() if self.metrics else None,
+            }
+
+    # Interfaz de placeholder de Streamlit
+    def _set_message(self, level, text):
+        with self._lock:
+            self.message = (level, text)
+
+    def info(self, text):
+        self._set_message("info", text)
+
+    def success(self, text):
+        self._set_message("success", text)
+
+    def warning(self, text):
+        self._set_message("warning", text)
+
+    def progress(self, value, text=None):
+        with self._lock:
+            self.progress_value = value
+            if text:
+                self.message = ("info", text)
+
+    def markdown(self, text):
+        with self._lock:
+            self.partial = text
+
+    def empty(self):
+        with self._lock:
+            self.partial = None
+
+def _get_executor():
+    global _executor
+    with _jobs_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_MAX_CONCURRENT, thread_name_prefix="analysis-job")
+        return _executor
+
+def _run(job, func, args, kwargs):
+    job.status = RUNNING
+    job.info("🔄 Iniciando...")
+    try:
+        with metrics.run("analisis", job_id=job.id, archivo=job.description) as run:
+            job.metrics = run
+            result = func(job, *args, **kwargs)
+        with job._lock:
+            job.result = result
+            job.finished_at = time.time()
+            job.status = DONE
+    except Exception as e:
+        with job._lock:
+            job.error = str(e) or e.__class__.__name__
+            job.traceback = traceback.format_exc()
+            job.finished_at = time.time()
+            job.status = FAILED
+
+def _cleanup():
+    """Olvida los trabajos terminados hace más de JOB_RETENTION_SECONDS"""
+    limit = time.time() - JOB_RETENTION_SECONDS
+    with _jobs_lock:
+        for job_id in [j.id for j in _jobs.values() if j.finished and j.finished_at < limit]:
+            del _jobs[job_id]
+
+def submit(func, *args, owner=None, description="", **kwargs):
+    """Encola func(job, *args, **kwargs) y devuelve el identificador del trabajo"""
+    _cleanup()
+    job = Job(uuid.uuid4().hex[:12], owner, description)
+    with _jobs_lock:
+        _jobs[job.id] = job
+    _get_executor().submit(_run, job, func, args, kwargs)
+    return job.id
+
+def get(job_id):
+    """Trabajo con ese identificador, o None si no existe o ya se ha olvidado"""
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+def jobs_for(owner, limit=10):
+    """Trabajos de un usuario, del más reciente al más antiguo"""
+    with _jobs_lock:
+        owned = [job for job in _jobs.values() if job.owner == owner]
+    return sorted(owned, key=lambda job: job.created_at, reverse=True)[:limit]
@@ -0,0 +1,214 @@
+"""Instrumentación ligera del pipeline: tiempos, tokens, bytes y aciertos de caché.
+
+Las funciones del pipeline se miden con spans (span() o el decorador timed())
+y las respuestas de la API con record_response(). Todo se acumula en la
+ejecución en curso (run(), guardada en un contextvar y propagada a los hilos
+de run_pages_concurrently) y en los totales del proceso.
+
+Al terminar cada ejecución se escribe una línea JSON en METRICS_LOG (también
+una por llamada a la API). Si se define PIPELINE_PROMETHEUS_FILE, los
+totales del proceso se vuelcan en ese archivo en formato de texto de
+Prometheus (para el textfile collector de node_exporter).
+"""
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+METRICS_LOG = os.getenv("PIPELINE_METRICS_LOG", str(Path(__file__).parent / ".cache" / "metrics.jsonl"))
+PROMETHEUS_FILE = os.getenv("PIPELINE_PROMETHEUS_FILE", "")
+
+TOKEN_FIELDS = ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+
+_current_run = contextvars.ContextVar("pipeline_run", default=None)
+_totals_lock = threading.Lock()
+_log_lock = threading.Lock()
+
+class Metrics:
+    """Acumulador de spans (número y segundos), contadores y tokens"""
+
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        self.tokens = dict.fromkeys(TOKEN_FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            count, total = self.spans.get(name, (0, 0.0))
+            self.spans[name] = (count + 1, total + seconds)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_tokens(self, usage):
+        with self._lock:
+            for field in TOKEN_FIELDS:
+                self.tokens[field] += getattr(usage, field, None) or 0
+
+    def summary(self):
+        with self._lock:
+            tokens = dict(self.tokens)
+            prompt_tokens = tokens["input_tokens"] + tokens["cache_read_input_tokens"] + tokens["cache_creation_input_tokens"]
+            return {
+                "spans": {name: {"count": c, "seconds": round(s, 3)} for name, (c, s) in self.spans.items()},
+                "counters": dict(self.counters),
+                "tokens": tokens,
+                "prompt_cache_hit_rate": round(tokens["cache_read_input_tokens"] / prompt_tokens, 3) if prompt_tokens else None,
+            }
+
+class Run(Metrics):
+    def __init__(self, name, **labels):
+        super().__init__()
+        self.name = name
+        self.labels = labels
+        self.started_at = time.time()
+        self.seconds = None
+        self.status = None
+
+_totals = Metrics()
+
+def current_run():
+    return _current_run.get()
+
+def _targets():
+    run = _current_run.get()
+    return (_totals, run) if run is not None else (_totals,)
+
+@contextmanager
+def span(name):
+    """Mide el bloque y lo suma al span name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for target in _targets():
+            target.add_span(name, seconds)
+
+def timed(name):
+    """Decorador: mide cada llamada a la función como span name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, amount=1):
+    for target in _targets():
+        target.count(name, amount)
+
+def record_response(response, seconds=None, model=None):
+    """Suma los tokens de una respuesta de la API y la anota en el log"""
+    usage = getattr(response, "usage", None)
+    count("api_requests")
+    if usage is None:
+        return
+    for target in _targets():
+        target.add_tokens(usage)
+    run = _current_run.get()
+    event = {"event": "api_call", "model": model, "seconds": round(seconds, 3) if seconds is not None else None}
+    event.update({field: getattr(usage, field, None) or 0 for field in TOKEN_FIELDS})
+    if run is not None:
+        event["run"] = run.name
+        event.update(run.labels)
+    _log(event)
+
+@contextmanager
+def run(name, **labels):
+    """Ejecución medida; al salir se anota en el log y se actualizan los totales"""
+    current = Run(name, **labels)
+    token = _current_run.set(current)
+    start = time.perf_counter()
+    current.status = "ok"
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        _current_run.reset(token)
+        current.seconds = time.perf_counter() - start
+        _totals.count(f"runs_{current.status}")
+        _totals.add_span(f"run_{name}", current.seconds)
+        event = {"event": "run", "run": name, "status": current.status, "seconds": round(current.seconds, 3)}
+        event.update(labels)
+        event.update(current.summary())
+        _log(event)
+        write_prometheus()
+
+def propagate(func):
+    """Envuelve func para que se ejecute (en otro hilo) dentro de la ejecución actual"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+def _log(event):
+    if not METRICS_LOG:
+        return
+    event = {"ts": round(time.time(), 3), **event}
+    try:
+        Path(METRICS_LOG).parent.mkdir(parents=True, exist_ok=True)
+        with _log_lock, open(METRICS_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+    except OSError:
+        pass  # las métricas nunca deben interrumpir un análisis
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def prometheus_text():
+    """Totales del proceso en formato de texto de Prometheus"""
+    summary = _totals.summary()
+    lines = [
+        "# HELP pipeline_span_seconds_total Segundos acumulados por span del pipeline",
+        "# TYPE pipeline_span_seconds_total counter",
+    ]
+    lines += [f'pipeline_span_seconds_total{{span="{_label(n)}"}} {s["seconds"]}' for n, s in sorted(summary["spans"].items())]
+    lines += ["# HELP pipeline_span_calls_total Llamadas por span del pipeline", "# TYPE pipeline_span_calls_total counter"]
+    lines += [f'pipeline_span_calls_total{{span="{_label(n)}"}} {s["count"]}' for n, s in sorted(summary["spans"].items())]
+    lines += ["# HELP pipeline_tokens_total Tokens de la API por tipo", "# TYPE pipeline_tokens_total counter"]
+    lines += [f'pipeline_tokens_total{{type="{t}"}} {v}' for t, v in summary["tokens"].items()]
+    lines += ["# HELP pipeline_events_total Contadores del pipeline", "# TYPE pipeline_events_total counter"]
+    lines += [f'pipeline_events_total{{name="{_label(n)}"}} {v}' for n, v in sorted(summary["counters"].items())]
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path=None):
+    """Vuelca los totales en el archivo de Prometheus (escritura atómica), si está configurado"""
+    path = path or PROMETHEUS_FILE
+    if not path:
+        return
+    path = Path(path)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with _totals_lock:
+            tmp_path.write_text(prometheus_text(), encoding="utf-8")
+            os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def format_breakdown(summary):
+    """Tabla markdown con el desglose de una ejecución, para la barra lateral"""
+    lines = ["| Etapa | Llamadas | Segundos |", "|---|---|---|"]
+    for name, s in sorted(summary["spans"].items(), key=lambda item: -item[1]["seconds"]):
+        lines.append(f"| {name} | {s['count']} | {s['seconds']:.2f} |")
+    tokens = summary["tokens"]
+    lines.append("")
+    lines.append(
+        f"Tokens: {tokens['input_tokens']:,} entrada, {tokens['output_tokens']:,} salida, "
+        f"{tokens['cache_read_input_tokens']:,} leídos de caché, {tokens['cache_creation_input_tokens']:,} escritos en caché"
+    )
+    if summary["prompt_cache_hit_rate"] is not None:
+        lines.append(f"Acierto de caché de prompts: {summary['prompt_cache_hit_rate']:.0%}")
+    counters = summary["counters"]
+    if counters:
+        lines.append("")
+        lines.append(" · ".join(f"{name}: {value:,}" for name, value in sorted(counters.items())))
+    return "\n".join(lines)
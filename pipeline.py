@@ -0,0 +1,1891 @@
+"""Pipeline de extracción y cálculo, sin dependencias de la interfaz de Streamlit.
+
+Lo usan tanto la aplicación (app.py) como los procesos sin interfaz
+(batch.py, convenio_library.py).
+"""
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from dotenv import load_dotenv
+import fitz  # PyMuPDF para leer PDFs
+import numpy as np
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, Border, NamedStyle, Side, PatternFill
+from openpyxl.utils import get_column_letter
+from api_client import with_retries
+import convenio_cache
+import convenio_library
+import metrics
+from cost_engine import (
+    SCENARIO_COLUMNS, compute_costs, format_staff_diff, normalize_name, render_cost_report, staff_diff,
+)
+from convenio_context import CONVENIO_CONTEXT_TOKENS, select_convenio_context
+
+# Cargar variables de entorno (local)
+load_dotenv()
+
+# Número de llamadas simultáneas a la API al procesar páginas del convenio
+CONVENIO_MAX_WORKERS = int(os.getenv("CONVENIO_MAX_WORKERS", "8"))
+
+# Páginas que se clasifican en una sola petición durante la fase 1 (1 = una por petición)
+TRIAGE_BATCH_SIZE = int(os.getenv("TRIAGE_BATCH_SIZE", "8"))
+# Hasta este número de páginas escaneadas se extraen todas sin fase 1
+SCANNED_PAGES_DIRECT_MAX = 20
+# Páginas que se extraen si la fase 1 no encuentra ninguna relevante
+SCANNED_PAGES_FALLBACK = 30
+
+# Perfiles de renderizado de páginas para cada etapa. max_px limita el lado mayor
+# de la imagen; además nunca se supera el tamaño máximo que usa el modelo
+# (MODEL_IMAGE_MAX_PX / MODEL_IMAGE_MAX_PIXELS), para no enviar imágenes que el
+# servidor va a reducir igualmente. format: "jpeg" o "png".
+RENDER_PROFILES = {
+    "triage": {"max_px": 800, "grayscale": True, "format": "jpeg", "quality": 60},
+    "extraction": {"max_px": 1568, "grayscale": False, "format": "jpeg", "quality": 85},
+    "analysis": {"max_px": 1568, "grayscale": False, "format": "jpeg", "quality": 85},
+}
+MODEL_IMAGE_MAX_PX = 1568
+MODEL_IMAGE_MAX_PIXELS = 1_150_000
+# Zoom con el que se renderizaban antes todas las páginas (PNG sin pérdida), para el informe de ahorro
+BASELINE_ZOOM = 2
+
+# Etiqueta de versión de la caché de convenios: cambiarla al modificar prompts o modelo
+CONVENIO_CACHE_VERSION = "claude-sonnet-4-20250514_extract-v3"
+
+# Días que se reutiliza el resultado de "Buscar con IA" para el mismo convenio
+CONVENIO_SEARCH_TTL_DAYS = float(os.getenv("CONVENIO_SEARCH_TTL_DAYS", "7"))
+SEARCH_CACHE_VERSION = "claude-sonnet-4-20250514_search-v1"
+
+# Búsquedas web en curso, compartidas entre sesiones (clave -> Future)
+_search_lock = threading.Lock()
+_search_inflight = {}
+
+# Protege los dicts de uso de tokens compartidos entre hilos
+_usage_lock = threading.Lock()
+
+# Segundos mínimos entre actualizaciones de la UI al recibir respuestas por streaming
+STREAM_CALLBACK_INTERVAL = 0.25
+
+# Versión del prompt/herramienta de extracción de la tabla de personal (clave del almacén de análisis)
+ANALYSIS_PROMPT_VERSION = "claude-sonnet-4-20250514_staff-v6"
+
+# Páginas de la tabla de personal por petición; los documentos más largos se procesan por grupos
+STAFF_PAGES_PER_REQUEST = int(os.getenv("STAFF_PAGES_PER_REQUEST", "10"))
+
+# Lado mayor (px) de la miniatura con la que se calcula la huella de cada página
+FINGERPRINT_PX = 256
+
+# Pre-filtro de páginas escaneadas antes de la visión (ver skip_scanned_pages),
+# sobre una miniatura en gris de SKIP_THUMBNAIL_PX px de lado mayor. Una página
+# está en blanco si no tiene ni una línea de tinta: menos de
+# SKIP_BLANK_MIN_INK_ROWS filas con SKIP_BLANK_ROW_INK_PX píxeles
+# SKIP_INK_CONTRAST niveles más oscuros que el fondo (las motas del escáner
+# no llegan). Una página con una sola línea, aunque sea casi blanca, no se
+# descarta: la fase 1 decide si es relevante. Dos páginas son duplicadas si
+# su dHash difiere en pocos bits y ningún bloque de SKIP_BLOCK_PX px difiere
+# más de SKIP_DUPLICATE_MAX_DIFF niveles de media: el criterio es estricto
+# para que un solo número distinto las separe.
+SKIP_THUMBNAIL_PX = 600
+SKIP_INK_CONTRAST = 60
+SKIP_BLANK_ROW_INK_PX = 3
+SKIP_BLANK_MIN_INK_ROWS = 2
+SKIP_DUPLICATE_MAX_BITS = 4
+SKIP_BLOCK_PX = 8
+SKIP_DUPLICATE_MAX_DIFF = 2.0
+
+# Columnas de la tabla de personal reconocidas en la extracción local (palabras clave normalizadas)
+STAFF_COLUMNS = {
+    "trabajador": ("nombre", "trabajador", "apellido", "empleado", "iniciales"),
+    "fecha_antiguedad": ("antig", "fecha alta", "fecha de alta", "f. alta", "alta"),
+    "tipo_contrato": ("contrato", "modalidad"),
+    "categoria": ("categ", "puesto", "grupo profesional"),
+    "horas_mensuales": ("jornada", "horas", "h/mes", "h/sem"),
+}
+# Mínimo de columnas reconocidas y proporción de filas completas para usar la tabla local
+STAFF_MIN_COLUMNS = 3
+STAFF_MIN_FILLED_ROWS = 0.8
+
+# Umbrales para decidir si una página tiene una capa de texto utilizable
+PAGE_MIN_TEXT_CHARS = 100
+PAGE_MIN_WORD_DENSITY = 0.5  # palabras por cada 10.000 pt² de página
+
+def cached_relevant_pages(pdf_bytes):
+    """Páginas relevantes de la fase 1 guardadas en la caché para este PDF (o None)"""
+    key = convenio_cache.cache_key(pdf_bytes, CONVENIO_CACHE_VERSION)
+    return convenio_cache.get_json(key, "relevant_pages.json")
+
+def convenio_page_key(pdf_bytes, max_px=None):
+    """Clave de caché de los textos por página de un convenio, según la resolución de las imágenes"""
+    version = CONVENIO_CACHE_VERSION
+    if render_profiles(max_px) is not RENDER_PROFILES:
+        version += f"_px{max_px}"
+    return convenio_cache.cache_key(pdf_bytes, version)
+
+class PdfPages:
+    """PDF abierto una sola vez con acceso perezoso a cada página.
+
+    Las páginas se renderizan bajo demanda, con el perfil de RENDER_PROFILES
+    de cada etapa, y no se guardan, así que la memoria no crece con el número
+    de páginas. El documento de PyMuPDF no es seguro entre hilos, por eso todo
+    acceso pasa por un lock; las llamadas a la API que usan las imágenes sí
+    pueden ir en paralelo.
+
+    image_stats acumula, por perfil, las imágenes, bytes y tokens estimados
+    enviados, junto con la estimación de lo que habría costado el PNG 2x.
+    """
+
+    def __init__(self, pdf_bytes, profiles=None):
+        self.document = fitz.open(stream=pdf_bytes, filetype="pdf")
+        self.profiles = profiles or RENDER_PROFILES
+        self.image_stats = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.document)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def render(self, page_num, profile="extraction"):
+        """Renderiza la página con el perfil indicado y libera el pixmap inmediatamente.
+
+        Devuelve (bytes_imagen, tipo) con tipo "jpeg" o "png".
+        """
+        settings = self.profiles[profile]
+        with self._lock, metrics.span("render_pagina"):
+            page = self.document.load_page(page_num)
+            zoom = fit_zoom(page.rect.width, page.rect.height, settings["max_px"])
+            colorspace = fitz.csGRAY if settings.get("grayscale") else fitz.csRGB
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+            width, height = pix.width, pix.height
+            if settings["format"] == "jpeg":
+                img_bytes = pix.tobytes("jpeg", jpg_quality=settings.get("quality", 85))
+            else:
+                img_bytes = pix.tobytes("png")
+            pix = None
+
+            stats = self.image_stats.setdefault(profile, {
+                "images": 0, "bytes": 0, "tokens": 0, "baseline_tokens": 0, "baseline_bytes": 0,
+            })
+            if "baseline_ratio" not in stats:
+                # Se mide el PNG 2x solo en la primera página de cada perfil y se extrapola
+                base_pix = page.get_pixmap(matrix=fitz.Matrix(BASELINE_ZOOM, BASELINE_ZOOM))
+                stats["baseline_ratio"] = len(base_pix.tobytes("png")) / max(len(img_bytes), 1)
+                base_pix = None
+            base_w = page.rect.width * BASELINE_ZOOM
+            base_h = page.rect.height * BASELINE_ZOOM
+            page = None
+
+            stats["images"] += 1
+            stats["bytes"] += len(img_bytes)
+            stats["tokens"] += estimate_image_tokens(width, height)
+            stats["baseline_tokens"] += estimate_image_tokens(base_w, base_h)
+            stats["baseline_bytes"] += int(len(img_bytes) * stats["baseline_ratio"])
+
+        metrics.count("bytes_imagen", len(img_bytes))
+        return img_bytes, settings["format"]
+
+    def render_base64(self, page_num, profile="extraction"):
+        """Como render(), pero devuelve (imagen_base64, media_type) listo para la API"""
+        img_bytes, image_type = self.render(page_num, profile)
+        return base64.standard_b64encode(img_bytes).decode("utf-8"), f"image/{image_type}"
+
+    def fingerprint(self, page_num):
+        """Huella de la página: hash del texto y hash de una miniatura renderizada en gris.
+
+        Dos páginas con la misma huella se consideran iguales y reutilizan la
+        extracción guardada (ver extract_staff_data).
+        """
+        with self._lock:
+            page = self.document.load_page(page_num)
+            text_hash = hashlib.sha256(page.get_text().encode("utf-8")).hexdigest()[:16]
+            zoom = FINGERPRINT_PX / max(page.rect.width, page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+            image_hash = hashlib.sha256(pix.samples).hexdigest()[:16]
+            pix = None
+            page = None
+        return f"{text_hash}-{image_hash}"
+
+    def thumbnail(self, page_num, max_px=SKIP_THUMBNAIL_PX):
+        """Miniatura en gris de la página como array de NumPy (alto × ancho, uint8)"""
+        with self._lock:
+            page = self.document.load_page(page_num)
+            zoom = max_px / max(page.rect.width, page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+            image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width].copy()
+            pix = None
+            page = None
+        return image
+
+    def text(self, page_num):
+        with self._lock:
+            return self.document.load_page(page_num).get_text()
+
+    def page_info(self, page_num):
+        """Datos baratos de la página para planificar (sin detectar tablas ni renderizar)"""
+        with self._lock:
+            page = self.document.load_page(page_num)
+            stripped = page.get_text().strip()
+            info = {
+                "width": page.rect.width,
+                "height": page.rect.height,
+                "text_chars": len(stripped),
+                "has_text_layer": _has_text_layer(page, stripped),
+                "has_images": bool(page.get_images()),
+            }
+            page = None
+        return info
+
+    def local_page(self, page_num):
+        """Analiza la página sin llamar a la API.
+
+        Devuelve un dict con:
+        - "text": texto local de la página (con las tablas detectadas en markdown)
+        - "needs_vision": True si la página es una imagen sin texto utilizable
+        - "tables": número de tablas detectadas
+        """
+        with self._lock:
+            page = self.document.load_page(page_num)
+            text = page.get_text()
+            stripped = text.strip()
+            has_text_layer = _has_text_layer(page, stripped)
+
+            tables = []
+            if stripped:
+                try:
+                    tables = [t for t in page.find_tables().tables if t.row_count > 1]
+                except Exception:
+                    tables = []
+
+            if tables:
+                # Texto fuera de las tablas + cada tabla como markdown
+                table_rects = [fitz.Rect(t.bbox) for t in tables]
+                blocks = [
+                    b[4] for b in page.get_text("blocks")
+                    if not any(fitz.Rect(b[:4]).intersects(r) for r in table_rects)
+                ]
+                text = "\n".join(blocks) + "\n\n" + "\n\n".join(table_to_markdown(t.extract()) for t in tables)
+
+            needs_vision = not has_text_layer and not tables and bool(page.get_images())
+            page = None
+
+        return {"text": text, "needs_vision": needs_vision, "tables": len(tables)}
+
+    def table_rows(self, page_num):
+        """Filas de las tablas de texto de la página (find_tables), sin llamar a la API"""
+        with self._lock:
+            page = self.document.load_page(page_num)
+            if not page.get_text().strip():
+                return []
+            try:
+                tables = [t.extract() for t in page.find_tables().tables if t.row_count > 1]
+            except Exception:
+                tables = []
+            page = None
+        return tables
+
+    def close(self):
+        with self._lock:
+            if not self.document.is_closed:
+                self.document.close()
+        fitz.TOOLS.store_shrink(100)
+
+def _has_text_layer(page, stripped_text):
+    """True si la página tiene texto suficiente, denso y legible para no necesitar visión"""
+    words = page.get_text("words")
+    area = max(page.rect.width * page.rect.height, 1)
+    density = len(words) / area * 10000
+    alnum_ratio = sum(c.isalnum() for c in stripped_text) / len(stripped_text) if stripped_text else 0
+    return (
+        len(stripped_text) >= PAGE_MIN_TEXT_CHARS
+        and density >= PAGE_MIN_WORD_DENSITY
+        and alnum_ratio >= 0.5
+    )
+
+def render_profiles(max_px=None):
+    """RENDER_PROFILES con otra resolución máxima para extracción y análisis (ver planner)"""
+    if not max_px or max_px == RENDER_PROFILES["extraction"]["max_px"]:
+        return RENDER_PROFILES
+    profiles = {name: dict(settings) for name, settings in RENDER_PROFILES.items()}
+    for name in ("extraction", "analysis"):
+        profiles[name]["max_px"] = max_px
+    return profiles
+
+def fit_zoom(width_pt, height_pt, max_px):
+    """Zoom para que la página no supere max_px ni el tamaño máximo de imagen del modelo"""
+    max_side = min(max_px, MODEL_IMAGE_MAX_PX)
+    zoom = max_side / max(width_pt, height_pt)
+    area_zoom = (MODEL_IMAGE_MAX_PIXELS / (width_pt * height_pt)) ** 0.5
+    return min(zoom, area_zoom)
+
+def estimate_image_tokens(width, height):
+    """Tokens aproximados de una imagen (ancho × alto / 750), tras el reescalado del modelo"""
+    scale = min(1, MODEL_IMAGE_MAX_PX / max(width, height), (MODEL_IMAGE_MAX_PIXELS / (width * height)) ** 0.5)
+    return int(width * scale * height * scale / 750)
+
+def format_image_savings(image_stats):
+    """Resumen legible de bytes y tokens de imagen enviados y ahorrados respecto al PNG 2x"""
+    images = sum(s["images"] for s in image_stats.values())
+    if not images:
+        return ""
+    sent_bytes = sum(s["bytes"] for s in image_stats.values())
+    sent_tokens = sum(s["tokens"] for s in image_stats.values())
+    saved_bytes = sum(s["baseline_bytes"] for s in image_stats.values()) - sent_bytes
+    saved_tokens = sum(s["baseline_tokens"] for s in image_stats.values()) - sent_tokens
+    return (
+        f"🖼️ {images} imágenes enviadas: {sent_bytes / 1024:,.0f} KB, ≈{sent_tokens:,} tokens. "
+        f"Ahorro estimado frente a PNG 2x: {saved_bytes / 1024:,.0f} KB y ≈{saved_tokens:,} tokens"
+    )
+
+def table_to_markdown(rows):
+    """Convierte filas extraídas por find_tables() en una tabla markdown"""
+    def clean(cell):
+        return " ".join(str(cell).split()) if cell is not None else ""
+
+    rows = [[clean(cell) for cell in row] for row in rows]
+    if not rows:
+        return ""
+    lines = ["| " + " | ".join(rows[0]) + " |", "|" + "---|" * len(rows[0])]
+    lines += ["| " + " | ".join(row) + " |" for row in rows[1:]]
+    return "\n".join(lines)
+
+def match_staff_header(row):
+    """Columnas de la tabla de personal reconocidas en una fila de cabecera.
+
+    Devuelve {índice de columna: campo} con los campos de STAFF_COLUMNS.
+    """
+    columns = {}
+    for index, cell in enumerate(row):
+        name = normalize_name(cell)
+        if not name:
+            continue
+        for field, keywords in STAFF_COLUMNS.items():
+            if field not in columns.values() and any(k in name for k in keywords):
+                columns[index] = field
+                break
+    return columns
+
+def _confident_staff_table(rows, columns):
+    """Comprueba que las filas de datos tienen categoría y jornada o antigüedad"""
+    if len(columns) < STAFF_MIN_COLUMNS or "categoria" not in columns.values() or not rows:
+        return False
+    by_field = {field: index for index, field in columns.items()}
+    filled = 0
+    for row in rows:
+        def cell(field):
+            index = by_field.get(field)
+            return str(row[index] or "").strip() if index is not None and index < len(row) else ""
+        if cell("categoria") and (cell("horas_mensuales") or cell("fecha_antiguedad")):
+            filled += 1
+    return filled / len(rows) >= STAFF_MIN_FILLED_ROWS
+
+@metrics.timed("tablas_locales")
+def local_staff_tables(pages):
+    """Extrae localmente la tabla de personal de cada página de un PDF digital.
+
+    Devuelve {página: tabla markdown compacta} solo para las páginas que pasan
+    la comprobación de confianza; el resto se envía a la IA como imagen. Las
+    continuaciones de la tabla sin cabecera en páginas siguientes se
+    reconocen por el número de columnas de la última cabecera válida.
+    """
+    result = {}
+    last_header = None
+    for page_num in range(len(pages)):
+        markdown = []
+        for rows in pages.table_rows(page_num):
+            columns = {}
+            header_rows = 0
+            # La cabecera puede ocupar una o dos filas
+            for i in range(min(2, len(rows))):
+                candidate = match_staff_header(rows[i])
+                if len(candidate) > len(columns):
+                    columns, header_rows = candidate, i + 1
+            if len(columns) >= STAFF_MIN_COLUMNS:
+                header = [
+                    " ".join(" ".join(str(row[i] or "").split()) for row in rows[:header_rows] if row[i]).strip()
+                    for i in range(len(rows[0]))
+                ]
+                last_header = (header, columns)
+            elif last_header and len(rows[0]) == len(last_header[0]):
+                header, columns = last_header
+                header_rows = 0
+            else:
+                continue
+            data_rows = [row for row in rows[header_rows:] if any(str(c or "").strip() for c in row)]
+            if not _confident_staff_table(data_rows, columns):
+                continue
+            # Tabla compacta: sin columnas vacías
+            keep = [i for i in range(len(header)) if header[i] or any(str(row[i] or "").strip() for row in data_rows)]
+            markdown.append(table_to_markdown([[row[i] for i in keep] for row in [header] + data_rows]))
+        if markdown:
+            result[page_num] = "\n\n".join(markdown)
+    return result
+
+def is_blank_page(image):
+    """True si la miniatura es una página en blanco (ninguna línea de tinta)"""
+    background = np.median(image)
+    ink_per_row = (image < background - SKIP_INK_CONTRAST).sum(axis=1)
+    return np.count_nonzero(ink_per_row >= SKIP_BLANK_ROW_INK_PX) < SKIP_BLANK_MIN_INK_ROWS
+
+def _block_means(image, rows, cols):
+    """Media de cada bloque de la imagen, con los bloques empezando en rows × cols"""
+    sums = np.add.reduceat(np.add.reduceat(image.astype(np.float64), rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(np.append(rows, image.shape[0])), np.diff(np.append(cols, image.shape[1])))
+    return sums / counts
+
+def _block_grid(image):
+    return np.arange(0, image.shape[0], SKIP_BLOCK_PX), np.arange(0, image.shape[1], SKIP_BLOCK_PX)
+
+def dhash(image, size=8):
+    """Hash perceptual por diferencias (dHash) de size × size bits, como entero"""
+    rows = np.linspace(0, image.shape[0], size + 1).astype(int)[:-1]
+    cols = np.linspace(0, image.shape[1], size + 2).astype(int)[:-1]
+    means = _block_means(image, rows, cols)
+    bits = (means[:, 1:] > means[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def _near_duplicate(a, b):
+    """True si ningún bloque de SKIP_BLOCK_PX px difiere más de SKIP_DUPLICATE_MAX_DIFF niveles de media"""
+    diff = np.abs(a.astype(np.int16) - b)
+    return _block_means(diff, *_block_grid(diff)).max() <= SKIP_DUPLICATE_MAX_DIFF
+
+@metrics.timed("prefiltro_paginas")
+def skip_scanned_pages(pages, page_nums):
+    """Pre-filtro local de páginas escaneadas antes de enviarlas a la IA.
+
+    Descarta las páginas en blanco y agrupa las casi idénticas (portadas y
+    cabeceras repetidas): solo la primera de cada grupo se envía y su
+    resultado se comparte con el resto. Devuelve un dict con:
+    - "targets": páginas que sí hay que enviar (una por grupo)
+    - "representative": {página: página enviada en su lugar} para las duplicadas
+    - "blank": páginas en blanco
+    """
+    blank = []
+    representative = {}
+    clusters = []  # (página, dHash, medias por bloque) de cada página que se envía
+    for page_num in page_nums:
+        image = pages.thumbnail(page_num)
+        if is_blank_page(image):
+            blank.append(page_num)
+            continue
+        page_hash = dhash(image)
+        blocks = _block_means(image, *_block_grid(image))
+        for target, target_hash, target_blocks in clusters:
+            # Filtros baratos (dHash y medias por bloque) antes de comparar píxel a píxel
+            if (
+                (page_hash ^ target_hash).bit_count() <= SKIP_DUPLICATE_MAX_BITS
+                and blocks.shape == target_blocks.shape
+                and np.abs(blocks - target_blocks).max() <= SKIP_DUPLICATE_MAX_DIFF
+                and _near_duplicate(image, pages.thumbnail(target))
+            ):
+                representative[page_num] = target
+                break
+        else:
+            clusters.append((page_num, page_hash, blocks))
+    return {"targets": [page_num for page_num, _, _ in clusters], "representative": representative, "blank": blank}
+
+def extract_convenio_from_image(client, image_bytes, image_type, detailed=True):
+    """Extrae información del convenio desde una imagen usando Claude"""
+    img_base64 = base64.standard_b64encode(image_bytes).decode("utf-8")
+    media_type = f"image/{image_type}" if image_type != "jpg" else "image/jpeg"
+
+    if detailed:
+        prompt_text = """Extrae TODA la información de este convenio colectivo o tabla salarial.
+
+Incluye:
+- Tablas salariales con todas las categorías y salarios
+- Complementos (transporte, nocturnidad, festividad, etc.)
+- Antigüedad (trienios, porcentajes)
+- Pagas extras
+- Jornada laboral
+- Cualquier otro dato relevante para calcular costes de personal
+
+Transcribe los datos de forma estructurada y completa."""
+    else:
+        prompt_text = """Analiza brevemente esta página. ¿Contiene alguno de estos elementos?
+- Tablas salariales o retribuciones
+- Complementos salariales (transporte, nocturnidad, etc.)
+- Información sobre antigüedad/trienios
+- Pagas extraordinarias
+- Jornada laboral
+
+Responde SOLO con: "RELEVANTE: [motivo breve]" o "NO RELEVANTE"."""
+
+    response = client.messages.create(
+        model="claude-sonnet-4-20250514",
+        max_tokens=4096 if detailed else 200,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image",
+                        "source": {
+                            "type": "base64",
+                            "media_type": media_type,
+                            "data": img_base64,
+                        }
+                    },
+                    {
+                        "type": "text",
+                        "text": prompt_text
+                    }
+                ]
+            }
+        ]
+    )
+
+    return response.content[0].text
+
+def run_pages_concurrently(func, items, max_workers=None, progress_callback=None, progress_weight=None):
+    """Aplica func a cada elemento en paralelo y devuelve los resultados en el orden original.
+
+    progress_callback(completadas, total) se llama desde el hilo que invoca esta
+    función (nunca desde los hilos de trabajo), así que puede actualizar la UI.
+    Si se indica progress_weight(item), el progreso se cuenta en esas unidades
+    (por ejemplo, páginas de un lote) en lugar de en elementos.
+    """
+    total_items = len(items)
+    results = [None] * total_items
+    if total_items == 0:
+        return results
+
+    weight = progress_weight or (lambda item: 1)
+    total = sum(weight(item) for item in items)
+    done = 0
+
+    workers = max(1, min(max_workers or CONVENIO_MAX_WORKERS, total_items))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Cada tarea se ejecuta dentro de la ejecución medida actual (ver metrics)
+        futures = {executor.submit(metrics.propagate(func), item): i for i, item in enumerate(items)}
+        for future in as_completed(futures):
+            index = futures[future]
+            results[index] = future.result()
+            done += weight(items[index])
+            if progress_callback:
+                progress_callback(done, total)
+
+    return results
+
+def parse_triage_verdict(text):
+    """Interpreta la respuesta de clasificación: True, False o None si no se entiende"""
+    upper = text.upper()
+    if re.search(r"NO\s+RELEVANTE", upper):
+        return False
+    if "RELEVANTE" in upper:
+        return True
+    return None
+
+def classify_pages_batch(client, batch):
+    """Clasifica varias páginas en una sola petición.
+
+    batch es una lista de (índice_página, miniatura_base64, media_type). Devuelve un dict
+    índice_página -> True/False; las páginas cuyo veredicto no se pudo leer
+    no aparecen en el resultado.
+    """
+    content = []
+    for page_index, thumb_base64, media_type in batch:
+        content.append({"type": "text", "text": f"PÁGINA {page_index + 1}:"})
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": thumb_base64,
+            }
+        })
+
+    page_list = ", ".join(str(page_index + 1) for page_index, _, _ in batch)
+    content.append({
+        "type": "text",
+        "text": f"""Las imágenes anteriores son las páginas {page_list} de un convenio colectivo, cada una precedida de su número.
+Para cada página indica si contiene alguno de estos elementos:
+- Tablas salariales o retribuciones
+- Complementos salariales (transporte, nocturnidad, etc.)
+- Información sobre antigüedad/trienios
+- Pagas extraordinarias
+- Jornada laboral
+
+Responde SOLO con una línea por página, en este formato exacto:
+PÁGINA <número>: RELEVANTE - <motivo breve>
+PÁGINA <número>: NO RELEVANTE"""
+    })
+
+    response = client.messages.create(
+        model="claude-sonnet-4-20250514",
+        max_tokens=60 * len(batch) + 100,
+        messages=[
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+    )
+
+    expected = {page_index for page_index, _, _ in batch}
+    verdicts = {}
+    for line in response.content[0].text.splitlines():
+        match = re.search(r"P[ÁA]GINA\s+(\d+)\s*[:\-]\s*(.*)", line, re.IGNORECASE)
+        if not match:
+            continue
+        page_index = int(match.group(1)) - 1
+        verdict = parse_triage_verdict(match.group(2))
+        if page_index in expected and verdict is not None:
+            verdicts[page_index] = verdict
+
+    return verdicts
+
+@metrics.timed("fase1_triaje")
+def identify_relevant_pages(client, pages, progress_callback=None, max_workers=None, batch_size=1, page_nums=None):
+    """Identifica qué páginas del convenio contienen información relevante
+
+    pages es un PdfPages; cada página se renderiza solo cuando se clasifica.
+    page_nums limita la clasificación a esas páginas (por defecto, todas).
+    Con batch_size > 1 se envían varias miniaturas por petición; las páginas
+    cuyo veredicto no se pueda interpretar se vuelven a clasificar de una en una.
+    """
+    def classify(page_num):
+        img_bytes, image_type = pages.render(page_num, "triage")
+        return parse_triage_verdict(extract_convenio_from_image(client, img_bytes, image_type, detailed=False))
+
+    page_nums = list(range(len(pages))) if page_nums is None else list(page_nums)
+
+    if batch_size <= 1:
+        results = run_pages_concurrently(classify, page_nums, max_workers, progress_callback)
+        return [i for i, relevant in zip(page_nums, results) if relevant]
+
+    def classify_batch(batch):
+        thumbs = [(page_num, *pages.render_base64(page_num, "triage")) for page_num in batch]
+        return classify_pages_batch(client, thumbs)
+
+    batches = [page_nums[i:i + batch_size] for i in range(0, len(page_nums), batch_size)]
+    verdicts = {}
+    for batch_verdicts in run_pages_concurrently(
+        classify_batch, batches, max_workers, progress_callback, progress_weight=len
+    ):
+        verdicts.update(batch_verdicts)
+
+    # Reintentar individualmente solo las páginas sin veredicto
+    missing = [i for i in page_nums if i not in verdicts]
+    for page_num, relevant in zip(missing, run_pages_concurrently(classify, missing, max_workers)):
+        verdicts[page_num] = relevant
+
+    return [i for i in page_nums if verdicts[i]]
+
+@metrics.timed("extraccion_convenio")
+def extract_convenio_from_file(client, file_bytes, file_type, is_image, *, progress_placeholder=None, max_workers=None,
+                               image_stats=None, triage_batch_size=None, max_px=None, skip_stats=None):
+    """Extrae el texto del convenio; solo las páginas escaneadas se envían a la IA.
+
+    image_stats y skip_stats, si se pasan, se rellenan con las estadísticas
+    de las imágenes enviadas (ver PdfPages.image_stats) y de las páginas
+    omitidas ("blank", "duplicates", "calls_saved"). triage_batch_size y
+    max_px aplican la estrategia del planificador (ver planner).
+    """
+    key = convenio_cache.cache_key(file_bytes, CONVENIO_CACHE_VERSION)
+    # El texto de cada página depende de la resolución con que se envió
+    page_key = convenio_page_key(file_bytes, max_px)
+
+    if is_image:
+        cached = convenio_cache.get_text(key, "image.txt")
+        if cached is not None:
+            return cached
+        text = extract_convenio_from_image(client, file_bytes, file_type, detailed=True)
+        convenio_cache.put_text(key, "image.txt", text)
+        return text
+
+    with PdfPages(file_bytes, render_profiles(max_px)) as pages:
+        total_pages = len(pages)
+
+        # Pre-filtro local: texto, densidad de palabras y tablas de cada página
+        local_pages = [pages.local_page(page_num) for page_num in range(total_pages)]
+        scanned_pages = [i for i, page in enumerate(local_pages) if page["needs_vision"]]
+        page_texts = {
+            i: page["text"] for i, page in enumerate(local_pages)
+            if not page["needs_vision"] and page["text"].strip()
+        }
+
+        def assemble():
+            if image_stats is not None:
+                image_stats.update(pages.image_stats)
+            return "".join(
+                f"\n--- PÁGINA {page_num+1} ---\n{page_texts[page_num]}\n"
+                for page_num in sorted(page_texts)
+            )
+
+        # Documento digital: no hace falta ninguna llamada a la API
+        if not scanned_pages:
+            return assemble()
+
+        if progress_placeholder:
+            progress_placeholder.info(
+                f"📄 Convenio de {total_pages} páginas detectado: {total_pages - len(scanned_pages)} con texto, "
+                f"{len(scanned_pages)} escaneadas. Analizando estructura..."
+            )
+
+        # Pre-filtro local: las páginas en blanco no se envían y cada grupo de duplicadas se envía una vez
+        skipped = skip_scanned_pages(pages, scanned_pages)
+        targets = skipped["targets"]
+        representative = skipped["representative"]
+        calls_saved = 0
+
+        def share_duplicates():
+            for page_num, target in representative.items():
+                if target in page_texts:
+                    page_texts[page_num] = page_texts[target]
+
+        def report_skipped():
+            metrics.count("llamadas_ahorradas_prefiltro", calls_saved)
+            if skip_stats is not None:
+                skip_stats.update(
+                    blank=len(skipped["blank"]), duplicates=len(representative), calls_saved=calls_saved
+                )
+
+        if progress_placeholder and (skipped["blank"] or representative):
+            progress_placeholder.info(
+                f"🧹 {len(skipped['blank'])} páginas en blanco y {len(representative)} duplicadas no se envían a la IA"
+            )
+
+        def extract_page(page_num):
+            name = f"page_{page_num + 1:04d}.txt"
+            cached = convenio_cache.get_text(page_key, name)
+            if cached is not None:
+                return cached
+            img_bytes, image_type = pages.render(page_num, "extraction")
+            page_text = extract_convenio_from_image(client, img_bytes, image_type, detailed=True)
+            convenio_cache.put_text(page_key, name, page_text)
+            return page_text
+
+        # Si son pocas páginas escaneadas, procesar todas
+        if len(scanned_pages) <= SCANNED_PAGES_DIRECT_MAX:
+            def update_all(current, total):
+                if progress_placeholder:
+                    progress_placeholder.info(f"📄 Procesando página escaneada {current}/{total}...")
+
+            pages_text = run_pages_concurrently(extract_page, targets, max_workers, update_all)
+            page_texts.update(zip(targets, pages_text))
+            share_duplicates()
+            calls_saved = len(scanned_pages) - len(targets)
+            report_skipped()
+            return assemble()
+
+        # Para muchas páginas escaneadas: extracción inteligente en 2 fases
+        if progress_placeholder:
+            progress_placeholder.info(f"🔍 Fase 1: Escaneando {len(targets)} páginas para identificar tablas salariales...")
+
+        def update_progress(current, total):
+            if progress_placeholder:
+                progress_placeholder.info(f"🔍 Fase 1: Escaneando página {current}/{total}...")
+
+        # Fase 1: Identificar páginas relevantes
+        relevant_pages = convenio_cache.get_json(key, "relevant_pages.json")
+        if relevant_pages is None:
+            batch_size = triage_batch_size or TRIAGE_BATCH_SIZE
+            relevant_pages = identify_relevant_pages(
+                client, pages, update_progress, max_workers, batch_size, page_nums=targets
+            )
+            convenio_cache.put_json(key, "relevant_pages.json", relevant_pages)
+            calls_saved += math.ceil(len(scanned_pages) / batch_size) - math.ceil(len(targets) / batch_size)
+        elif progress_placeholder:
+            progress_placeholder.info("♻️ Fase 1 recuperada de la caché")
+        # Solo se extrae la página enviada de cada grupo de duplicadas (y nunca las páginas en blanco)
+        blank = set(skipped["blank"])
+        relevant_pages = sorted({representative.get(p, p) for p in relevant_pages if p not in blank})
+
+        if not relevant_pages:
+            # Si no encontró páginas relevantes, usar las primeras páginas escaneadas
+            if progress_placeholder:
+                progress_placeholder.warning(
+                    f"⚠️ No se identificaron páginas con tablas. Procesando primeras {SCANNED_PAGES_FALLBACK} páginas..."
+                )
+            relevant_pages = targets[:SCANNED_PAGES_FALLBACK]
+        else:
+            if progress_placeholder:
+                progress_placeholder.success(f"✅ Encontradas {len(relevant_pages)} páginas con información salarial")
+
+        # Fase 2: Extraer contenido detallado de páginas relevantes
+        if progress_placeholder:
+            progress_placeholder.info(f"📊 Fase 2: Extrayendo datos de {len(relevant_pages)} páginas relevantes...")
+
+        def update_phase2(current, total):
+            if progress_placeholder:
+                progress_placeholder.info(f"📊 Fase 2: Extrayendo páginas relevantes ({current}/{total})...")
+
+        with metrics.span("fase2_extraccion"):
+            pages_text = run_pages_concurrently(extract_page, relevant_pages, max_workers, update_phase2)
+        page_texts.update(zip(relevant_pages, pages_text))
+        share_duplicates()
+        calls_saved += sum(1 for target in representative.values() if target in relevant_pages)
+        report_skipped()
+
+        return assemble()
+
+def create_message(client, stream_callback=None, timings=None, usage=None, **request):
+    """Envía una petición a Claude, opcionalmente en modo streaming.
+
+    Con stream_callback, la respuesta se recibe por streaming y se llama a
+    stream_callback(texto_acumulado, json_acumulado) con cada fragmento: el
+    texto de los bloques de texto y el JSON parcial de las llamadas a
+    herramientas. Para no saturar la UI, se llama como mucho cada
+    STREAM_CALLBACK_INTERVAL segundos (y siempre al final). Si se pasa un dict en timings, se guardan "ttft" (segundos
+    hasta el primer fragmento, solo en streaming) y "total". Si se pasa un
+    dict en usage, se rellena con los tokens de la respuesta (ver record_usage).
+    El valor devuelto es el mensaje final, igual que con messages.create.
+    Los reintentos de las peticiones normales los hace el cliente compartido
+    (ver api_client); los del streaming, esta función.
+    """
+    start = time.perf_counter()
+
+    if not stream_callback:
+        response = client.messages.create(**request)
+        if timings is not None:
+            timings["total"] = time.perf_counter() - start
+        record_usage(response, usage)
+        return response
+
+    def stream_once():
+        text = ""
+        partial_json = ""
+        last_callback = 0.0
+        with client.messages.stream(**request) as stream:
+            for event in stream:
+                if event.type == "content_block_start" and event.content_block.type == "text" and text:
+                    text += "\n"
+                    continue
+                if event.type != "content_block_delta":
+                    continue
+                if timings is not None and "ttft" not in timings:
+                    timings["ttft"] = time.perf_counter() - start
+                if event.delta.type == "text_delta":
+                    text += event.delta.text
+                elif event.delta.type == "input_json_delta":
+                    partial_json += event.delta.partial_json
+                else:
+                    continue
+                now = time.perf_counter()
+                if now - last_callback >= STREAM_CALLBACK_INTERVAL:
+                    stream_callback(text, partial_json)
+                    last_callback = now
+            response = stream.get_final_message()
+            stream_callback(text, partial_json)
+        return response
+
+    # Si el streaming se corta por un error transitorio se repite entero;
+    # los callbacks reciben siempre el texto acumulado, así que se reinician solos
+    with metrics.span("api"):
+        response = with_retries(stream_once)
+    metrics.record_response(response, time.perf_counter() - start, request.get("model"))
+
+    if timings is not None:
+        timings["total"] = time.perf_counter() - start
+    record_usage(response, usage)
+    return response
+
+def record_usage(response, usage):
+    """Acumula en usage los tokens de entrada/salida y de caché de prompts de una respuesta"""
+    if usage is None or getattr(response, "usage", None) is None:
+        return
+    with _usage_lock:
+        for field in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"):
+            usage[field] = usage.get(field, 0) + (getattr(response.usage, field, None) or 0)
+
+def format_usage(usage):
+    """Texto con los tokens usados, incluidos los de la caché de prompts"""
+    if not usage:
+        return ""
+    return (
+        f"🔢 Tokens: {usage.get('input_tokens', 0):,} entrada, {usage.get('output_tokens', 0):,} salida · "
+        f"caché de prompt: {usage.get('cache_read_input_tokens', 0):,} leídos, "
+        f"{usage.get('cache_creation_input_tokens', 0):,} escritos"
+    )
+
+def partial_staff_rows(partial_json):
+    """Trabajadores ya completos dentro del JSON parcial de STAFF_EXTRACTION_TOOL"""
+    start = partial_json.find('"trabajadores"')
+    if start < 0:
+        return []
+    start = partial_json.find("[", start)
+    if start < 0:
+        return []
+
+    rows = []
+    depth = 0
+    in_string = False
+    escaped = False
+    obj_start = None
+    for i in range(start + 1, len(partial_json)):
+        char = partial_json[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            if depth == 0:
+                obj_start = i
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0 and obj_start is not None:
+                try:
+                    rows.append(json.loads(partial_json[obj_start:i + 1]))
+                except ValueError:
+                    pass
+        elif char == "]" and depth == 0:
+            break
+    return rows
+
+def format_partial_staff(rows):
+    """Tabla markdown provisional con los trabajadores recibidos hasta ahora"""
+    lines = [
+        f"⏳ **Trabajadores extraídos hasta ahora: {len(rows)}**",
+        "",
+        "| Trabajador | Categoría | Antigüedad | Jornada (h/mes) |",
+        "|---|---|---|---|",
+    ]
+    for row in rows:
+        lines.append(
+            f"| {row.get('trabajador', '')} | {row.get('categoria', '')} "
+            f"| {row.get('fecha_antiguedad') or ''} | {row.get('horas_mensuales') or ''} |"
+        )
+    return "\n".join(lines)
+
+def _search_key(nombre_convenio):
+    return convenio_cache.cache_key(normalize_name(nombre_convenio).encode("utf-8"), SEARCH_CACHE_VERSION)
+
+def cached_search(nombre_convenio):
+    """Resultado guardado de "Buscar con IA" si sigue vigente (CONVENIO_SEARCH_TTL_DAYS), o None"""
+    entry = convenio_cache.get_json(_search_key(nombre_convenio), "busqueda.json")
+    if entry and time.time() - entry["timestamp"] < CONVENIO_SEARCH_TTL_DAYS * 86400:
+        return entry
+    return None
+
+@metrics.timed("busqueda_convenio")
+def buscar_convenio_con_ia(client, nombre_convenio, stream_callback=None, timings=None, force_refresh=False,
+                           cache_info=None):
+    """Busca información del convenio usando Claude con búsqueda web para obtener datos actualizados
+
+    Con stream_callback(texto_parcial) se recibe la respuesta por streaming;
+    timings recoge el tiempo hasta el primer token y el total (ver create_message).
+
+    El resultado se guarda en disco durante CONVENIO_SEARCH_TTL_DAYS días,
+    indexado por el nombre normalizado (mayúsculas, acentos y espacios). Si
+    varias sesiones piden el mismo convenio a la vez, solo una hace la
+    búsqueda y las demás esperan su resultado. force_refresh ignora la caché.
+    Si se pasa un dict en cache_info, se rellena con "cached", "fecha" y "fuente".
+    """
+    key = _search_key(nombre_convenio)
+
+    if not force_refresh:
+        entry = cached_search(nombre_convenio)
+        if entry:
+            if cache_info is not None:
+                cache_info.update(cached=True, fecha=entry["fecha"], fuente=entry["fuente"])
+            return entry["text"]
+
+    with _search_lock:
+        future = _search_inflight.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _search_inflight[key] = future
+
+    if not owner:
+        # Otra sesión ya está buscando este convenio: esperar su resultado
+        entry = future.result()
+        if cache_info is not None:
+            cache_info.update(cached=True, fecha=entry["fecha"], fuente=entry["fuente"])
+        return entry["text"]
+
+    try:
+        text = _buscar_convenio_en_web(client, nombre_convenio, stream_callback, timings)
+        url = re.search(r"https?://[^\s)\]>\"']+", text)
+        entry = {
+            "nombre": nombre_convenio,
+            "text": text,
+            "timestamp": time.time(),
+            "fecha": time.strftime("%d/%m/%Y %H:%M"),
+            "fuente": url.group(0).rstrip(".,;:") if url else "búsqueda web",
+        }
+        convenio_cache.put_json(key, "busqueda.json", entry)
+        future.set_result(entry)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _search_lock:
+            _search_inflight.pop(key, None)
+
+    if cache_info is not None:
+        cache_info.update(cached=False, fecha=entry["fecha"], fuente=entry["fuente"])
+    return text
+
+def _buscar_convenio_en_web(client, nombre_convenio, stream_callback=None, timings=None):
+    """Llamada a Claude con búsqueda web (sin caché)"""
+
+    prompt = f"""Eres un experto en convenios colectivos españoles y legislación laboral.
+
+TAREA CRÍTICA: Busca en internet el convenio colectivo MÁS RECIENTE y ACTUALIZADO:
+"{nombre_convenio}"
+
+INSTRUCCIONES DE BÚSQUEDA:
+1. Busca PRIMERO en el BOE (Boletín Oficial del Estado) o boletines autonómicos/provinciales
+2. Busca la ÚLTIMA revisión salarial o tablas salariales publicadas
+3. Asegúrate de obtener los datos del año actual o el más reciente disponible
+4. Si hay varias publicaciones, usa SIEMPRE la más reciente
+
+DEBES INCLUIR CON DATOS ACTUALIZADOS:
+
+1. **TABLAS SALARIALES VIGENTES** - Salarios base por categoría profesional (indicar año de las tablas)
+2. **COMPLEMENTOS SALARIALES**:
+   - Plus de transporte
+   - Plus de nocturnidad
+   - Plus de festividad
+   - Otros pluses específicos del sector
+
+3. **ANTIGÜEDAD**:
+   - Tipo (trienios, quinquenios, bienios)
+   - Porcentaje o cantidad por periodo
+
+4. **PAGAS EXTRAORDINARIAS**:
+   - Número de pagas extras
+   - Cuantía (salario base, base + antigüedad, etc.)
+
+5. **JORNADA LABORAL**:
+   - Horas anuales
+   - Horas semanales
+
+6. **CATEGORÍAS PROFESIONALES** del sector
+
+7. **FECHA DE PUBLICACIÓN** del convenio/tablas salariales encontradas
+
+8. **FUENTE** (enlace al BOE u otra fuente oficial)
+
+IMPORTANTE:
+- NO uses datos aproximados ni de memoria
+- BUSCA siempre en internet para obtener los datos más recientes
+- Indica claramente la fecha y fuente de los datos
+
+Responde de forma estructurada y detallada para poder calcular costes de subrogación.
+"""
+
+    callback = (lambda text, _: stream_callback(text)) if stream_callback else None
+    response = create_message(
+        client,
+        callback,
+        timings,
+        model="claude-sonnet-4-20250514",
+        max_tokens=8192,
+        tools=[
+            {
+                "type": "web_search_20250305"
+            }
+        ],
+        messages=[
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    )
+
+    # Extraer el texto de la respuesta (puede venir en varios bloques por la búsqueda web)
+    result_text = ""
+    for block in response.content:
+        if hasattr(block, 'text'):
+            result_text += block.text + "\n"
+
+    return result_text.strip()
+
+STAFF_EXTRACTION_TOOL = {
+    "name": "registrar_datos_subrogacion",
+    "description": "Registra los datos del convenio y de cada trabajador de la tabla de personal. No calcula costes.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "convenio": {
+                "type": "object",
+                "properties": {
+                    "numero_pagas": {"type": ["number", "null"], "description": "Pagas al año (12, 14, 15...)"},
+                    "cita_pagas": {"type": "string", "description": "Cita textual del convenio sobre las pagas"},
+                    "base_pagas_extra": {
+                        "type": "string",
+                        "enum": ["total", "salario_base", "salario_base_antiguedad"],
+                        "description": "Conceptos que incluye cada paga extra",
+                    },
+                    "categorias": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "categoria": {"type": "string"},
+                                "salario_base_mensual": {"type": ["number", "null"], "description": "null si NO ENCONTRADO"},
+                                "cita": {"type": "string"},
+                            },
+                            "required": ["categoria", "salario_base_mensual", "cita"],
+                        },
+                    },
+                    "pluses": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "concepto": {"type": "string", "description": "Ej: Plus Transporte, Plus Convenio"},
+                                "importe_mensual": {"type": ["number", "null"], "description": "Importe mensual a jornada completa"},
+                                "cita": {"type": "string"},
+                            },
+                            "required": ["concepto", "importe_mensual", "cita"],
+                        },
+                    },
+                    "antiguedad": {
+                        "type": "object",
+                        "properties": {
+                            "tipo": {"type": "string", "description": "trienio, bienio, quinquenio..."},
+                            "periodo_anios": {"type": "number"},
+                            "importe_mensual": {"type": ["number", "null"], "description": "Importe mensual por periodo"},
+                            "porcentaje": {"type": ["number", "null"], "description": "% del salario base por periodo"},
+                            "maximo_periodos": {"type": ["number", "null"]},
+                            "cita": {"type": "string"},
+                        },
+                    },
+                },
+                "required": ["numero_pagas", "categorias", "pluses", "antiguedad"],
+            },
+            "trabajadores": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "trabajador": {"type": "string", "description": "Nombre o iniciales"},
+                        "fecha_antiguedad": {"type": ["string", "null"], "description": "Fecha de alta AAAA-MM-DD"},
+                        "tipo_contrato": {"type": ["string", "null"]},
+                        "categoria": {"type": "string", "description": "Categoría tal como aparece en la tabla"},
+                        "categoria_convenio": {"type": ["string", "null"], "description": "Nombre exacto de la categoría del convenio equivalente"},
+                        "horas_mensuales": {"type": ["number", "null"]},
+                        "pagina": {"type": ["integer", "null"], "description": "Número de la página del documento (--- PÁGINA n ---) donde está la fila"},
+                        "pluses": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Conceptos de 'convenio.pluses' que cobra este trabajador",
+                        },
+                    },
+                    "required": ["trabajador", "categoria", "horas_mensuales", "pluses"],
+                },
+            },
+            "observaciones": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["convenio", "trabajadores"],
+    },
+}
+
+def build_staff_system_prompt(convenio_text, context_tokens=None):
+    """Prefijo estable del análisis (instrucciones + convenio).
+
+    No depende de la tabla de personal, así que se marca para la caché de
+    prompts de la API y se reutiliza entre análisis con el mismo convenio.
+    Del convenio solo se incluyen los fragmentos más relevantes que caben en
+    context_tokens (ver convenio_context).
+    """
+    return f"""Eres un experto en recursos humanos y convenios colectivos en España.
+
+TAREA: Extrae los datos de la tabla de personal que te envíe el usuario (como imágenes o como tablas de texto extraídas del PDF) y los datos salariales del CONVENIO DE REFERENCIA.
+NO calcules costes: los cálculos se hacen después automáticamente con los datos que registres.
+
+⚠️ REGLA CRÍTICA - LEE ESTO PRIMERO ⚠️
+=============================================
+DEBES usar ÚNICAMENTE los salarios y datos que aparecen en el CONVENIO DE REFERENCIA proporcionado abajo.
+NUNCA inventes salarios. NUNCA uses valores por defecto como 750€.
+Si no encuentras un dato en el convenio, usa null (NO ENCONTRADO EN CONVENIO).
+Cita textualmente de dónde sacas cada salario del convenio.
+=============================================
+
+CONVENIO DE REFERENCIA (USA ESTOS DATOS, NO OTROS):
+================================================================================
+{select_convenio_context(convenio_text, context_tokens) if convenio_text else "ERROR: No se ha proporcionado convenio de referencia. Registra todos los importes como null."}
+================================================================================
+
+=== DATOS DEL CONVENIO ===
+1. **NÚMERO DE PAGAS** al año y qué incluye cada paga extra
+2. **SALARIO BASE MENSUAL** de cada categoría profesional (a jornada completa)
+3. **PLUSES Y COMPLEMENTOS** con su importe mensual a jornada completa:
+   Transporte / Locomoción, Convenio / Empresa, Nocturnidad, Festivos, Toxicidad / Penosidad,
+   Disponibilidad, Asistencia y otros pluses específicos del sector
+4. **ANTIGÜEDAD**: tipo (trienios, bienios, quinquenios), años de cada periodo,
+   importe mensual o % del salario base por periodo y tope de periodos si existe
+
+=== DATOS DE CADA TRABAJADOR DE LA TABLA DE PERSONAL ===
+- Trabajador (nombre o iniciales)
+- Antigüedad (fecha de alta, formato AAAA-MM-DD)
+- Tipo contrato (código o descripción)
+- Categoría profesional y la categoría equivalente del convenio
+- **JORNADA MENSUAL** (en horas) - MUY IMPORTANTE
+- Pluses del convenio que le corresponden
+- Página del documento donde aparece su fila (indicada como --- PÁGINA n --- antes de cada página)
+- IGNORA los salarios que aparezcan en la tabla de personal
+
+⚠️ REGLAS OBLIGATORIAS:
+1. NUNCA inventes un salario: si no está en el convenio, usa null
+2. Incluye TODOS los trabajadores de la tabla
+3. Los importes son números (1200.5), sin símbolo € ni separador de miles
+4. Indica en "observaciones" cualquier dato que falte o que sea dudoso
+
+Registra los datos con la herramienta {STAFF_EXTRACTION_TOOL["name"]}.
+"""
+
+def _request_staff_group(client, page_content, convenio_text, context_tokens, first_page, last_page,
+                         stream_callback=None, timings=None, usage=None):
+    """Una petición de extracción para un grupo de páginas; devuelve la entrada de la herramienta"""
+    pages_hint = f" (páginas {first_page}-{last_page} del documento)" if last_page else ""
+    content = list(page_content)
+    content.append({
+        "type": "text",
+        "text": f"Extrae los datos de la tabla de personal de las páginas anteriores{pages_hint} y regístralos con la herramienta {STAFF_EXTRACTION_TOOL['name']}."
+    })
+
+    callback = (lambda _, partial_json: stream_callback(partial_staff_rows(partial_json))) if stream_callback else None
+    response = create_message(
+        client,
+        callback,
+        timings,
+        usage,
+        model="claude-sonnet-4-20250514",
+        max_tokens=8192,
+        tools=[STAFF_EXTRACTION_TOOL],
+        tool_choice={"type": "tool", "name": STAFF_EXTRACTION_TOOL["name"]},
+        system=[
+            {
+                "type": "text",
+                "text": build_staff_system_prompt(convenio_text, context_tokens),
+                "cache_control": {"type": "ephemeral"}
+            }
+        ],
+        messages=[
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+    )
+
+    for block in response.content:
+        if getattr(block, "type", None) == "tool_use":
+            return block.input
+
+    raise ValueError("La IA no devolvió los datos estructurados de la tabla de personal")
+
+def _worker_key(row):
+    return (
+        normalize_name(row.get("trabajador")),
+        str(row.get("fecha_antiguedad") or ""),
+        normalize_name(row.get("categoria")),
+        row.get("horas_mensuales"),
+    )
+
+def merge_staff_groups(groups):
+    """Une los resultados de varios grupos de páginas en uno solo.
+
+    Los grupos se solapan una página, así que los trabajadores repetidos en
+    la frontera entre dos grupos consecutivos se eliminan: una fila solo se
+    descarta si el grupo anterior tiene otra igual en la misma página
+    ("pagina"), de modo que dos trabajadores idénticos en páginas distintas
+    se conservan. Si las filas no indican la página se compara con todo el
+    grupo anterior. Los parámetros del convenio se toman del primer grupo
+    que los tenga.
+    """
+    merged = {"convenio": {}, "trabajadores": [], "observaciones": []}
+    previous_keys = set()
+    for group in groups:
+        if not merged["convenio"].get("categorias") and group.get("convenio"):
+            merged["convenio"] = group["convenio"]
+        keys = set()
+        for row in group.get("trabajadores") or []:
+            key = (row.get("pagina"), _worker_key(row))
+            keys.add(key)
+            if key not in previous_keys:
+                merged["trabajadores"].append(row)
+        previous_keys = keys
+        observaciones = group.get("observaciones") or []
+        if isinstance(observaciones, str):
+            observaciones = [observaciones]
+        for obs in observaciones:
+            if obs not in merged["observaciones"]:
+                merged["observaciones"].append(obs)
+    return merged
+
+def staff_page_groups(total_pages):
+    """Grupos de páginas de una petición cada uno, solapados una página para no perder filas partidas"""
+    if total_pages <= STAFF_PAGES_PER_REQUEST:
+        return [list(range(total_pages))]
+    step = max(STAFF_PAGES_PER_REQUEST - 1, 1)
+    return [
+        list(range(start, min(start + STAFF_PAGES_PER_REQUEST, total_pages)))
+        for start in range(0, max(total_pages - 1, 1), step)
+    ]
+
+def _staff_version(context_tokens=None, max_px=None):
+    version = f"{ANALYSIS_PROMPT_VERSION}_ctx{context_tokens or CONVENIO_CONTEXT_TOKENS}"
+    if render_profiles(max_px) is not RENDER_PROFILES:
+        version += f"_px{max_px}"
+    return version
+
+def staff_analysis_key(file_bytes, convenio_text, context_tokens=None, max_px=None):
+    """Clave de caché del análisis de una tabla de personal con un convenio y una estrategia"""
+    return convenio_cache.analysis_key(file_bytes, convenio_text, _staff_version(context_tokens, max_px))
+
+def staff_page_key(fingerprint, convenio_text, context_tokens=None, max_px=None):
+    """Clave de caché de la extracción de una sola página, por su huella (ver PdfPages.fingerprint)"""
+    return convenio_cache.analysis_key(
+        f"page:{fingerprint}".encode("utf-8"), convenio_text, _staff_version(context_tokens, max_px)
+    )
+
+def split_staff_by_page(result, page_nums):
+    """Reparte los trabajadores de un grupo por página ({página: resultado de esa página}).
+
+    Devuelve None si algún trabajador no indica una página del grupo: en ese
+    caso el grupo no se puede reutilizar por páginas.
+    """
+    valid = {page_num + 1 for page_num in page_nums}
+    workers = result.get("trabajadores") or []
+    if any(row.get("pagina") not in valid for row in workers):
+        return None
+    return {
+        page_num: {
+            "convenio": result.get("convenio") or {},
+            "trabajadores": [row for row in workers if row.get("pagina") == page_num + 1],
+            "observaciones": result.get("observaciones") or [],
+        }
+        for page_num in page_nums
+    }
+
+@metrics.timed("analisis_personal")
+def extract_staff_data(client, file_bytes, file_type, convenio_text, is_image=False, *, image_stats=None,
+                       stream_callback=None, timings=None, usage=None, context_tokens=None,
+                       progress_callback=None, max_workers=None, max_px=None):
+    """Extrae con Claude los datos estructurados de la tabla de personal y del convenio.
+
+    Devuelve el dict de STAFF_EXTRACTION_TOOL más "paginas", "paginas_texto",
+    "paginas_reutilizadas", "huellas" y "analisis_anterior" (ver
+    previous_staff_data). image_stats, timings y usage, si se pasan, se
+    rellenan con las estadísticas de las imágenes, los tiempos y los tokens;
+    stream_callback(trabajadores) y progress_callback(hechos, total) informan
+    del avance.
+    """
+    context_tokens = context_tokens or CONVENIO_CONTEXT_TOKENS
+    key = staff_analysis_key(file_bytes, convenio_text, context_tokens, max_px)
+    cached = convenio_cache.get_json(key, "staff_data.json")
+    if cached is not None:
+        # Mismo archivo ya analizado: no se ha reutilizado nada de otra versión
+        return {**cached, "paginas_reutilizadas": 0, "analisis_anterior": None}
+
+    if is_image:
+        img_base64 = base64.standard_b64encode(file_bytes).decode("utf-8")
+        media_type = "image/png" if file_type == "png" else f"image/{file_type}"
+        image_content = {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": img_base64,
+            }
+        }
+        data = _request_staff_group(
+            client, [image_content], convenio_text, context_tokens, 1, None, stream_callback, timings, usage
+        )
+        data["paginas"] = 1
+        convenio_cache.put_json(key, "staff_data.json", data)
+        return data
+
+    with PdfPages(file_bytes, render_profiles(max_px)) as pages:
+        total_pages = len(pages)
+
+        # Páginas ya extraídas en otra versión del documento (misma huella y mismo convenio)
+        fingerprints = [pages.fingerprint(page_num) for page_num in range(total_pages)]
+        page_keys = [staff_page_key(f, convenio_text, context_tokens, max_px) for f in fingerprints]
+        page_results = {}
+        for page_num, page_key in enumerate(page_keys):
+            stored = convenio_cache.get_json(page_key, "staff_page.json")
+            if stored is not None:
+                # La página puede estar en otra posición en esta versión del documento
+                for row in stored.get("trabajadores") or []:
+                    row["pagina"] = page_num + 1
+                page_results[page_num] = stored
+        reused_pages = len(page_results)
+        pending = [page_num for page_num in range(total_pages) if page_num not in page_results]
+
+        if not page_results:
+            groups = staff_page_groups(total_pages)
+        else:
+            groups = [pending[i:i + STAFF_PAGES_PER_REQUEST] for i in range(0, len(pending), STAFF_PAGES_PER_REQUEST)]
+
+        # Páginas con la tabla de personal en texto: se envían como tabla, no como imagen
+        local_tables = local_staff_tables(pages)
+
+        def extract_group(page_nums, callback=None, group_timings=None):
+            page_content = []
+            for page_num in page_nums:
+                if page_num in local_tables:
+                    page_content.append({
+                        "type": "text",
+                        "text": f"--- PÁGINA {page_num + 1} (tabla extraída del texto del PDF) ---\n{local_tables[page_num]}"
+                    })
+                    continue
+                img_base64, media_type = pages.render_base64(page_num, "analysis")
+                page_content.append({"type": "text", "text": f"--- PÁGINA {page_num + 1} ---"})
+                page_content.append({
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": img_base64,
+                    }
+                })
+            last_page = page_nums[-1] + 1 if len(groups) > 1 or reused_pages else None
+            return _request_staff_group(
+                client, page_content, convenio_text, context_tokens, page_nums[0] + 1, last_page,
+                callback, group_timings, usage
+            )
+
+        if len(groups) == 1:
+            group_results = [extract_group(groups[0], stream_callback, timings)]
+        else:
+            start = time.perf_counter()
+            group_results = run_pages_concurrently(extract_group, groups, max_workers, progress_callback)
+            if timings is not None:
+                timings["total"] = time.perf_counter() - start
+
+        if image_stats is not None:
+            image_stats.update(pages.image_stats)
+
+    # Guardar cada página por su huella; los grupos sin página en cada fila no se guardan por páginas
+    unassigned = []
+    for page_nums, result in zip(groups, group_results):
+        by_page = split_staff_by_page(result, page_nums)
+        if by_page is None:
+            unassigned.append((page_nums, result))
+            continue
+        for page_num, page_result in by_page.items():
+            if page_num in page_results:
+                # Página compartida por dos grupos: se suman sus filas sin repetir
+                known = {_worker_key(row) for row in page_results[page_num]["trabajadores"]}
+                page_result["trabajadores"] = page_results[page_num]["trabajadores"] + [
+                    row for row in page_result["trabajadores"] if _worker_key(row) not in known
+                ]
+            page_results[page_num] = page_result
+    for page_num in pending:
+        if page_num in page_results:
+            convenio_cache.put_json(page_keys[page_num], "staff_page.json", page_results[page_num])
+
+    # Último análisis completo que contenía las páginas reutilizadas
+    previous_keys = [
+        convenio_cache.get_text(page_keys[page_num], "analisis.txt")
+        for page_num in range(total_pages) if page_num not in pending
+    ]
+    previous_keys = [k for k in previous_keys if k and k != key]
+    previous_key = max(set(previous_keys), key=previous_keys.count) if previous_keys else None
+
+    # Unir en el orden del documento; las filas de un grupo sin páginas que ya
+    # están en una página suya resuelta por otro grupo (el solape) se descartan
+    ordered = [(page_num, 0, result) for page_num, result in page_results.items()]
+    for page_nums, result in unassigned:
+        known = {
+            _worker_key(row)
+            for page_num in page_nums if page_num in page_results
+            for row in page_results[page_num]["trabajadores"]
+        }
+        rows = [row for row in result.get("trabajadores") or [] if _worker_key(row) not in known]
+        ordered.append((page_nums[0], 1, {**result, "trabajadores": rows}))
+    ordered.sort(key=lambda item: item[:2])
+    data = merge_staff_groups([result for _, _, result in ordered])
+    data["paginas"] = total_pages
+    data["paginas_texto"] = len(local_tables)
+    data["paginas_reutilizadas"] = reused_pages
+    data["huellas"] = fingerprints
+    data["analisis_anterior"] = previous_key
+    convenio_cache.put_json(key, "staff_data.json", data)
+    for page_key in page_keys:
+        convenio_cache.put_text(page_key, "analisis.txt", key)
+    return data
+
+def previous_staff_data(staff_data):
+    """Análisis anterior del mismo documento (ver extract_staff_data), o None"""
+    if not staff_data.get("analisis_anterior"):
+        return None
+    return convenio_cache.get_json(staff_data["analisis_anterior"], "staff_data.json")
+
+def analyze_with_claude(client, file_bytes, file_type, convenio_text, years, is_image=False, image_stats=None):
+    """Analiza el documento con Claude y calcula los costes localmente
+
+    Devuelve el informe en markdown con las tablas de costes.
+    """
+    data = extract_staff_data(client, file_bytes, file_type, convenio_text, is_image, image_stats=image_stats)
+    return render_cost_report(data, compute_costs(data, years))
+
+def run_analysis(job, client, request):
+    """Análisis completo (convenio + tabla de personal + costes), pensado para jobs.submit
+
+    request es un dict con los datos ya leídos de la interfaz:
+    - "metodo": "buscar", "biblioteca", "subir" o None
+    - "convenio_busqueda", "forzar_busqueda" (buscar)
+    - "convenio_nombre" (biblioteca)
+    - "convenio_bytes", "convenio_file_type", "convenio_is_image" (subir)
+    - "file_bytes", "file_type", "is_image": tabla de personal
+    - "years", "max_workers", "streaming"
+    - "estrategia": opcional, la elegida por planner.plan_analysis
+
+    El progreso se notifica en job (ver jobs.Job). Devuelve un dict con
+    staff_data, resultado, years, convenio_text y staff_diff (cambios respecto
+    al análisis anterior del mismo documento, o None).
+    """
+    max_workers = request.get("max_workers")
+    streaming = request.get("streaming")
+    estrategia = request.get("estrategia") or {}
+    convenio_text = ""
+    convenio_image_stats = {}
+    convenio_skip_stats = {}
+
+    job.set_stage("Convenio")
+    metodo = request.get("metodo")
+    if metodo == "buscar":
+        nombre = request["convenio_busqueda"]
+        search_timings = {}
+        search_cache_info = {}
+        job.info(f"🌐 Buscando en internet el convenio más reciente: {nombre}...")
+        convenio_text = buscar_convenio_con_ia(
+            client,
+            nombre,
+            job.markdown if streaming else None,
+            search_timings,
+            request.get("forzar_busqueda", False),
+            search_cache_info
+        )
+        job.empty()
+        if search_cache_info.get("cached"):
+            job.note(
+                "success",
+                f"♻️ Convenio recuperado de la búsqueda del {search_cache_info['fecha']} "
+                f"(fuente: {search_cache_info['fuente']})"
+            )
+        else:
+            job.note("success", "✅ Convenio actualizado obtenido de internet")
+            job.note("caption", f"{format_timings(search_timings)} · fuente: {search_cache_info.get('fuente', '')}")
+    elif metodo == "subir":
+        job.info("📄 Procesando archivo del convenio...")
+        convenio_text = extract_convenio_from_file(
+            client, request["convenio_bytes"], request["convenio_file_type"], request["convenio_is_image"],
+            progress_placeholder=job,
+            max_workers=max_workers,
+            image_stats=convenio_image_stats,
+            triage_batch_size=estrategia.get("triage_batch"),
+            max_px=estrategia.get("max_px"),
+            skip_stats=convenio_skip_stats,
+        )
+        job.note("success", "✅ Convenio procesado correctamente")
+    elif metodo == "biblioteca":
+        convenio_path = convenio_library.LIBRARY_DIR / request["convenio_nombre"]
+        entry = convenio_library.get_entry(convenio_path)
+        if entry is None:
+            job.info("📄 Procesando convenio seleccionado...")
+            convenio_library.index_file(
+                convenio_path,
+                # El índice de la biblioteca es permanente: siempre a resolución completa
+                lambda pdf_bytes: extract_convenio_from_file(
+                    client, pdf_bytes, "pdf", False,
+                    progress_placeholder=job,
+                    max_workers=max_workers,
+                    image_stats=convenio_image_stats,
+                    triage_batch_size=estrategia.get("triage_batch"),
+                    skip_stats=convenio_skip_stats,
+                ),
+                cached_relevant_pages
+            )
+            entry = convenio_library.get_entry(convenio_path)
+            job.note("success", "✅ Convenio procesado correctamente")
+        else:
+            job.note(
+                "success",
+                f"📚 Convenio precompilado de la biblioteca "
+                f"(indexado el {time.strftime('%d/%m/%Y %H:%M', time.localtime(entry['indexed_at']))})"
+            )
+        convenio_text = entry["text"] if entry else ""
+
+    if convenio_image_stats:
+        job.note("caption", format_image_savings(convenio_image_stats))
+    if convenio_skip_stats.get("blank") or convenio_skip_stats.get("duplicates"):
+        job.note(
+            "caption",
+            f"🧹 Páginas escaneadas omitidas: {convenio_skip_stats['blank']} en blanco y "
+            f"{convenio_skip_stats['duplicates']} duplicadas · {convenio_skip_stats['calls_saved']} llamadas ahorradas"
+        )
+    if not convenio_text:
+        job.note("warning", "⚠️ No se ha cargado ningún convenio. Los cálculos pueden no ser precisos.")
+
+    job.set_stage("Tabla de personal")
+    job.info("🔄 Analizando documento con IA... Esto puede tardar unos segundos.")
+    analysis_image_stats = {}
+    analysis_timings = {}
+    analysis_usage = {}
+    staff_data = extract_staff_data(
+        client,
+        request["file_bytes"],
+        request["file_type"],
+        convenio_text,
+        request.get("is_image", False),
+        image_stats=analysis_image_stats,
+        stream_callback=(lambda rows: job.markdown(format_partial_staff(rows))) if streaming else None,
+        timings=analysis_timings,
+        usage=analysis_usage,
+        context_tokens=estrategia.get("context_tokens"),
+        progress_callback=lambda done, total: job.progress(
+            done / total, text=f"Grupos de páginas analizados: {done}/{total}"
+        ),
+        max_workers=max_workers,
+        max_px=estrategia.get("max_px")
+    )
+    job.empty()
+
+    job.set_stage("Cálculo de costes")
+    years = request["years"]
+    with metrics.span("calculo_costes"):
+        resultado = render_cost_report(staff_data, compute_costs(staff_data, years))
+
+    job.note("success", "✅ Análisis completado")
+    job.note(
+        "caption",
+        f"Páginas procesadas: {staff_data.get('paginas', 1)} "
+        f"({staff_data.get('paginas_texto', 0)} leídas como texto, sin imagen) · "
+        f"Trabajadores extraídos: {len(staff_data.get('trabajadores') or [])}"
+    )
+    if staff_data.get("paginas_reutilizadas"):
+        job.note(
+            "caption",
+            f"♻️ {staff_data['paginas_reutilizadas']} de {staff_data['paginas']} páginas sin cambios "
+            f"reutilizadas de una versión anterior del documento"
+        )
+    if analysis_timings:
+        job.note("caption", format_timings(analysis_timings))
+    if analysis_image_stats:
+        job.note("caption", format_image_savings(analysis_image_stats))
+    if analysis_usage:
+        job.note("caption", format_usage(analysis_usage))
+
+    # Versión corregida de un documento ya analizado (en esta u otra sesión): qué ha cambiado
+    diff = None
+    previous = previous_staff_data(staff_data)
+    if previous:
+        diff = format_staff_diff(
+            staff_diff(previous, staff_data),
+            compute_costs(previous, years)["summary"]["total"] * years,
+            compute_costs(staff_data, years)["summary"]["total"] * years,
+        )
+
+    return {
+        "staff_data": staff_data,
+        "resultado": resultado,
+        "years": years,
+        "convenio_text": convenio_text,
+        "staff_diff": diff,
+    }
+
+@metrics.timed("parseo_markdown")
+def parse_markdown_sections(text):
+    """Extrae las tablas markdown del texto junto con su título
+
+    Devuelve una lista de (título, filas), donde el título es la última línea
+    de texto anterior a la tabla (sin negritas ni dos puntos) y cada fila es
+    la lista de celdas; se omiten las filas separadoras.
+    """
+    sections = []
+    title = ""
+    rows = None
+    for line in text.split('\n') + [""]:
+        stripped = line.strip()
+        if stripped.startswith('|'):
+            if rows is None:
+                rows = []
+            if not re.fullmatch(r"[\s|:\-]+", stripped):
+                rows.append([cell.strip() for cell in stripped.strip('|').split('|')])
+            continue
+        if rows is not None:
+            sections.append((title, rows))
+            rows = None
+        if stripped:
+            title = stripped
+    return [(_section_title(title), rows) for title, rows in sections if rows]
+
+def _section_title(line):
+    title = re.sub(r"[*:]", "", line)
+    title = re.sub(r"\(.*?\)", "", title)
+    return " ".join(c for c in title.split() if any(ch.isalnum() for ch in c))
+
+_EXCEL_NUMBER_RE = re.compile(r"(-?\d{1,3}(?:\.\d{3})*(?:,\d+)?|-?\d+(?:,\d+)?)\s*(€|%)?")
+
+def excel_value(text):
+    """Convierte una celda del informe en (valor, estilo)
+
+    Los importes en formato español ("1.234,56 €") y los porcentajes se
+    escriben como números con su formato; el resto, como texto sin negritas.
+    """
+    text = text.replace("**", "").strip()
+    match = _EXCEL_NUMBER_RE.fullmatch(text)
+    if not match:
+        return text, "informe_celda"
+    number = float(match.group(1).replace(".", "").replace(",", "."))
+    if match.group(2) == "€":
+        return number, "informe_importe"
+    if match.group(2) == "%":
+        return number / 100, "informe_porcentaje"
+    return number, _number_style(number)
+
+def _number_style(number):
+    """Sin decimales si el número es entero (el formato "#,##0.##" deja la coma colgando)"""
+    return "informe_entero" if float(number).is_integer() else "informe_numero"
+
+def _excel_styles():
+    border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    styles = [
+        NamedStyle(name="informe_titulo", font=Font(bold=True, size=14)),
+        NamedStyle(
+            name="informe_cabecera",
+            font=Font(bold=True, color="FFFFFF"),
+            fill=PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid"),
+            border=border,
+            alignment=Alignment(horizontal='center'),
+        ),
+        NamedStyle(name="informe_celda", border=border),
+        NamedStyle(name="informe_numero", border=border, number_format="#,##0.##", alignment=Alignment(horizontal='right')),
+        NamedStyle(name="informe_entero", border=border, number_format="#,##0", alignment=Alignment(horizontal='right')),
+        NamedStyle(name="informe_importe", border=border, number_format='#,##0.00 "€"', alignment=Alignment(horizontal='right')),
+        NamedStyle(name="informe_porcentaje", border=border, number_format="0.00%", alignment=Alignment(horizontal='right')),
+    ]
+    return styles
+
+def _sheet_name(title, used):
+    name = re.sub(r"[\[\]:*?/\\]", "", title).strip()[:31] or "Tabla"
+    base, n = name, 2
+    while name.lower() in used:
+        suffix = f" ({n})"
+        name = base[:31 - len(suffix)] + suffix
+        n += 1
+    used.add(name.lower())
+    return name
+
+@metrics.timed("excel")
+def create_excel_from_result(resultado, years, scenarios=None):
+    """Crea un archivo Excel con los resultados del análisis
+
+    Cada tabla del informe va en su propia hoja. El libro se escribe en modo
+    write-only con estilos con nombre compartidos, y los anchos de columna se
+    calculan al convertir las celdas, sin recorrer después la hoja.
+
+    scenarios, si se pasa, es la tabla de cost_engine.scenario_table y se
+    añade como hoja "Escenarios" con los valores numéricos tal cual.
+    """
+    wb = Workbook(write_only=True)
+    for style in _excel_styles():
+        wb.add_named_style(style)
+    titulo = f"CÁLCULO DE COSTES DE SUBROGACIÓN - {years} AÑO(S)"
+
+    # Intentar extraer tablas del resultado
+    sections = parse_markdown_sections(resultado)
+    if not sections:
+        # Si no hay tablas, poner el texto completo
+        lines = [line for line in resultado.split('\n') if line.strip()]
+        sections = [("Resultado", [["Resultado del Análisis:"]] + [[line] for line in lines])]
+
+    used_names = set()
+    for title, rows in sections:
+        ws = wb.create_sheet(_sheet_name(title, used_names))
+
+        values = []
+        widths = {}
+        for row_num, row in enumerate(rows):
+            converted = []
+            for col, text in enumerate(row):
+                value, style = excel_value(text)
+                if row_num == 0:
+                    value, style = text.replace("**", "").strip(), "informe_cabecera"
+                converted.append((value, style))
+                widths[col] = max(widths.get(col, 0), len(text))
+            values.append(converted)
+
+        # En modo write-only los anchos se fijan antes de escribir las filas
+        for col, max_length in widths.items():
+            ws.column_dimensions[get_column_letter(col + 1)].width = min(max_length + 2, 50) if max_length else 10
+
+        # append() escribe la fila en el momento, así que basta una celda con
+        # estilo por columna y estilo, que se reutiliza cambiando su valor
+        styled_cells = {}
+
+        def styled(col, value, style):
+            cell = styled_cells.get((col, style))
+            if cell is None:
+                cell = styled_cells[(col, style)] = WriteOnlyCell(ws)
+                cell.style = style
+            cell.value = value
+            return cell
+
+        ws.append([styled(0, titulo, "informe_titulo")])
+        ws.append([])
+        for converted in values:
+            ws.append([styled(col, value, style) for col, (value, style) in enumerate(converted)])
+
+    if scenarios:
+        headers, rows = scenarios
+        ws = wb.create_sheet(_sheet_name("Escenarios", used_names))
+        for col, header in enumerate(headers):
+            ws.column_dimensions[get_column_letter(col + 1)].width = max(len(header) + 2, 14)
+        header_cells = [WriteOnlyCell(ws, value=header) for header in headers]
+        for cell in header_cells:
+            cell.style = "informe_cabecera"
+        ws.append(header_cells)
+        row_cells = [WriteOnlyCell(ws) for _ in headers]
+        for cell, (_, _, kind) in zip(row_cells, SCENARIO_COLUMNS):
+            cell.style = f"informe_{kind}"
+        for row in rows:
+            for cell, value, (_, _, kind) in zip(row_cells, row, SCENARIO_COLUMNS):
+                cell.value = value
+                if kind == "numero":
+                    cell.style = _number_style(value)
+            ws.append(row_cells)
+
+    # Guardar en buffer
+    excel_buffer = io.BytesIO()
+    wb.save(excel_buffer)
+    excel_buffer.seek(0)
+
+    return excel_buffer
+
+@lru_cache(maxsize=16)
+def excel_export_bytes(resultado, years, scenarios=None):
+    """Bytes del XLSX de un informe, memorizados por el contenido del informe, los años y los escenarios"""
+    return create_excel_from_result(resultado, years, scenarios).getvalue()
+
+def format_timings(timings):
+    """Texto con el tiempo hasta el primer token y el tiempo total de una llamada"""
+    if not timings:
+        return ""
+    parts = []
+    if "ttft" in timings:
+        parts.append(f"primer token en {timings['ttft']:.1f} s")
+    parts.append(f"total {timings['total']:.1f} s")
+    return "⏱️ " + ", ".join(parts)
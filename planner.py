@@ -0,0 +1,295 @@
+"""Planificación previa de cada análisis: llamadas, tokens, tiempo y coste.
+
+Antes de lanzar un análisis se inspeccionan los documentos localmente (número
+de páginas, páginas con capa de texto, tamaño de las imágenes que se
+enviarían, tablas de personal legibles como texto y longitud del convenio)
+y se estima, para cada estrategia posible, cuántas llamadas a la API se
+harán, sus tokens de entrada y salida, el tiempo total y el coste. Lo que ya
+está en la caché de disco no se cuenta.
+
+Una estrategia combina tres parámetros: la resolución de las páginas
+enviadas como imagen (RESOLUTIONS), las páginas por petición de la fase 1
+(TRIAGE_BATCHES) y el presupuesto de tokens del convenio en el prompt del
+análisis (CONTEXT_CAPS). Cada lista va de la opción más fiable a la más
+barata; plan_analysis elige la más fiable que cabe en el presupuesto del
+usuario (coste y minutos) y, si ninguna cabe, la más barata.
+
+Las constantes de latencia y tokens de salida son aproximaciones medidas
+sobre convenios reales; se pueden ajustar por entorno.
+"""
+import math
+import os
+from functools import lru_cache
+from itertools import product
+
+import api_client
+import convenio_cache
+from convenio_context import CHARS_PER_TOKEN, CONVENIO_CONTEXT_TOKENS
+from pipeline import (
+    CONVENIO_CACHE_VERSION, CONVENIO_MAX_WORKERS, RENDER_PROFILES, SCANNED_PAGES_DIRECT_MAX, SCANNED_PAGES_FALLBACK,
+    TRIAGE_BATCH_SIZE, PdfPages, cached_search, convenio_page_key, estimate_image_tokens, fit_zoom, local_staff_tables,
+    staff_analysis_key, staff_page_groups,
+)
+
+# Precio por millón de tokens (USD)
+PLANNER_PRICE_INPUT = float(os.getenv("PLANNER_PRICE_INPUT", "3"))
+PLANNER_PRICE_OUTPUT = float(os.getenv("PLANNER_PRICE_OUTPUT", "15"))
+# Multiplicadores de precio de la caché de prompts (escritura y lectura)
+CACHE_WRITE_FACTOR = 1.25
+CACHE_READ_FACTOR = 0.1
+
+# Segundos fijos por llamada (red + primer token) y tokens de salida por segundo
+PLANNER_CALL_LATENCY = float(os.getenv("PLANNER_CALL_LATENCY", "2.5"))
+PLANNER_OUTPUT_TPS = float(os.getenv("PLANNER_OUTPUT_TPS", "60"))
+# Proporción de páginas escaneadas que la fase 1 suele marcar como relevantes
+PLANNER_RELEVANT_RATIO = float(os.getenv("PLANNER_RELEVANT_RATIO", "0.3"))
+
+# Tokens aproximados de cada tipo de petición
+TRIAGE_PROMPT_TOKENS = 150
+TRIAGE_OUTPUT_TOKENS_PER_PAGE = 20
+EXTRACTION_PROMPT_TOKENS = 250
+EXTRACTION_OUTPUT_TOKENS = 900
+SEARCH_INPUT_TOKENS = 25000
+SEARCH_OUTPUT_TOKENS = 4000
+SEARCH_SECONDS = 60
+STAFF_PROMPT_TOKENS = 1500
+STAFF_BASE_OUTPUT_TOKENS = 600
+STAFF_OUTPUT_TOKENS_PER_WORKER = 70
+STAFF_WORKERS_PER_IMAGE_PAGE = 25
+
+# Opciones de cada parámetro, de la más fiable a la más barata
+RESOLUTIONS = (RENDER_PROFILES["extraction"]["max_px"], 1200, 1000)
+TRIAGE_BATCHES = (TRIAGE_BATCH_SIZE, TRIAGE_BATCH_SIZE * 2)
+CONTEXT_CAPS = (CONVENIO_CONTEXT_TOKENS, 6000, 3000)
+
+def _image_tokens(width, height, max_px):
+    zoom = fit_zoom(width, height, max_px)
+    return estimate_image_tokens(width * zoom, height * zoom)
+
+@lru_cache(maxsize=8)
+def inspect_pdf(pdf_bytes, staff=False):
+    """Datos locales de un PDF para planificar.
+
+    Con staff, las tablas de personal legibles como texto. Las páginas en
+    blanco o duplicadas no se descartan aquí (ver pipeline.skip_scanned_pages):
+    renderizarlas costaría más que el propio plan, y el plan queda por arriba.
+    """
+    with PdfPages(pdf_bytes) as pages:
+        infos = [pages.page_info(page_num) for page_num in range(len(pages))]
+        scanned = [i for i, info in enumerate(infos) if not info["has_text_layer"] and info["has_images"]]
+        local_tables = local_staff_tables(pages) if staff else {}
+    return {
+        "pages": [(info["width"], info["height"]) for info in infos],
+        "scanned": scanned,
+        "text_chars": sum(info["text_chars"] for info in infos if info["has_text_layer"]),
+        "local_tables": {page: len(markdown) for page, markdown in local_tables.items()},
+        "local_rows": {page: markdown.count("\n") - 1 for page, markdown in local_tables.items()},
+    }
+
+def _stage(name, calls=0, input_tokens=0, output_tokens=0, seconds=0.0, cached_input_tokens=0, cost=None):
+    if cost is None:
+        cost = (input_tokens * PLANNER_PRICE_INPUT + output_tokens * PLANNER_PRICE_OUTPUT) / 1e6
+    return {
+        "name": name,
+        "calls": calls,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_input_tokens": cached_input_tokens,
+        "seconds": seconds,
+        "cost": cost,
+    }
+
+def _wall_seconds(call_outputs, input_tokens, max_workers):
+    """Tiempo de un grupo de llamadas en paralelo, acotado por los límites de ritmo de api_client"""
+    if not call_outputs:
+        return 0.0
+    waves = [call_outputs[i:i + max_workers] for i in range(0, len(call_outputs), max_workers)]
+    seconds = sum(PLANNER_CALL_LATENCY + max(wave) / PLANNER_OUTPUT_TPS for wave in waves)
+    # Los cubos del limitador empiezan llenos: solo limita lo que supera un minuto de cupo
+    rpm_seconds = max(0, len(call_outputs) - api_client.API_RPM) / api_client.API_RPM * 60
+    tpm_seconds = max(0, input_tokens - api_client.API_INPUT_TPM) / api_client.API_INPUT_TPM * 60
+    otpm_seconds = max(0, sum(call_outputs) - api_client.API_OUTPUT_TPM) / api_client.API_OUTPUT_TPM * 60
+    return max(seconds, rpm_seconds, tpm_seconds, otpm_seconds)
+
+def estimate_convenio_pdf(pdf_bytes, strategy, max_workers):
+    """Etapas de extracción de un convenio en PDF y tokens estimados de su texto"""
+    info = inspect_pdf(pdf_bytes)
+    key = convenio_cache.cache_key(pdf_bytes, CONVENIO_CACHE_VERSION)
+    scanned = info["scanned"]
+    stages = []
+
+    if len(scanned) <= SCANNED_PAGES_DIRECT_MAX:
+        to_extract = scanned
+    else:
+        relevant = convenio_cache.get_json(key, "relevant_pages.json")
+        if relevant is None:
+            batch = strategy["triage_batch"]
+            batches = [scanned[i:i + batch] for i in range(0, len(scanned), batch)]
+            triage_px = RENDER_PROFILES["triage"]["max_px"]
+            input_tokens = sum(
+                TRIAGE_PROMPT_TOKENS + sum(_image_tokens(*info["pages"][p], triage_px) for p in pages)
+                for pages in batches
+            )
+            outputs = [TRIAGE_OUTPUT_TOKENS_PER_PAGE * len(pages) for pages in batches]
+            stages.append(_stage(
+                "Convenio: fase 1 (triaje)", len(batches), input_tokens, sum(outputs),
+                _wall_seconds(outputs, input_tokens, max_workers)
+            ))
+            relevant = scanned[:max(1, round(len(scanned) * PLANNER_RELEVANT_RATIO))]
+        to_extract = relevant or scanned[:SCANNED_PAGES_FALLBACK]
+
+    page_key = convenio_page_key(pdf_bytes, strategy["max_px"])
+    pending = [p for p in to_extract if not convenio_cache.has(page_key, f"page_{p + 1:04d}.txt")]
+    if pending:
+        input_tokens = sum(
+            EXTRACTION_PROMPT_TOKENS + _image_tokens(*info["pages"][p], strategy["max_px"]) for p in pending
+        )
+        outputs = [EXTRACTION_OUTPUT_TOKENS] * len(pending)
+        stages.append(_stage(
+            "Convenio: extracción de páginas escaneadas", len(pending), input_tokens, sum(outputs),
+            _wall_seconds(outputs, input_tokens, max_workers)
+        ))
+
+    text_tokens = int(info["text_chars"] / CHARS_PER_TOKEN) + len(to_extract) * EXTRACTION_OUTPUT_TOKENS
+    return stages, text_tokens
+
+def estimate_convenio(request, strategy, max_workers):
+    """Etapas del paso del convenio según request["metodo"] (ver pipeline.run_analysis)"""
+    metodo = request.get("metodo")
+    if metodo == "buscar":
+        entry = None if request.get("forzar_busqueda") else cached_search(request["convenio_busqueda"])
+        if entry:
+            return [], int(len(entry["text"]) / CHARS_PER_TOKEN)
+        stage = _stage("Convenio: búsqueda web", 1, SEARCH_INPUT_TOKENS, SEARCH_OUTPUT_TOKENS, SEARCH_SECONDS)
+        return [stage], SEARCH_OUTPUT_TOKENS
+    if metodo == "biblioteca":
+        if request.get("convenio_text") is not None:
+            return [], int(len(request["convenio_text"]) / CHARS_PER_TOKEN)
+        # La biblioteca se indexa siempre a resolución completa (ver pipeline.run_analysis)
+        return estimate_convenio_pdf(request["convenio_bytes"], {**strategy, "max_px": None}, max_workers)
+    if metodo == "subir":
+        if not request["convenio_is_image"]:
+            return estimate_convenio_pdf(request["convenio_bytes"], strategy, max_workers)
+        key = convenio_cache.cache_key(request["convenio_bytes"], CONVENIO_CACHE_VERSION)
+        if convenio_cache.has(key, "image.txt"):
+            return [], EXTRACTION_OUTPUT_TOKENS
+        input_tokens = EXTRACTION_PROMPT_TOKENS + api_client.IMAGE_TOKENS
+        stage = _stage(
+            "Convenio: extracción de la imagen", 1, input_tokens, EXTRACTION_OUTPUT_TOKENS,
+            _wall_seconds([EXTRACTION_OUTPUT_TOKENS], input_tokens, max_workers)
+        )
+        return [stage], EXTRACTION_OUTPUT_TOKENS
+    return [], 0
+
+def estimate_staff(request, strategy, convenio_tokens, max_workers):
+    """Etapa del análisis de la tabla de personal (una llamada por grupo de páginas)"""
+    convenio_text = request.get("convenio_text")
+    if convenio_text is not None:
+        key = staff_analysis_key(request["file_bytes"], convenio_text, strategy["context_tokens"], strategy["max_px"])
+        if convenio_cache.has(key, "staff_data.json"):
+            return None
+
+    prefix_tokens = STAFF_PROMPT_TOKENS + min(convenio_tokens, strategy["context_tokens"])
+    if request.get("is_image"):
+        groups = [(api_client.IMAGE_TOKENS, STAFF_WORKERS_PER_IMAGE_PAGE)]
+    else:
+        info = inspect_pdf(request["file_bytes"], staff=True)
+        groups = []
+        for page_nums in staff_page_groups(len(info["pages"])):
+            page_tokens = 0
+            workers = 0
+            for p in page_nums:
+                if p in info["local_tables"]:
+                    page_tokens += int(info["local_tables"][p] / CHARS_PER_TOKEN)
+                    workers += info["local_rows"][p]
+                else:
+                    page_tokens += _image_tokens(*info["pages"][p], strategy["max_px"])
+                    workers += STAFF_WORKERS_PER_IMAGE_PAGE
+            groups.append((page_tokens, workers))
+
+    outputs = [STAFF_BASE_OUTPUT_TOKENS + workers * STAFF_OUTPUT_TOKENS_PER_WORKER for _, workers in groups]
+    page_tokens = sum(tokens for tokens, _ in groups)
+    input_tokens = page_tokens + prefix_tokens * len(groups)
+    # El prefijo (instrucciones + convenio) se escribe en la caché de prompts una vez y se lee en el resto
+    cost = (
+        page_tokens * PLANNER_PRICE_INPUT
+        + prefix_tokens * PLANNER_PRICE_INPUT * (CACHE_WRITE_FACTOR + CACHE_READ_FACTOR * (len(groups) - 1))
+        + sum(outputs) * PLANNER_PRICE_OUTPUT
+    ) / 1e6
+    return _stage(
+        "Tabla de personal", len(groups), input_tokens, sum(outputs),
+        _wall_seconds(outputs, input_tokens, max_workers), prefix_tokens * (len(groups) - 1), cost
+    )
+
+def estimate(request, strategy, max_workers=None):
+    """Plan de un análisis con una estrategia concreta"""
+    max_workers = max_workers or CONVENIO_MAX_WORKERS
+    stages, convenio_tokens = estimate_convenio(request, strategy, max_workers)
+    staff_stage = estimate_staff(request, strategy, convenio_tokens, max_workers)
+    if staff_stage:
+        stages.append(staff_stage)
+    return {
+        "estrategia": strategy,
+        "etapas": stages,
+        "llamadas": sum(s["calls"] for s in stages),
+        "tokens_entrada": sum(s["input_tokens"] for s in stages),
+        "tokens_salida": sum(s["output_tokens"] for s in stages),
+        "segundos": sum(s["seconds"] for s in stages),
+        "coste": sum(s["cost"] for s in stages),
+    }
+
+def strategies():
+    """Todas las estrategias con su índice de pérdida de calidad (0 = la de siempre)"""
+    for (r, max_px), (b, batch), (c, context) in product(
+        enumerate(RESOLUTIONS), enumerate(TRIAGE_BATCHES), enumerate(CONTEXT_CAPS)
+    ):
+        yield r + b + c, {"max_px": max_px, "triage_batch": batch, "context_tokens": context}
+
+def plan_analysis(request, max_usd=0, max_minutes=0, max_workers=None):
+    """Elige la estrategia para el presupuesto (0 = sin límite) y devuelve su plan.
+
+    request tiene el formato de pipeline.run_analysis; para la biblioteca se
+    puede añadir "convenio_text" (si ya está indexado) o "convenio_bytes".
+    Se prefiere la estrategia con menos pérdida de calidad que cabe en el
+    presupuesto y, a igualdad, la más barata. Si ninguna cabe, se elige la
+    más barata y el plan lleva "dentro_presupuesto" a False.
+    """
+    candidates = [(loss, estimate(request, strategy, max_workers)) for loss, strategy in strategies()]
+
+    def fits(plan):
+        return (not max_usd or plan["coste"] <= max_usd) and (not max_minutes or plan["segundos"] <= max_minutes * 60)
+
+    within = [(loss, plan) for loss, plan in candidates if fits(plan)]
+    if within:
+        plan = min(within, key=lambda item: (item[0], item[1]["coste"], item[1]["segundos"]))[1]
+    else:
+        plan = min(candidates, key=lambda item: (item[1]["coste"], item[1]["segundos"]))[1]
+    plan["dentro_presupuesto"] = bool(within)
+    plan["referencia"] = candidates[0][1]
+    return plan
+
+def format_plan(plan):
+    """Resumen markdown del plan, para mostrarlo antes de lanzar el análisis"""
+    strategy = plan["estrategia"]
+    minutes, seconds = divmod(math.ceil(plan["segundos"]), 60)
+    lines = [
+        f"**{plan['llamadas']} llamadas** a la IA · ≈{plan['tokens_entrada']:,} tokens de entrada y "
+        f"{plan['tokens_salida']:,} de salida · ≈{minutes} min {seconds:02d} s · ≈{plan['coste']:.2f} $",
+        "",
+        f"Estrategia: imágenes a {strategy['max_px']} px · fase 1 de {strategy['triage_batch']} páginas por petición · "
+        f"convenio de hasta {strategy['context_tokens']:,} tokens en el prompt",
+    ]
+    reference = plan["referencia"]
+    if reference["estrategia"] != strategy:
+        lines.append(
+            f"(la estrategia completa costaría ≈{reference['coste']:.2f} $ y ≈{reference['segundos'] / 60:.1f} min)"
+        )
+    if plan["etapas"]:
+        lines += ["", "| Etapa | Llamadas | Tokens entrada | Tokens salida | Segundos | Coste ($) |", "|---|---|---|---|---|---|"]
+        lines += [
+            f"| {s['name']} | {s['calls']} | {s['input_tokens']:,} | {s['output_tokens']:,} | {s['seconds']:.0f} | {s['cost']:.3f} |"
+            for s in plan["etapas"]
+        ]
+    else:
+        lines += ["", "♻️ Todo está en la caché: no se llamará a la IA."]
+    return "\n".join(lines)